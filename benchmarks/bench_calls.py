@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Function call speed and how deep recursion can go, for the Expression tree
+# walker and the VM. Depth is found by doubling n in a recursive sum (and a
+# tail-recursive count) until the run fails, then bisecting.
+# Usage: python benchmarks/bench_calls.py [calls] [depth cap]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import interpreter
+import vm
+import optimizer
+
+CALLS = {
+  "call loop": """
+function step takes x
+  return x + 1
+i = 0
+while i < %(n)d
+  i = step i
+""",
+  "fibonacci": """
+function fib takes n
+  if n < 2
+    return n
+  else
+    return (fib (n - 1)) + (fib (n - 2))
+print fib %(fib)d
+""",
+}
+
+# How many calls each of the above makes for n.
+def fibCalls(n):
+  a, b = 1, 1
+  for i in range(n):
+    a, b = b, a + b + 1
+  return a
+
+DEPTH = {
+  "recursion": """
+function sum takes n
+  if n < 1
+    return 0
+  else
+    return n + (sum (n - 1))
+print sum %(n)d
+""",
+  "tail recursion": """
+function count takes n, acc
+  if n < 1
+    return acc
+  return count (n - 1), (acc + n)
+print count %(n)d, 0
+""",
+}
+
+def runProgram(text, mode, max_depth):
+  #Run a program from scratch; returns (seconds, printed lines), raising whatever stopped it.
+  expressions = interpreter.fullParse(text)
+  log = []
+  session = interpreter.resetGlobalScope(log, state = interpreter.RunState(max_depth = max_depth))
+  start = time.time()
+  if mode == "vm":
+    vm.run(vm.compileProgram(optimizer.optimize(expressions)[0]), interpreter.global_scope)
+  else:
+    session.evaluate(expressions)
+  return time.time() - start, log
+
+def succeeds(text, mode, n, max_depth):
+  try:
+    seconds, log = runProgram(text % {'n': n}, mode, max_depth)
+  except (interpreter.ScriptError, RuntimeError):
+    return False
+  return len(log) > 0
+
+def maxDepth(text, mode, cap):
+  #The largest n (up to cap) for which the program runs to the end.
+  low, high = 0, 1
+  while high <= cap and succeeds(text, mode, high, cap):
+    low, high = high, high * 2
+  high = min(high, cap + 1)
+  while high - low > 1:
+    middle = (low + high) / 2
+    if succeeds(text, mode, middle, cap):
+      low = middle
+    else:
+      high = middle
+  return low
+
+if __name__ == '__main__':
+  calls = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+  cap = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+  fib = 15
+  counts = {"call loop": calls, "fibonacci": fibCalls(fib)}
+  print '%-16s %14s %14s' % ('calls/s', 'tree', 'vm')
+  for name in sorted(CALLS):
+    rates = []
+    logs = []
+    for mode in ['tree', 'vm']:
+      seconds, log = runProgram(CALLS[name] % {'n': calls, 'fib': fib}, mode, cap)
+      rates.append(counts[name] / seconds)
+      logs.append(log)
+    print '%-16s %14.0f %14.0f' % (name, rates[0], rates[1])
+    if logs[0] != logs[1]:
+      print '%-16s results differ: %r != %r' % (name, logs[0], logs[1])
+  print
+  print '%-16s %14s %14s   (max_depth = %d)' % ('max depth', 'tree', 'vm', cap)
+  for name in sorted(DEPTH):
+    print '%-16s %14d %14d' % (name, maxDepth(DEPTH[name], 'tree', cap), maxDepth(DEPTH[name], 'vm', cap))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# How long /check takes to find the errors in a long program: parsing all of
+# it, checking it for the first time, and checking it again after a one-line
+# edit, when only the edited top-level block is parsed. A program that is all
+# one function is a single block, so every edit parses all of it.
+# Usage: python benchmarks/bench_check.py [lines]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import interpreter
+import checker
+import bench_memory
+
+def best(work, repeat = 5):
+  fastest = None
+  for index in range(repeat):
+    start = time.time()
+    work()
+    elapsed = (time.time() - start) * 1000
+    fastest = elapsed if fastest is None else min(fastest, elapsed)
+  return fastest
+
+def edited(text, version):
+  #text with one line in the middle changed, differently for each version.
+  lines = text.split('\n')
+  middle = len(lines) / 2
+  while lines[middle].strip() == '':
+    middle += 1
+  indent = len(lines[middle]) - len(lines[middle].lstrip())
+  lines[middle] = ' ' * indent + 'edited = %d' % version
+  return '\n'.join(lines)
+
+def measure(name, text):
+  lines = len(text.strip().split('\n'))
+  full_ms = best(lambda: interpreter.fullParse(text))
+  cold_ms = best(lambda: checker.Checker().check(text))
+  editor = checker.Checker()
+  editor.check(text)
+  versions = iter(xrange(10 ** 9))
+  edit_ms = best(lambda: editor.check(edited(text, versions.next())))
+  parsed = editor.parsed
+  same_ms = best(lambda: editor.check(text))
+  print '%-16s %6d %12.2f %12.2f %12.2f %8d %12.2f' % (name, lines, full_ms, cold_ms, edit_ms, parsed, same_ms)
+
+if __name__ == '__main__':
+  lines = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+  chunks = max(1, lines / len(bench_memory.CHUNK.strip().split('\n')))
+  programs = {
+    'blocks': ''.join(bench_memory.CHUNK % {'i': i} for i in range(chunks)),
+    'one function': 'function main\n' + '\n'.join('  ' + line for line in ''.join(bench_memory.CHUNK % {'i': i} for i in range(chunks)).split('\n')),
+  }
+  print '%-16s %6s %12s %12s %12s %8s %12s' % ('program', 'lines', 'parse ms', 'first ms', 'edit ms', 'parsed', 'unchanged ms')
+  for name in sorted(programs):
+    measure(name, programs[name])
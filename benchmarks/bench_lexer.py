@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# Check lexer.tokenTexts against the original tokenizer on random lines, then
+# compare their throughput in tokens per second.
+# Usage: python benchmarks/bench_lexer.py [lines]
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import interpreter
+import lexer
+
+ALPHABET = 'ab1 2 _()",\\-+*/=<>\t.'
+SAMPLE_LINES = [
+  'x = x + 1',
+  'while distance "left" > 50',
+  'say "hello, " + name + "!"',
+  'result = (fib (n - 1)) + (fib (n - 2))',
+  'function greet takes who, times',
+  'if (a is 1) and (b mod 2 == 0)',
+  'print "escaped \\" quote" + neg 5',
+]
+
+def randomLine(generator):
+  return ''.join(generator.choice(ALPHABET) for i in range(generator.randint(0, 30)))
+
+def checkEquivalence(count, seed = 0):
+  generator = random.Random(seed)
+  lines = SAMPLE_LINES + [randomLine(generator) for i in range(count)]
+  for line in lines:
+    expected = interpreter.legacyTokenize(line)
+    actual = lexer.tokenTexts(line)
+    typed = [token.text for token in lexer.tokenize(line)]
+    if actual != expected or typed != expected:
+      print 'MISMATCH on %r:\n  legacy   %r\n  lexer    %r\n  tokenize %r' % (line, expected, actual, typed)
+      return False
+  print 'lexer matches the legacy tokenizer on %d lines' % len(lines)
+  return True
+
+def throughput(tokenizer, lines):
+  start = time.time()
+  count = 0
+  for line in lines:
+    count += len(tokenizer(line))
+  return count / (time.time() - start)
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  if not checkEquivalence(count):
+    sys.exit(1)
+  lines = SAMPLE_LINES * (count / len(SAMPLE_LINES))
+  print '%-16s %14s' % ('tokenizer', 'tokens/s')
+  print '%-16s %14.0f' % ('legacy', throughput(interpreter.legacyTokenize, lines))
+  print '%-16s %14.0f' % ('tokenTexts', throughput(lexer.tokenTexts, lines))
+  print '%-16s %14.0f' % ('tokenize', throughput(lexer.tokenize, lines))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# How much memory parse trees and running programs take: the bytes a parsed
+# program keeps alive, and the memory and time a run needs, for both the
+# Expression tree walker and the VM. Each measurement runs in a forked child
+# so they don't see each other's garbage.
+# Uses tracemalloc when it's importable (pytracemalloc on Python 2); otherwise
+# falls back to walking the object graph and the child's peak resident size.
+# Usage: python benchmarks/bench_memory.py [lines]
+import os
+import sys
+import gc
+import time
+import resource
+import cPickle as pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import interpreter
+import vm
+import optimizer
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# Repeated to make a program of the requested number of lines.
+CHUNK = """
+count%(i)d = 0
+function step%(i)d takes x, y
+  if x > y
+    return x - y
+  else
+    return (x + y) * 2
+while count%(i)d < 3
+  count%(i)d = step%(i)d count%(i)d, %(i)d
+  if count%(i)d is 4 and not (count%(i)d > 10)
+    say "count is four"
+"""
+
+RUNS = {
+  "fibonacci": """
+function fib takes n
+  if n < 2
+    return n
+  else
+    return (fib (n - 1)) + (fib (n - 2))
+print fib 18
+""",
+  "deep recursion": """
+function sum takes n
+  if n < 1
+    return 0
+  else
+    return n + (sum (n - 1))
+i = 0
+while i < 200
+  total = sum 120
+  i = i + 1
+print total
+""",
+  "nested scopes": """
+function outer takes a
+  function middle takes b
+    function inner takes c
+      return a + b + c
+    return inner b
+  return middle a
+i = 0
+while i < 20000
+  i = i + (outer 1) - 2
+""",
+}
+
+def deepSize(root):
+  #Bytes taken by everything reachable from root, counting shared objects once.
+  seen = set()
+  stack = [root]
+  total = 0
+  while len(stack) > 0:
+    value = stack.pop()
+    if id(value) in seen or value is None:
+      continue
+    seen.add(id(value))
+    total += sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+      stack.extend(value)
+    elif isinstance(value, dict):
+      stack.extend(value.keys())
+      stack.extend(value.values())
+    elif not isinstance(value, (basestring, int, long, float, bool)):
+      if hasattr(value, '__dict__'):
+        total += sys.getsizeof(value.__dict__)
+        stack.extend(value.__dict__.values())
+      for name in getattr(type(value), '__slots__', ()):
+        stack.append(getattr(value, name, None))
+  return total
+
+def frameSize(frame):
+  #Bytes one call's Stack takes, not counting the values in it or the layout it shares.
+  total = sys.getsizeof(frame)
+  if hasattr(frame, '__dict__'):
+    total += sys.getsizeof(frame.__dict__)
+  if isinstance(frame.state, dict):
+    total += sys.getsizeof(frame.state)
+  if frame.slots is not None:
+    total += sys.getsizeof(frame.slots)
+  return total
+
+def inChild(measure):
+  #Run measure() in a forked child and return what it returns.
+  read_end, write_end = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_end)
+    try:
+      result = measure()
+    except Exception, e:
+      result = {'error': repr(e)}
+    os.write(write_end, pickle.dumps(result))
+    os._exit(0)
+  os.close(write_end)
+  data = []
+  while True:
+    chunk = os.read(read_end, 65536)
+    if chunk == '':
+      break
+    data.append(chunk)
+  os.close(read_end)
+  os.waitpid(pid, 0)
+  return pickle.loads(''.join(data))
+
+def traced(work):
+  #Run work() and report its memory use and time. Returns (result, report).
+  gc.collect()
+  before_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if tracemalloc is not None:
+    tracemalloc.start()
+  start = time.time()
+  result = work()
+  elapsed = time.time() - start
+  report = {'seconds': elapsed, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before_rss}
+  if tracemalloc is not None:
+    current, peak = tracemalloc.get_traced_memory()
+    report['traced_kb'] = current / 1024.0
+    report['traced_peak_kb'] = peak / 1024.0
+    report['blocks'] = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+  return result, report
+
+def measureParse(text):
+  def measure():
+    expressions, report = traced(lambda: interpreter.fullParse(text))
+    report['tree_kb'] = deepSize(expressions) / 1024.0
+    return report
+  return measure
+
+def measureRun(text, mode):
+  def measure():
+    expressions = interpreter.fullParse(text)
+    if mode == "vm":
+      code = vm.compileProgram(optimizer.optimize(expressions)[0])
+    log = []
+    interpreter.resetGlobalScope(log, state = interpreter.RunState(max_depth = 150))
+    if mode == "vm":
+      work = lambda: vm.run(code, interpreter.global_scope)
+    else:
+      work = lambda: [line.evaluate(interpreter.global_scope) for line in expressions]
+    result, report = traced(work)
+    report['log'] = log
+    return report
+  return measure
+
+def show(name, report):
+  if 'error' in report:
+    print '%-28s failed: %s' % (name, report['error'])
+    return
+  columns = '%-28s %9.3f %12d' % (name, report['seconds'], report['peak_rss_kb'])
+  columns += ' %10.1f' % report['tree_kb'] if 'tree_kb' in report else ' %10s' % '-'
+  if 'traced_peak_kb' in report:
+    columns += ' %12.1f %10d' % (report['traced_peak_kb'], report['blocks'])
+  print columns
+
+if __name__ == '__main__':
+  lines = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  chunks = max(1, lines / len(CHUNK.strip().split('\n')))
+  program = ''.join(CHUNK % {'i': i} for i in range(chunks))
+  print 'tracemalloc %s' % ('available' if tracemalloc is not None else 'not available; using object sizes and peak RSS')
+  tree_frame = interpreter.Stack(None)
+  tree_frame.set('x', 1)
+  tree_frame.set('y', 2)
+  vm_frame = interpreter.Stack(None, slots = [1, 2], layout = {'x': 0, 'y': 1})
+  print 'call frame bytes: %d (tree), %d (vm)' % (frameSize(tree_frame), frameSize(vm_frame))
+  header = '%-28s %9s %12s %10s' % ('measurement', 'seconds', 'peak RSS KB', 'tree KB')
+  if tracemalloc is not None:
+    header += ' %12s %10s' % ('traced peak', 'blocks')
+  print header
+  show('parse %d lines' % len(program.strip().split('\n')), inChild(measureParse(program)))
+  for name in sorted(RUNS):
+    logs = []
+    for mode in ['tree', 'vm']:
+      report = inChild(measureRun(RUNS[name], mode))
+      show('%s (%s)' % (name, mode), report)
+      logs.append(report.get('log'))
+    if logs[0] != logs[1]:
+      print '%-28s results differ: %r != %r' % (name, logs[0], logs[1])
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# What recording metrics costs: a histogram observation and a counter
+# increment on their own, and a call to the simulated robot through a
+# LazyProxy, which times every call, against calling the module directly.
+# Usage: python benchmarks/bench_metrics.py [calls]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import robot
+import metrics
+import simulator
+
+def perCall(work, calls):
+  #Microseconds each call to work takes, at best over three runs.
+  fastest = None
+  for repeat in range(3):
+    start = time.time()
+    for index in xrange(calls):
+      work()
+    elapsed = (time.time() - start) * 1000000 / calls
+    fastest = elapsed if fastest is None else min(fastest, elapsed)
+  return fastest
+
+if __name__ == '__main__':
+  calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  robot.configure('simulator', time_scale = 0)
+  histogram = metrics.Histogram("bench_seconds", "Benchmark observations", ("module", "method"))
+  counter = metrics.Counter("bench_total", "Benchmark increments", ("module", "method"))
+  proxy = robot.LazyProxy("ALMemory")
+  direct = robot.backend().proxy("ALMemory")
+  print '%-24s %10s' % ('operation', 'us/call')
+  print '%-24s %10.2f' % ('histogram observe', perCall(lambda: histogram.observe(0.003, "ALMemory", "getData"), calls))
+  print '%-24s %10.2f' % ('counter inc', perCall(lambda: counter.inc("ALMemory", "getData"), calls))
+  print '%-24s %10.2f' % ('direct robot call', perCall(lambda: direct.getData(simulator.SONAR_LEFT), calls))
+  print '%-24s %10.2f' % ('timed robot call', perCall(lambda: proxy.getData(simulator.SONAR_LEFT), calls))
+  print '%-24s %10.2f' % ('metrics text', perCall(metrics.registry.text, max(1, calls / 1000)))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Check parseExpression against the original TreeNode parser on random
+# well-formed lines, then compare how long each takes to parse them.
+# Usage: python benchmarks/bench_parser.py [lines]
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import interpreter
+import lexer
+
+NAMES = ['x', 'y', 'count', 'say', 'not', 'fib']
+OPERATORS = ['and', 'or', 'is', '==', '>', '<', '+', '-', 'mod', '*', '/']
+
+class Generator:
+  # Random lines from the subset of the grammar both parsers agree on.
+  # The TreeNode parser attached a comma to a call that a parenthesis had
+  # already closed, as in "f (g a), b", and turned a "(" straight after a
+  # comma into a variable named "(". So parenthesised calls only appear in
+  # the last argument of a call, and only the first argument can start with "(".
+
+  def __init__(self, seed):
+    self.random = random.Random(seed)
+
+  def value(self):
+    choice = self.random.randint(0, 2)
+    if choice == 0:
+      return str(self.random.randint(0, 99))
+    elif choice == 1:
+      return '"%s"' % self.random.choice(['hi', 'a b', ''])
+    return self.random.choice(NAMES)
+
+  def expression(self, depth, calls = True, parenthesised = True):
+    terms = [self.term(depth, calls) for i in range(self.random.randint(1, 3))]
+    if not parenthesised:
+      terms[0] = self.value()
+    text = terms[0]
+    for term in terms[1:]:
+      text += ' %s %s' % (self.random.choice(OPERATORS), term)
+    if calls and depth > 0 and self.random.random() < 0.3:
+      # A call swallows the rest of the line, so it can only come last.
+      text += ' %s %s' % (self.random.choice(OPERATORS), self.call(depth - 1))
+    return text
+
+  def term(self, depth, calls):
+    if depth > 0 and self.random.random() < 0.3:
+      return '(%s)' % self.expression(depth - 1, calls)
+    return self.value()
+
+  def call(self, depth):
+    count = self.random.randint(1, 3)
+    args = [self.expression(depth, calls = count == 1)]
+    args += [self.expression(depth, calls = False, parenthesised = False) for i in range(count - 2)]
+    if count > 1:
+      args.append(self.expression(depth, parenthesised = False))
+    if self.random.random() < 0.3:
+      return '%s (%s)' % (self.random.choice(NAMES), ', '.join(args))
+    return '%s %s' % (self.random.choice(NAMES), ', '.join(args))
+
+  def line(self):
+    if self.random.random() < 0.5:
+      text = self.call(3)
+    else:
+      text = self.expression(3)
+    if self.random.random() < 0.2:
+      text = '%s = %s' % (self.random.choice(NAMES), text)
+    return text
+
+def legacyParse(tokens):
+  return interpreter.expressionize(interpreter.legacyParseTokens(tokens).children[0])
+
+def checkEquivalence(lines):
+  for line in lines:
+    tokens = lexer.tokenTexts(line)
+    expected = repr(legacyParse(tokens))
+    actual = repr(interpreter.parseExpression(tokens))
+    if expected != actual:
+      print 'MISMATCH on %r:\n  legacy %s\n  pratt  %s' % (line, expected, actual)
+      return False
+  print 'parseExpression matches the TreeNode parser on %d lines' % len(lines)
+  return True
+
+def timeParser(parser, token_lists):
+  start = time.time()
+  for tokens in token_lists:
+    parser(tokens)
+  return time.time() - start
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  generator = Generator(0)
+  lines = [generator.line() for i in range(count)]
+  if not checkEquivalence(lines):
+    sys.exit(1)
+  token_lists = [lexer.tokenTexts(line) for line in lines]
+  tokens = sum(len(token_list) for token_list in token_lists)
+  legacy_time = timeParser(legacyParse, token_lists)
+  pratt_time = timeParser(interpreter.parseExpression, token_lists)
+  print '%-16s %14s' % ('parser', 'tokens/s')
+  print '%-16s %14.0f' % ('TreeNode', tokens / legacy_time)
+  print '%-16s %14.0f' % ('parseExpression', tokens / pratt_time)
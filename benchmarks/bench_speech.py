@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Speech with and without the speech cache, on the simulated robot: how long
+# after `say` is called the robot starts talking (time to first audio), and
+# how long a program that repeats a few phrases takes. Synthesis and
+# playback take simulated time, scaled by time_scale.
+# Usage: python benchmarks/bench_speech.py [time scale]
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import robot
+import interpreter
+import parsecache
+import vm
+
+PROGRAM = """
+i = 0
+while i < 8
+  say "hello"
+  say "turn left"
+  say "step " + i
+  i = i + 1
+say "done"
+"""
+
+def run(program, cache):
+  #Run program and return (seconds, time to first audio of each say in seconds, share of says already on disk).
+  hits, misses = cache.hits, cache.misses
+  simulated = robot.backend().state
+  calls = []
+  say = cache.say
+  def timed(text):
+    calls.append(time.time())
+    return say(text)
+  cache.say = timed
+  first = len(simulated.spoken_at)
+  session = interpreter.Session().start()
+  start = time.time()
+  try:
+    with session:
+      vm.runInSession(program.code, session)
+      session.finishMotion()
+  finally:
+    del cache.say
+  elapsed = time.time() - start
+  hits, misses = cache.hits - hits, cache.misses - misses
+  return elapsed, [heard - called for called, heard in zip(calls, simulated.spoken_at[first:])], hits / float(hits + misses) if hits + misses > 0 else None
+
+def show(name, elapsed, delays, hit_rate):
+  delays = sorted(delays)
+  columns = '%-22s %10.2f %10.0f %10.0f %10.0f' % (name, elapsed, sum(delays) / len(delays) * 1000, delays[len(delays) / 2] * 1000, delays[-1] * 1000)
+  print columns + (' %9.0f%%' % (hit_rate * 100) if hit_rate is not None else '')
+
+if __name__ == '__main__':
+  time_scale = float(sys.argv[1]) if len(sys.argv) > 1 else 0.25
+  robot.configure('simulator', time_scale = time_scale)
+  program = parsecache.ParseCache().get(PROGRAM)
+  cache = interpreter.speech_cache
+  directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+  try:
+    print 'time scale %g; %d phrases said as constants' % (time_scale, len(program.phrases))
+    print '%-22s %10s %10s %10s %10s %10s' % ('speech', 'seconds', 'mean ms', 'p50 ms', 'max ms', 'hit rate')
+    show('synthesised each time', *run(program, cache))
+
+    cache.open(directories[0])
+    show('cached, first run', *run(program, cache))
+
+    # As the server does when a job starts: the constant phrases render while the program starts
+    cache.open(directories[1])
+    cache.warm(program.phrases)
+    show('cached and warmed', *run(program, cache))
+    show('cached, second run', *run(program, cache))
+    print 'cache: %(entries)d files, %(bytes)d bytes, %(warmed)d rendered ahead of time' % cache.stats()
+  finally:
+    for directory in directories:
+      shutil.rmtree(directory)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Per-request storage latency with many saved programs: the old
+# read-modify-write of programs.json, the SQLite ProgramStore, and the
+# in-memory ProgramCatalog in front of it that the server uses.
+# Usage: python benchmarks/bench_store.py [programs] [requests]
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import store
+
+USERS = 100
+
+class JSONStore:
+  # What NaoHandler did before: load the whole file, change it, write it all back.
+
+  #Fields
+  path = None
+
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    programsfile = open(self.path)
+    contents = json.load(programsfile)
+    programsfile.close()
+    return contents
+
+  def save(self, contents):
+    wprogramsfile = open(self.path, 'w')
+    wprogramsfile.write(json.dumps(contents))
+    wprogramsfile.close()
+
+  def programs(self, username):
+    return self.load().get(username, {})
+
+  def add(self, username, name, commands):
+    contents = self.load()
+    if name in contents[username]:
+      return False
+    contents[username][name] = commands
+    self.save(contents)
+    return True
+
+  def edit(self, username, oldname, newname, commands):
+    contents = self.load()
+    if newname in contents[username] and newname != oldname:
+      return False
+    if oldname in contents[username]: del(contents[username][oldname])
+    contents[username][newname] = commands
+    self.save(contents)
+    return True
+
+  def delete(self, username, name):
+    contents = self.load()
+    if not name in contents[username]:
+      return False
+    del(contents[username][name])
+    self.save(contents)
+    return True
+
+def makePrograms(count):
+  contents = dict(('user%d' % user, {}) for user in range(USERS))
+  for index in range(count):
+    contents['user%d' % (index % USERS)]['program%d' % index] = 'i = 0\nwhile i < %d\n  walk 1\n  i = i + 1\nsay "done"' % index
+  return contents
+
+def timeRequests(backend, requests):
+  # Returns {operation: [seconds per request]}.
+  timings = {'getprograms': [], 'addprogram': [], 'editprogram': [], 'delprogram': []}
+  for index in range(requests):
+    username = 'user%d' % random.randrange(USERS)
+    name = 'new%d' % index
+    for operation, call in [
+        ('getprograms', lambda: backend.programs(username)),
+        ('addprogram', lambda: backend.add(username, name, 'say "hi"')),
+        ('editprogram', lambda: backend.edit(username, name, name + 'b', 'say "bye"')),
+        ('delprogram', lambda: backend.delete(username, name + 'b'))]:
+      start = time.time()
+      call()
+      timings[operation].append(time.time() - start)
+  return timings
+
+def report(name, timings):
+  for operation in sorted(timings):
+    ordered = sorted(timings[operation])
+    print '%-8s %-12s %9.3f %9.3f' % (name, operation, ordered[len(ordered) / 2] * 1000, ordered[min(len(ordered) - 1, len(ordered) * 99 / 100)] * 1000)
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  directory = tempfile.mkdtemp()
+  try:
+    json_path = os.path.join(directory, 'programs.json')
+    contents = makePrograms(count)
+    JSONStore(json_path).save(contents)
+
+    start = time.time()
+    program_store = store.ProgramStore(os.path.join(directory, 'programs.db'), json_path = json_path)
+    print 'Imported %d programs in %.2fs' % (program_store.count(), time.time() - start)
+    for username in contents:
+      if program_store.programs(username) != contents[username]:
+        print 'Imported programs differ for %s' % username
+
+    print '%-8s %-12s %9s %9s' % ('store', 'request', 'p50 ms', 'p99 ms')
+    report('json', timeRequests(JSONStore(json_path), requests))
+    report('sqlite', timeRequests(program_store, requests))
+    catalog = store.ProgramCatalog(program_store)
+    report('catalog', timeRequests(catalog, requests))
+    catalog.flush()
+    print 'catalog wrote %d changes in %d flushes for %d requests' % (catalog.writes, catalog.flushes, requests * 3)
+    program_store.close()
+  finally:
+    shutil.rmtree(directory)
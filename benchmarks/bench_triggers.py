@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Reacting to a sensor with a `when` block against polling for it in a while
+# loop: how much CPU each takes while waiting, and how long after the robot
+# gets near a wall each notices. The simulated robot starts in the middle of
+# the room and, at a random moment, is moved close to a wall; the run is
+# cancelled as soon as the program prints "near".
+# Usage: python benchmarks/bench_triggers.py [trials]
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import robot
+import interpreter
+import optimizer
+import vm
+
+PROGRAMS = {
+  "polling loop": """
+while (distance "left") > 1
+  checks = 0
+print "near"
+""",
+  "when": """
+when (distance "left") < 1
+  print "near"
+""",
+}
+
+class Log(list):
+  # Notes when the first line is printed.
+  def __init__(self):
+    list.__init__(self)
+    self.printed = threading.Event()
+    self.printed_at = None
+
+  def append(self, line):
+    if self.printed_at is None:
+      self.printed_at = time.time()
+    list.append(self, line)
+    self.printed.set()
+
+def trial(text, mode, delay):
+  #Run text until it prints, moving the robot towards the wall after delay seconds.
+  #Returns (seconds from the move to the print, CPU seconds used, wall seconds).
+  simulated = robot.backend().state
+  simulated.x, simulated.y, simulated.theta = 0.0, 0.0, 0.0
+  interpreter.sensor_cache.invalidate() # Forget the last trial's readings
+  log = Log()
+  session = interpreter.Session(log = log, limits = {'max_seconds': delay + 10})
+  session.start(log = log)
+  expressions = interpreter.fullParse(text)
+  code = vm.compileProgram(optimizer.optimize(expressions)[0])
+  def work():
+    with session:
+      try:
+        if mode == "vm":
+          vm.runInSession(code, session)
+        else:
+          session.evaluate(expressions)
+      except interpreter.Cancelled:
+        pass
+  runner = threading.Thread(target = work)
+  start_cpu = sum(os.times()[:2])
+  start = time.time()
+  runner.start()
+  time.sleep(delay)
+  moved_at = time.time()
+  simulated.move(1.5, 0, 0)
+  log.printed.wait(10)
+  session.state.cancel()
+  runner.join()
+  cpu = sum(os.times()[:2]) - start_cpu
+  latency = log.printed_at - moved_at if log.printed_at is not None else None
+  return latency, cpu, time.time() - start
+
+if __name__ == '__main__':
+  trials = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  robot.configure('simulator', time_scale = 0)
+  random.seed(0)
+  print '%-14s %-5s %14s %14s %10s' % ('program', 'mode', 'latency ms', 'max ms', 'CPU %')
+  for name in sorted(PROGRAMS):
+    for mode in ['tree', 'vm']:
+      latencies = []
+      cpu = 0.0
+      wall = 0.0
+      for index in range(trials):
+        latency, used, elapsed = trial(PROGRAMS[name], mode, random.uniform(0.5, 1.5))
+        if latency is None:
+          print '%-14s %-5s never noticed the wall' % (name, mode)
+          break
+        latencies.append(latency * 1000)
+        cpu += used
+        wall += elapsed
+      else:
+        print '%-14s %-5s %14.1f %14.1f %10.1f' % (name, mode, sum(latencies) / len(latencies), max(latencies), cpu * 100 / wall)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Compare the optimized bytecode VM against the Expression tree walker on
+# loop-heavy and recursive NaoScript.
+# Usage: python benchmarks/bench_vm.py [iterations]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import interpreter
+import vm
+import optimizer
+
+PROGRAMS = {
+  "counting loop": """
+i = 0
+while i < %(n)d
+  i = i + 1
+""",
+  "arithmetic loop": """
+i = 0
+total = 0
+while i < %(n)d
+  total = total + (i * 3 mod 7) - 1
+  i = i + 1
+""",
+  "conditional loop": """
+i = 0
+evens = 0
+while i < %(n)d
+  if i mod 2 is 0
+    evens = evens + 1
+  else
+    evens = evens - 0
+  i = i + 1
+""",
+  "function call loop": """
+function step takes x
+  return x + 1
+i = 0
+while i < %(n)d
+  i = step i
+""",
+  "factorial": """
+function fact takes n
+  if n < 2
+    return 1
+  else
+    return n * fact (n - 1)
+i = 0
+while i < %(n)d / 20
+  result = fact 20
+  i = i + 1
+print result
+""",
+  "fibonacci": """
+function fib takes n
+  if n < 2
+    return n
+  else
+    return (fib (n - 1)) + (fib (n - 2))
+print fib (%(n)d / 2000 + 10)
+""",
+  "nested scopes": """
+function outer takes a
+  function middle takes b
+    function inner takes c
+      return a + b + c
+    return inner b
+  return middle a
+i = 0
+while i < %(n)d
+  i = i + (outer 1) - 2
+""",
+}
+
+def timeTree(expressions):
+  log = []
+  interpreter.resetGlobalScope(log)
+  start = time.time()
+  for line in expressions:
+    line.evaluate(interpreter.global_scope)
+  return time.time() - start, log
+
+def timeVM(code):
+  log = []
+  interpreter.resetGlobalScope(log)
+  start = time.time()
+  vm.run(code, interpreter.global_scope)
+  return time.time() - start, log
+
+if __name__ == '__main__':
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  print '%-20s %14s %14s %8s %11s' % ('program', 'tree iter/s', 'vm iter/s', 'speedup', 'eliminated')
+  for name in sorted(PROGRAMS):
+    expressions = interpreter.fullParse(PROGRAMS[name] % {'n': iterations})
+    optimized, report = optimizer.optimize(expressions)
+    code = vm.compileProgram(optimized)
+    tree_time, tree_log = timeTree(expressions)
+    vm_time, vm_log = timeVM(code)
+    if tree_log != vm_log:
+      print '%-20s results differ: %r != %r' % (name, tree_log, vm_log)
+    print '%-20s %14.0f %14.0f %7.2fx %11d' % (name, iterations / tree_time, iterations / vm_time, tree_time / vm_time, report.eliminated())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Load the HTTP server with concurrent clients and report per-route latency.
+# The server runs in this process against the simulated robot, so this needs
+# no Nao.
+# Usage: python benchmarks/load_test.py [clients] [requests per client] [workers] [queue limit]
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import httplib
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#Simulated actions take this fraction of the time they would on the robot
+TIME_SCALE = 0.05
+
+PROGRAMS = [
+  'print 1 + 2',
+  'i = 0\nwhile i < 200\n  i = i + 1\nprint i',
+  'say "hello"\nprint distance "left"',
+  'walk 1\nturn 90',
+]
+
+def request(port, method, path, body = None):
+  connection = httplib.HTTPConnection('127.0.0.1', port, timeout = 60)
+  headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body is not None else {}
+  start = time.time()
+  try:
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    response.read()
+    status = response.status
+  except Exception:
+    status = 0
+  connection.close()
+  return status, time.time() - start
+
+def client(port, count, results, lock):
+  for index in range(count):
+    choice = random.random()
+    if choice < 0.3:
+      route, status_time = 'GET /', request(port, 'GET', '/')
+    elif choice < 0.6:
+      route, status_time = 'GET /getprograms', request(port, 'GET', '/getprograms?username=load')
+    elif choice < 0.7:
+      route, status_time = 'GET /cachestats', request(port, 'GET', '/cachestats')
+    elif choice < 0.95: # The page queues programs and streams them; a few scripts still block on ?wait
+      route, status_time = 'POST /code', request(port, 'POST', '/code', urllib.urlencode({'code': random.choice(PROGRAMS)}))
+    else:
+      route, status_time = 'POST /code?wait', request(port, 'POST', '/code?wait=1', urllib.urlencode({'code': random.choice(PROGRAMS)}))
+    with lock:
+      results.append((route,) + status_time)
+
+def startServer(workers = 16, queue_limit = 64, time_scale = TIME_SCALE):
+  #Start the server on a free port in a scratch directory, against the simulated
+  #robot. Returns (server, port, directory); pass them to stopServer.
+  import robot
+  robot.configure('simulator', time_scale = time_scale)
+  #The server reads its page from, and keeps its programs in, its working directory
+  directory = tempfile.mkdtemp()
+  for name in ['index.html', 'stylesheet.css', 'favicon.ico', 'static']:
+    source = os.path.join(ROOT, name)
+    if os.path.isdir(source):
+      shutil.copytree(source, os.path.join(directory, name))
+    elif os.path.exists(source):
+      shutil.copy(source, directory)
+  open(os.path.join(directory, 'programs.json'), 'w').write('{}')
+  os.chdir(directory)
+  import http_server
+  http_server.NaoHandler.log_message = lambda self, *args: None
+  http_server.parse_cache.path = None
+  http_server.job_runner.start()
+  httpd = http_server.PooledHTTPServer(('127.0.0.1', 0), http_server.NaoHandler, workers = workers, queue_limit = queue_limit)
+  server = threading.Thread(target = httpd.serve_forever)
+  server.daemon = True
+  server.start()
+  return httpd, httpd.server_address[1], directory
+
+def stopServer(httpd, directory):
+  httpd.shutdown()
+  os.chdir(ROOT)
+  shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+  per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+  workers = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+  queue_limit = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+
+  httpd, port, directory = startServer(workers, queue_limit)
+  import http_server
+
+  results = []
+  lock = threading.Lock()
+  threads = [threading.Thread(target = client, args = (port, per_client, results, lock)) for index in range(clients)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  stopServer(httpd, directory)
+
+  print '%d clients x %d requests, %d workers, queue limit %d: %.0f requests/s' % (clients, per_client, workers, queue_limit, len(results) / elapsed)
+  print '%-18s %7s %7s %7s %9s %9s' % ('route', 'ok', '503', 'failed', 'p50 ms', 'p99 ms')
+  for route in sorted(set(result[0] for result in results)):
+    timings = sorted(seconds for name, status, seconds in results if name == route)
+    statuses = [status for name, status, seconds in results if name == route]
+    print '%-18s %7d %7d %7d %9.1f %9.1f' % (route, statuses.count(200), statuses.count(503), len(statuses) - statuses.count(200) - statuses.count(503),
+      http_server.percentile(timings, 50) * 1000, http_server.percentile(timings, 99) * 1000)
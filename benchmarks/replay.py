@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Replay a session recorded with `http_server.py --record TRACE`: the server
+# runs in this process with the same settings, every robot call is answered
+# from the trace, and the /code submissions and the cancels of their jobs
+# are sent again at the moments they were recorded. Prints how long each job
+# took then and now, so a slow classroom session can be timed again,
+# repeatably, with no robot attached. --speed 1 replays in real time, 10 ten
+# times faster (the recorded time limits shrink to match), and 0 as fast as
+# the server goes, with no waiting on robot calls or between submissions.
+# Usage: python benchmarks/replay.py TRACE [--speed S] [--workers N]
+import os
+import sys
+import time
+import argparse
+import threading
+import httplib
+import urllib
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import load_test
+import robot
+import recording
+import interpreter
+
+# Seconds a cancel waits for the submission of its job to be answered
+CANCEL_TIMEOUT = 30
+
+class JobIds:
+  # Recorded job id -> the id its submission got this time, for sending the job's cancels.
+
+  #Fields
+  ids = None
+  condition = None
+
+  def __init__(self):
+    self.ids = {}
+    self.condition = threading.Condition()
+
+  def add(self, recorded, replayed):
+    with self.condition:
+      self.ids[recorded] = replayed
+      self.condition.notify_all()
+
+  def get(self, recorded, timeout):
+    #The replayed id, waiting up to timeout seconds for it; None if it doesn't come.
+    deadline = time.time() + timeout
+    with self.condition:
+      while recorded not in self.ids and time.time() < deadline:
+        self.condition.wait(deadline - time.time())
+      return self.ids.get(recorded)
+
+def submit(port, entry, ids):
+  #Send a recorded submission and wait for its job; return (status, seconds from sending to finishing).
+  query = {'mode': entry['mode']}
+  if entry.get('session') is not None:
+    query['session'] = entry['session']
+  if entry.get('profile'):
+    query['profile'] = '1'
+  if entry.get('wait'):
+    query['wait'] = '1'
+  start = time.time()
+  connection = httplib.HTTPConnection('127.0.0.1', port, timeout = 3600)
+  connection.request('POST', '/code?' + urllib.urlencode(query), urllib.urlencode({'code': entry['code']}), {'Content-Type': 'application/x-www-form-urlencoded'})
+  reply = json.loads(connection.getresponse().read())
+  if not entry.get('wait'):
+    ids.add(entry['job'], reply['job'])
+    connection.request('GET', '/jobs/%s/stream' % reply['job'])
+    connection.getresponse().read()
+    connection.request('GET', '/jobs/%s' % reply['job'])
+    reply = json.loads(connection.getresponse().read())
+  connection.close()
+  return reply.get('status'), time.time() - start
+
+def cancel(port, job):
+  #Cancel a job; return whether the server had it.
+  connection = httplib.HTTPConnection('127.0.0.1', port, timeout = 60)
+  connection.request('POST', '/jobs/%s/cancel' % job, '')
+  reply = json.loads(connection.getresponse().read())
+  connection.close()
+  return reply.get('success', False)
+
+def replay(port, entries, cancels, speed):
+  #Send every submission and cancel at its recorded moment divided by speed. Returns
+  #([(status, seconds)] in the order of entries, how many cancels reached their job).
+  #Only jobs submitted without wait can be cancelled, as the editor only learns their ids.
+  results = [None] * len(entries)
+  ids = JobIds()
+  cancellable = set(entry['job'] for entry in entries if not entry.get('wait'))
+  cancelled = []
+  def send(index):
+    results[index] = submit(port, entries[index], ids)
+  def stop(index):
+    recorded = cancels[index]['cancel']
+    job = ids.get(recorded, CANCEL_TIMEOUT) if recorded in cancellable else None
+    if job is not None and cancel(port, job):
+      cancelled.append(recorded)
+  # A submission comes before a cancel recorded at the same moment
+  events = sorted([(entry['t'], 0, index) for index, entry in enumerate(entries)] + [(entry['t'], 1, index) for index, entry in enumerate(cancels)])
+  threads = []
+  start = time.time()
+  first = events[0][0] if len(events) > 0 else 0.0
+  for t, kind, index in events:
+    if speed > 0:
+      delay = start + (t - first) / speed - time.time()
+      if delay > 0:
+        time.sleep(delay)
+    thread = threading.Thread(target = send if kind == 0 else stop, args = (index,))
+    thread.start()
+    threads.append(thread)
+    if speed == 0:
+      # As fast as possible, but still in the recorded order
+      time.sleep(0.001)
+  for thread in threads:
+    thread.join()
+  return results, len(cancelled)
+
+def formatSeconds(seconds):
+  return '%10.3f' % seconds if seconds is not None else '%10s' % '-'
+
+if __name__ == '__main__':
+  arguments = argparse.ArgumentParser(description = 'Replay a recorded session against the server, answering robot calls from the trace.')
+  arguments.add_argument('trace')
+  arguments.add_argument('--speed', type = float, default = 1.0, help = 'how many times faster than recorded to go; 0 for no waiting at all')
+  arguments.add_argument('--workers', type = int, default = 16)
+  options = arguments.parse_args()
+
+  header, entries = recording.load(options.trace)
+  settings = header['options']
+  cancels = recording.cancels(entries)
+  entries = recording.submissions(entries)
+  httpd, port, directory = load_test.startServer(options.workers)
+  import http_server
+  replaying = robot.configure('replay', trace = os.path.abspath(options.trace), time_scale = 1.0 / options.speed if options.speed > 0 else 0)
+  if 'limits' in settings:
+    limits = dict(settings['limits'])
+    if options.speed > 0:
+      # Time limits go by the replay's clock, which runs speed times faster than the recording's
+      for name in ('max_seconds', 'max_listen'):
+        if limits.get(name) is not None:
+          limits[name] = limits[name] / options.speed
+    http_server.job_runner.limits = limits
+  interpreter.sensor_cache.max_age = settings.get('sensor_max_age', interpreter.sensor_cache.max_age)
+  if settings.get('sensor_poll') is not None:
+    interpreter.sensor_cache.startPoller(settings['sensor_poll'])
+  if settings.get('speech_cache'):
+    interpreter.speech_cache.open(os.path.join(directory, 'speechcache'), int(settings.get('speech_cache_mb', 50) * 1024 * 1024))
+
+  start = time.time()
+  results, cancelled = replay(port, entries, cancels, options.speed)
+  elapsed = time.time() - start
+  load_test.stopServer(httpd, directory)
+
+  print '%-6s %-5s %6s %-10s %-10s %10s %10s' % ('job', 'mode', 'lines', 'recorded', 'replayed', 'then s', 'now s')
+  for entry, (status, seconds) in zip(entries, results):
+    print '%-6s %-5s %6d %-10s %-10s %s %s' % (entry['job'], entry['mode'], len(entry['code'].split('\n')), entry['status'] or '-', status,
+      formatSeconds(entry['seconds']), formatSeconds(seconds))
+  recorded = sum(entry['seconds'] for entry in entries if entry['seconds'] is not None)
+  print '%d submissions replayed in %.3fs (%.3fs of jobs when recorded, %.3fs now)' % (len(entries), elapsed, recorded, sum(seconds for status, seconds in results))
+  print '%d of %d cancels replayed' % (cancelled, len(cancels))
+  print 'robot calls: %s' % json.dumps(replaying.stats(), sort_keys = True)
+  if any(status != entry['status'] for entry, (status, seconds) in zip(entries, results) if entry['status'] is not None):
+    print 'Some jobs finished differently than when they were recorded'
+    sys.exit(1)
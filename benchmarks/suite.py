@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# The benchmark suite. Parses, compiles and runs a corpus of NaoScript
+# programs with both evaluators, then puts every server route under load
+# from concurrent clients. The simulated robot stands in for naoqi
+# throughout, with actions taking no time.
+#
+# Results are written as JSON. Given the results of an earlier run, any
+# measurement that has slowed down by more than the threshold is reported
+# and the exit status is 1, so a change can be checked against its parent:
+#   python benchmarks/suite.py --output before.json
+#   (make the change)
+#   python benchmarks/suite.py --compare before.json
+import os
+import sys
+import time
+import random
+import platform
+import argparse
+import threading
+import subprocess
+import urllib
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import robot
+import interpreter
+import optimizer
+import vm
+import bench_memory
+import load_test
+
+# Measurements smaller than this many milliseconds are too noisy to flag.
+NOISE_MS = 1.0
+
+CORPUS = {
+  "arithmetic loop": """
+i = 0
+total = 0
+while i < 5000
+  total = total + (i * 3 mod 7) - 1
+  i = i + 1
+print total
+""",
+  "recursion": """
+function fib takes n
+  if n < 2
+    return n
+  else
+    return (fib (n - 1)) + (fib (n - 2))
+function sum takes n
+  if n < 1
+    return 0
+  else
+    return n + (sum (n - 1))
+print fib 16
+print sum 140
+""",
+  "string building": """
+text = ""
+i = 0
+while i < 2000
+  if i mod 2 is 0
+    text = text + "a"
+  else
+    text = text + i
+  i = i + 1
+print text
+""",
+  "sensor polling": """
+i = 0
+near = 0
+while i < 300
+  if (distance "left") < 1
+    near = near + 1
+  dark = brightness
+  i = i + 1
+print near
+""",
+  "robot script": """
+i = 0
+while i < 20
+  walk 1
+  turn 90
+  say "step"
+  i = i + 1
+sit
+stand
+finish
+""",
+}
+
+def straightLine(lines):
+  # A long script with no loops, like a student's first programs.
+  text = []
+  for index in range(lines / 3):
+    text.append('x%d = %d + (%d * 2)' % (index, index, index))
+    text.append('if x%d > %d' % (index, index * 2))
+    text.append('  print "x%d is " + x%d' % (index, index))
+  return '\n'.join(text)
+
+def best(work, repeat):
+  #The fastest of repeat runs of work(), in milliseconds, and its last result.
+  fastest = None
+  for index in range(repeat):
+    start = time.time()
+    result = work()
+    elapsed = (time.time() - start) * 1000
+    fastest = elapsed if fastest is None else min(fastest, elapsed)
+  return fastest, result
+
+def evaluate(program):
+  #Run parsed Expressions or compiled Code on a fresh session, waiting for the robot; returns what it printed.
+  log = []
+  session = interpreter.Session(log = log, limits = {'max_seconds': 60})
+  session.start(log = log)
+  with session:
+    if isinstance(program, vm.Code):
+      vm.runInSession(program, session)
+    else:
+      session.evaluate(program)
+    session.finishMotion()
+  return log
+
+def measureProgram(text, repeat):
+  def measure():
+    # Memory first: peak RSS only ever goes up, so once the timing runs have
+    # reached theirs, a run measured after them shows no growth at all.
+    result, memory = bench_memory.traced(lambda: evaluate(vm.compileProgram(optimizer.optimize(interpreter.fullParse(text))[0])))
+    parse_ms, expressions = best(lambda: interpreter.fullParse(text), repeat)
+    compile_ms, code = best(lambda: vm.compileProgram(optimizer.optimize(expressions)[0]), repeat)
+    tree_ms, tree_log = best(lambda: evaluate(expressions), repeat)
+    vm_ms, vm_log = best(lambda: evaluate(code), repeat)
+    report = {
+      'lines': len(text.strip().split('\n')),
+      'parse_ms': parse_ms,
+      'compile_ms': compile_ms,
+      'tree_ms': tree_ms,
+      'vm_ms': vm_ms,
+      'tree_kb': bench_memory.deepSize(expressions) / 1024.0,
+      'peak_rss_kb': memory['peak_rss_kb'],
+      'agree': tree_log == vm_log,
+    }
+    if 'traced_peak_kb' in memory:
+      report['traced_peak_kb'] = memory['traced_peak_kb']
+    return report
+  return measure
+
+def routes(port):
+  # Route name -> function making one request and returning (status, seconds).
+  # Job 1, for the /jobs routes
+  load_test.request(port, 'POST', '/code?wait=1', urllib.urlencode({'code': 'print 1'}))
+  counter = iter(xrange(10 ** 9))
+  lock = threading.Lock()
+  def unique():
+    with lock:
+      return counter.next()
+  def program(**fields):
+    fields.setdefault('username', 'suite')
+    return urllib.urlencode({'data': json.dumps(fields)})
+  def add():
+    return load_test.request(port, 'POST', '/addprogram', program(name = 'p%d' % unique(), commands = 'say "hi"'))
+  def edit():
+    name = 'e%d' % unique()
+    load_test.request(port, 'POST', '/addprogram', program(name = name, commands = 'say "hi"'))
+    return load_test.request(port, 'POST', '/editprogram', program(oldname = name, newname = name + 'b', commands = 'say "bye"'))
+  def delete():
+    name = 'd%d' % unique()
+    load_test.request(port, 'POST', '/addprogram', program(name = name, commands = 'say "hi"'))
+    return load_test.request(port, 'POST', '/delprogram', program(name = name))
+  def code(query, text):
+    return lambda: load_test.request(port, 'POST', '/code' + query, urllib.urlencode({'code': text}))
+  def get(path):
+    return lambda: load_test.request(port, 'GET', path)
+  return {
+    'GET /': get('/'),
+    'GET /stylesheet.css': get('/stylesheet.css'),
+    'GET /static/jquery.min.js': get('/static/jquery.min.js'),
+    'GET /getprograms': get('/getprograms?username=suite'),
+    'GET /cachestats': get('/cachestats'),
+    'GET /sensorstats': get('/sensorstats'),
+    'GET /speechstats': get('/speechstats'),
+    'GET /latency': get('/latency'),
+    'GET /metrics': get('/metrics'),
+    'GET /jobs/<id>': get('/jobs/1'),
+    'GET /jobs/<id>/stream': get('/jobs/1/stream'),
+    'POST /code': code('', 'print 1 + 2'),
+    'POST /code?wait': code('?wait=1', 'i = 0\nwhile i < 200\n  i = i + 1\nprint i'),
+    'POST /code?profile': code('?wait=1&profile=1', 'say "hello"\nprint distance "left"'),
+    'POST /code?session': code('?wait=1&session=suite', 'x = 1'),
+    'POST /check': lambda: load_test.request(port, 'POST', '/check?session=suite', urllib.urlencode({'code': straightLine(300) + '\nx%d = (' % unique()})),
+    'POST /sessions/<name>/reset': lambda: load_test.request(port, 'POST', '/sessions/suite/reset', ''),
+    'POST /jobs/<id>/cancel': lambda: load_test.request(port, 'POST', '/jobs/1/cancel', ''),
+    'POST /addprogram': add,
+    'POST /editprogram': edit,
+    'POST /delprogram': delete,
+  }
+
+def loadRoute(call, clients, requests):
+  results = []
+  lock = threading.Lock()
+  def client():
+    for index in range(requests):
+      status, seconds = call()
+      with lock:
+        results.append((status, seconds))
+  threads = [threading.Thread(target = client) for index in range(clients)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  timings = sorted(seconds for status, seconds in results)
+  return {
+    'requests': len(results),
+    'ok': len([status for status, seconds in results if status == 200]),
+    'requests_per_s': len(results) / elapsed,
+    'p50_ms': timings[len(timings) / 2] * 1000,
+    'p99_ms': timings[min(len(timings) - 1, len(timings) * 99 / 100)] * 1000,
+  }
+
+def measureHTTP(clients, requests):
+  httpd, port, directory = load_test.startServer(time_scale = 0)
+  try:
+    results = {}
+    calls = routes(port)
+    for name in sorted(calls):
+      results[name] = loadRoute(calls[name], clients, requests)
+    return results
+  finally:
+    load_test.stopServer(httpd, directory)
+
+def gitRevision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = load_test.ROOT, stderr = open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+# Measurements where bigger is worse, and their units.
+COMPARED = [('programs', 'parse_ms'), ('programs', 'compile_ms'), ('programs', 'tree_ms'), ('programs', 'vm_ms'), ('programs', 'tree_kb'),
+  ('http', 'p50_ms'), ('http', 'p99_ms')]
+
+def regressions(old, new, threshold):
+  #Every measurement more than threshold (a fraction) worse than before, as (what, old, new).
+  found = []
+  for section, metric in COMPARED:
+    for name in sorted(new.get(section, {})):
+      if name not in old.get(section, {}) or metric not in old[section][name]:
+        continue
+      before = old[section][name][metric]
+      after = new[section][name][metric]
+      if metric.endswith('_ms') and after - before < NOISE_MS:
+        continue
+      if after > before * (1 + threshold):
+        found.append(('%s %s' % (name, metric), before, after))
+  return found
+
+if __name__ == '__main__':
+  arguments = argparse.ArgumentParser(description = 'Benchmark the parser, both evaluators and the HTTP routes.')
+  arguments.add_argument('--output', default = 'benchmark-results.json', help = 'where to write the results')
+  arguments.add_argument('--compare', default = None, help = 'an earlier results file to flag regressions against')
+  arguments.add_argument('--threshold', type = float, default = 0.25, help = 'how much slower (as a fraction) counts as a regression')
+  arguments.add_argument('--repeat', type = int, default = 5, help = 'runs of each program; the fastest counts')
+  arguments.add_argument('--lines', type = int, default = 3000, help = 'length of the straight-line script')
+  arguments.add_argument('--clients', type = int, default = 8, help = 'concurrent clients per route')
+  arguments.add_argument('--requests', type = int, default = 10, help = 'requests per client per route')
+  arguments.add_argument('--skip-http', action = 'store_true')
+  options = arguments.parse_args()
+  output = os.path.abspath(options.output)
+  random.seed(0)
+
+  robot.configure('simulator', time_scale = 0)
+  corpus = dict(CORPUS)
+  corpus['straight line'] = straightLine(options.lines)
+  results = {
+    'meta': {'time': time.time(), 'revision': gitRevision(), 'python': platform.python_version(), 'machine': platform.node(), 'repeat': options.repeat},
+    'programs': {},
+    'http': {},
+  }
+  print '%-18s %6s %10s %10s %10s %10s %10s %12s' % ('program', 'lines', 'parse ms', 'compile ms', 'tree ms', 'vm ms', 'tree KB', 'peak RSS KB')
+  for name in sorted(corpus):
+    # Each program runs in its own process, so memory use isn't shared between them.
+    report = bench_memory.inChild(measureProgram(corpus[name], options.repeat))
+    results['programs'][name] = report
+    if 'error' in report:
+      print '%-18s failed: %s' % (name, report['error'])
+      continue
+    print '%-18s %6d %10.2f %10.2f %10.2f %10.2f %10.1f %12d%s' % (name, report['lines'], report['parse_ms'], report['compile_ms'], report['tree_ms'], report['vm_ms'],
+      report['tree_kb'], report['peak_rss_kb'], '' if report['agree'] else '  (tree and vm output differ)')
+
+  if not options.skip_http:
+    print
+    print '%-28s %8s %6s %10s %9s %9s' % ('route', 'requests', 'ok', 'req/s', 'p50 ms', 'p99 ms')
+    results['http'] = measureHTTP(options.clients, options.requests)
+    for name in sorted(results['http']):
+      report = results['http'][name]
+      print '%-28s %8d %6d %10.0f %9.1f %9.1f' % (name, report['requests'], report['ok'], report['requests_per_s'], report['p50_ms'], report['p99_ms'])
+
+  results_file = open(output, 'w')
+  json.dump(results, results_file, indent = 2, sort_keys = True)
+  results_file.close()
+  print
+  print 'Wrote %s' % output
+
+  if options.compare is not None:
+    compare_file = open(options.compare)
+    old = json.load(compare_file)
+    compare_file.close()
+    found = regressions(old, results, options.threshold)
+    print 'Compared with %s (revision %s): %d regression%s over %d%%' % (options.compare, old['meta'].get('revision'), len(found), '' if len(found) == 1 else 's', options.threshold * 100)
+    for what, before, after in found:
+      print '  %-40s %10.2f -> %10.2f' % (what, before, after)
+    if len(found) > 0:
+      sys.exit(1)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+  Syntax checking for the editor, without running anything.
+
+  A program is split into statements: a line with the more indented lines
+  under it, which are statements in their turn. A Checker remembers the
+  errors found in every statement of the last program it checked, keyed by
+  the statement's text, with line numbers counted from its first line. When
+  the editor checks again after an edit, only the statements whose text
+  changed are looked at again: the edited line, and the first line of each
+  block it is in. Everything else keeps its errors, moved to wherever it
+  now starts. Lines are parsed one at a time by interpreter.parse, and
+  lineParse checks that whatever opens a block has one.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import interpreter
+from interpreter import ParseError
+
+def indentation(line):
+  return len(line) - len(line.lstrip())
+
+def splitStatements(lines):
+  #Return (index of its first line, its lines) for each statement: a line as
+  #indented as the first one (or less) with the more indented lines under it.
+  #Blank lines between statements belong to neither.
+  statements = []
+  start = None
+  last = None # The last line of the current statement that isn't blank
+  for index, line in enumerate(lines):
+    if len(line.strip()) == 0:
+      continue
+    if start is None:
+      base = indentation(line)
+    elif indentation(line) <= base:
+      statements.append((start, lines[start:last + 1]))
+      start = None
+    if start is None:
+      start = index
+    last = index
+  if start is not None:
+    statements.append((start, lines[start:last + 1]))
+  return statements
+
+def checkHeader(line, has_block):
+  #Parse a statement's first line and return its errors, as in checkStatement.
+  try:
+    for statement in interpreter.parse([line.lstrip()], 0)[0]:
+      if not has_block:
+        # Complains about a while, if, function or when with nothing under it
+        interpreter.lineParse(statement)
+  except ParseError, e:
+    return [(1, str(e))]
+  except Exception, e:
+    # As in parsecache, anything else the parser trips over is a parse failure too.
+    return [(1, "Could not parse this: %s" % e)]
+  return []
+
+class Checker:
+  # The parse state of one editor.
+
+  #Fields
+  statements = None # Statement text -> its errors, for the statements of the last program checked
+  parsed = 0        # Lines parsed by the last check
+  reused = 0        # Statements whose errors the last check already knew
+  lock = None
+
+  def __init__(self):
+    self.statements = {}
+    self.lock = threading.Lock()
+
+  def checkStatement(self, lines, seen):
+    #Return the errors in one statement as (line, counting from 1 at its first line, message).
+    #seen collects the statements of this check.
+    key = "\n".join(lines)
+    found = seen.get(key)
+    if found is None:
+      found = self.statements.get(key)
+    if found is not None:
+      self.reused += 1
+    else:
+      self.parsed += 1
+      found = checkHeader(lines[0], len(lines) > 1)
+      for start, block in splitStatements(lines[1:]):
+        for line, message in self.checkStatement(block, seen):
+          found.append((start + 1 + line, message))
+    seen[key] = found
+    return found
+
+  def check(self, text):
+    #Return the errors in the program text as a list of {'line', 'message'}, in line order.
+    lines = text.split("\n")
+    with self.lock:
+      seen = {}
+      errors = []
+      self.parsed = 0
+      self.reused = 0
+      statements = splitStatements(lines)
+      if len(statements) > 0 and indentation(statements[0][1][0]) > 0:
+        errors.append({'line': statements[0][0] + 1, 'message': "Unexpected indentation"})
+      for start, statement in statements:
+        for line, message in self.checkStatement(statement, seen):
+          errors.append({'line': start + line, 'message': message})
+      # Only the statements of this version are kept, so memory stays in proportion to the program.
+      self.statements = seen
+      return errors
+
+class Checkers:
+  # A Checker for each editor, by the session name it sends, least recently used first.
+
+  #Fields
+  checkers = None
+  size = 64
+  lock = None
+
+  def __init__(self, size = 64):
+    self.size = size
+    self.checkers = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, name):
+    with self.lock:
+      checker = self.checkers.pop(name, None)
+      if checker is None:
+        checker = Checker()
+      self.checkers[name] = checker
+      while len(self.checkers) > self.size:
+        self.checkers.popitem(last = False)
+      return checker
+
+  def check(self, name, text):
+    #Check text for the named editor and return the reply for /check.
+    checker = self.get(name) if name is not None else Checker()
+    start = time.time()
+    errors = checker.check(text)
+    return {
+      'success': len(errors) == 0,
+      'errors': errors,
+      'parsed': checker.parsed,
+      'reused': checker.reused,
+      'ms': (time.time() - start) * 1000,
+    }
@@ -1,32 +1,341 @@
 #!/usr/bin/env python
 import BaseHTTPServer
+import Queue
+import threading
+import socket
+import time
+import argparse
+import collections
+import logging
 import urllib
 import urlparse
 import simplejson as json
 import interpreter
+import parsecache
+import store
+import static
+import jobs
+import checker
+import metrics
+import recording
 import math
 
-from naoqi import ALProxy
+import robot
 
-#Create the proxies we'll need to execute commands
-ttsproxy = ALProxy('ALTextToSpeech', 'localhost', 9559)
-walkproxy = ALProxy('ALMotion', 'localhost', 9559)
-bmproxy = ALProxy('ALBehaviorManager', 'localhost', 9559)
-netproxy = ALProxy('ALNetwork', 'localhost', 9559)
+logger = logging.getLogger("naoscript.http")
 
-'''
-#These aren't needed right now but might be in the future
+#The robot's network module, connected the first time it is used
+netproxy = robot.LazyProxy('ALNetwork')
 
-adproxy = ALProxy('ALAudioDevice', 'localhost', 9559)
+#Parsed and compiled programs, keyed by source text
+parse_cache = parsecache.ParseCache(size = 256, path = 'parsecache.pickle')
 
-'''
+#The page and its stylesheet and scripts, kept in memory
+static_files = static.StaticFiles()
+
+#Everyone's saved programs, served from memory; programs.json is imported the first time this runs
+program_store = store.ProgramCatalog(store.ProgramStore('programs.db', json_path = 'programs.json'))
+
+#Programs run one at a time in the background; /code only queues them
+job_runner = jobs.JobRunner(parse_cache, limits = {'max_steps': 100000000, 'max_seconds': 600, 'max_depth': 10000, 'max_listen': 60})
+
+#Each editor's parse state, so /check only re-parses the blocks that changed
+checkers = checker.Checkers(size = 64)
+
+request_seconds = metrics.histogram("naoscript_http_request_seconds", "Time taken to serve requests, by route", ("method", "route"))
+requests_served = metrics.counter("naoscript_http_requests_total", "Requests served, by route and status", ("method", "route", "status"))
+metrics.gauge("naoscript_jobs_queued", "Programs waiting to run", lambda: job_runner.queue.qsize())
+metrics.gauge("naoscript_sessions", "Sessions keeping variables between runs", lambda: len(job_runner.sessions))
+metrics.gauge("naoscript_parse_cache_entries", "Programs in the parse cache", lambda: parse_cache.stats()['entries'])
+
+def lookups(stats):
+  #Hit and miss counts from a cache's stats, for a counter labelled by result.
+  return {('hit',): stats['hits'], ('miss',): stats['misses']}
+
+metrics.countedBy("naoscript_parse_cache_lookups_total", "Parse cache lookups, by result", lambda: lookups(parse_cache.stats()), ("result",))
+metrics.countedBy("naoscript_speech_cache_says_total", "Says, by whether the speech was already on disk", lambda: lookups(interpreter.speech_cache.stats()), ("result",))
+metrics.countedBy("naoscript_sensor_reads_total", "Sensor reads", lambda: interpreter.sensor_cache.stats()['reads'])
+metrics.countedBy("naoscript_sensor_fetches_total", "Batches of sensor readings fetched from the robot", lambda: interpreter.sensor_cache.stats()['fetches'])
+metrics.gauge("naoscript_speech_cache_bytes", "Synthesised speech kept on disk", lambda: interpreter.speech_cache.stats()['bytes'])
+metrics.gauge("naoscript_programs", "Saved programs", lambda: program_store.stats()['programs'])
+
+def streamEvents(lines, finished, job):
+  #Server-sent events for lines a job has printed: one "data:" line per printed
+  #line, then, once it has finished, a "done" event with the job's status.
+  text = ''.join(''.join('data: %s\n' % part for part in line.split('\n')) + '\n' for line in lines)
+  if finished:
+    text += 'event: done\ndata: %s\n\n' % json.dumps(job.toDict())
+  return text
+
+class StreamHub:
+  #Writes every open /jobs/<id>/stream from one thread. Jobs run one at a time,
+  #so a classroom's streams can stay open for minutes while their jobs queue;
+  #a worker only sends a stream's headers and hands its connection over here.
+
+  #Fields
+  interval = 0.02    # Seconds between looks at the streams' jobs
+  keepalive = 15     # Seconds of silence before a comment is sent to keep the connection open
+  send_timeout = 5.0 # Seconds a client may take to accept what we send before it is dropped
+  offered = None     # Connection -> stream, for streams whose worker hasn't finished with them yet
+  streams = None     # [connection, job, lines sent, when we last sent anything]
+  condition = None
+  thread = None
+
+  def __init__(self):
+    self.offered = {}
+    self.streams = []
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target = self.work, name = "http-streams")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def offer(self, connection, job):
+    #Called by the handler once the headers are sent; the stream starts when its worker calls adopt.
+    with self.condition:
+      self.offered[connection] = [connection, job, 0, time.time()]
+
+  def adopt(self, connection):
+    #Take over a connection the handler offered. Returns False if it didn't, and the worker should close it.
+    with self.condition:
+      stream = self.offered.pop(connection, None)
+      if stream is None:
+        return False
+      connection.settimeout(self.send_timeout)
+      self.streams.append(stream)
+      self.condition.notify()
+      return True
+
+  def count(self):
+    with self.condition:
+      return len(self.streams)
+
+  def work(self):
+    while True:
+      with self.condition:
+        while len(self.streams) == 0:
+          self.condition.wait()
+        streams = list(self.streams)
+      for stream in streams:
+        if not self.send(stream):
+          with self.condition:
+            self.streams.remove(stream)
+          try:
+            stream[0].shutdown(socket.SHUT_WR)
+          except socket.error:
+            pass
+          stream[0].close()
+      time.sleep(self.interval)
+
+  def send(self, stream):
+    #Send a stream whatever its job has printed since last time. Returns False once it is over.
+    connection, job, sent, written_at = stream
+    lines, finished = job.wait(sent, timeout = 0)
+    text = streamEvents(lines, finished, job)
+    now = time.time()
+    if text == '' and now - written_at >= self.keepalive:
+      text = ': waiting\n\n'
+    try:
+      if text != '':
+        connection.sendall(text)
+        stream[2] = sent + len(lines)
+        stream[3] = now
+    except socket.error:
+      return False # The client went away
+    return not finished
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+  #Hands each accepted connection to a fixed pool of worker threads. At most
+  #queue_limit connections wait for a free worker; any more are turned away
+  #with a 503 straight from the accepting thread. Open /jobs/<id>/stream
+  #connections are handed to a StreamHub, so they don't hold workers.
+
+  #Fields
+  request_queue_size = 128 # The listen backlog; connections beyond it wait on TCP retries instead of getting a 503
+  workers = 16
+  queue_limit = 64
+  pending = None  # Connections waiting for a worker
+  rejected = 0
+  streams = None  # The StreamHub writing open job streams
+
+  def __init__(self, address, handler, workers = 16, queue_limit = 64):
+    BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+    self.workers = workers
+    self.queue_limit = queue_limit
+    self.pending = Queue.Queue(queue_limit)
+    self.rejected = 0
+    self.streams = StreamHub()
+    metrics.gauge("naoscript_http_streams", "Job streams open", self.streams.count)
+    metrics.gauge("naoscript_http_connections_queued", "Connections waiting for a worker", self.pending.qsize)
+    metrics.countedBy("naoscript_http_connections_rejected_total", "Connections turned away with a 503", lambda: self.rejected)
+    for index in range(workers):
+      worker = threading.Thread(target = self.work, name = "http-worker-%d" % index)
+      worker.daemon = True
+      worker.start()
+
+  def process_request(self, request, client_address):
+    try:
+      self.pending.put_nowait((request, client_address))
+    except Queue.Full:
+      self.rejected += 1
+      self.reject(request)
+
+  def reject(self, request):
+    body = json.dumps({'success': False, 'response': 'Server busy, try again'})
+    try:
+      #Read what the client has sent so far so closing the socket doesn't reset the connection under our reply
+      request.settimeout(0.1)
+      request.recv(65536)
+    except socket.error:
+      pass
+    try:
+      request.sendall('HTTP/1.0 503 Service Unavailable\r\nContent-Type: application/json\r\nContent-Length: %d\r\nRetry-After: 1\r\nConnection: close\r\n\r\n%s' % (len(body), body))
+    except socket.error:
+      pass
+    self.shutdown_request(request)
+
+  def work(self):
+    while True:
+      request, client_address = self.pending.get()
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        if not self.streams.adopt(request):
+          self.shutdown_request(request)
+
+  def stats(self):
+    return {'workers': self.workers, 'queue_limit': self.queue_limit, 'queued': self.pending.qsize(), 'rejected': self.rejected, 'streams': self.streams.count()}
+
+class RouteLatency:
+  #Request counts and timings per route, with percentiles over the most recent samples.
+
+  #Fields
+  samples = 1000 # How many recent timings to keep per route
+  routes = None  # Route -> [count, total seconds, max seconds, deque of recent timings]
+  lock = None
+
+  def __init__(self, samples = 1000):
+    self.samples = samples
+    self.routes = {}
+    self.lock = threading.Lock()
+
+  def record(self, route, seconds):
+    with self.lock:
+      if route not in self.routes:
+        self.routes[route] = [0, 0.0, 0.0, collections.deque(maxlen = self.samples)]
+      counter = self.routes[route]
+      counter[0] += 1
+      counter[1] += seconds
+      counter[2] = max(counter[2], seconds)
+      counter[3].append(seconds)
+
+  def toDict(self):
+    with self.lock:
+      routes = {}
+      for route, (count, total, longest, recent) in self.routes.iteritems():
+        recent = sorted(recent)
+        routes[route] = {
+          'count': count,
+          'mean_ms': total / count * 1000,
+          'max_ms': longest * 1000,
+          'p50_ms': percentile(recent, 50) * 1000,
+          'p99_ms': percentile(recent, 99) * 1000,
+        }
+      return routes
+
+def percentile(ordered, percent):
+  #Nearest-rank percentile of an already sorted list.
+  if len(ordered) == 0:
+    return 0.0
+  return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+latency = RouteLatency()
+
+# The first parts of the paths we serve, and what may follow a job's id. Anything
+# else is counted as OTHER_ROUTE, so stray URLs can't add series without end.
+ROUTES = frozenset(['getprograms', 'cachestats', 'sensorstats', 'speechstats', 'latency', 'metrics', 'jobs', 'code', 'check', 'sessions',
+  'delprogram', 'addprogram', 'editprogram'] + [url.split('/')[0] for url in static.FILES])
+JOB_ROUTES = frozenset(['stream', 'profile', 'cancel'])
+OTHER_ROUTE = 'other'
+
+def routePath(path):
+  #Group requests for the latency counters: job ids and query strings are dropped.
+  path = urlparse.urlparse(path).path.split('/')
+  if len(path) < 2 or path[1] == '':
+    return '/'
+  if path[1] not in ROUTES:
+    return OTHER_ROUTE
+  if path[1] == 'jobs':
+    return '/jobs' + ('/' + path[3] if len(path) > 3 and path[3] in JOB_ROUTES else '')
+  return '/' + path[1]
 
 def dVFloat (dic, key, val):
   #Parse a dictionary element as a float if it exists, otherwise default to (val).
   return float(dic[key]) if key in dic else val
 
 class NaoHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+  #Fields
+  status = None # The status sent for the current request, if one has been
+
   def do_GET(self):
+    self.timed('GET', self.handleGET)
+
+  def do_POST(self):
+    self.timed('POST', self.handlePOST)
+
+  def timed(self, method, handler):
+    #Run handler, recording how long it took and the status it sent under the request's route.
+    start = time.time()
+    self.status = None
+    try:
+      handler()
+    finally:
+      elapsed = time.time() - start
+      route = routePath(self.path)
+      latency.record(method + ' ' + route, elapsed)
+      request_seconds.observe(elapsed, method, route)
+      requests_served.inc(method, route, str(self.status or 500))
+
+  def send_response(self, code, message = None):
+    self.status = code
+    BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)
+
+  def log_message(self, format, *args):
+    logger.info("%s %s", self.client_address[0], format % args)
+
+  def log_error(self, format, *args):
+    logger.warning("%s %s", self.client_address[0], format % args)
+
+  def sendJSON(self, reply, code = 200):
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.end_headers()
+    self.wfile.write(json.dumps(reply))
+
+  def streamJob(self, job):
+    #Server-sent events, written by the server's StreamHub once this worker is done with the connection.
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.wfile.flush()
+    self.server.streams.offer(self.request, job)
+
+  def sendProfile(self, job):
+    #A profiled job's folded stacks, for flamegraph.pl or speedscope.
+    if job.profiler is None or not job.finished():
+      self.sendJSON({'success': False, 'response': 'No profile for this job'}, 404)
+      return
+    folded = job.profiler.folded()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; charset=utf-8')
+    self.send_header('Content-Disposition', 'attachment; filename="job-%s.folded"' % job.id)
+    self.send_header('Content-Length', str(len(folded)))
+    self.end_headers()
+    self.wfile.write(folded)
+
+  def handleGET(self):
     #Parse the given path
     parsed = urlparse.urlparse(self.path)
     path = parsed.path.split('/')
@@ -35,39 +344,45 @@ class NaoHandler (BaseHTTPServer.BaseHTTPRequestHandler):
     #Enforce one value per query string argument
     for key in qwargs:
       qwargs[key] = qwargs[key][0]
-    
-    print path
 
-    if len(path) < 2 or path[1] == '' or path[1] == 'index.html':
-      index_file = open('index.html')
-      self.send_response(200)
-      self.send_header('Content-type', 'text/html')
-      self.end_headers()
-      self.wfile.write(index_file.read())
-      index_file.close()
+    logger.debug("GET %s", path)
+
+    static_file = static_files.get('index.html' if len(path) < 2 or path[1] == '' else '/'.join(path[1:]))
+
+    if static_file is not None:
+      static.serve(self, static_file)
     elif path[len(path) - 1] == 'favicon.ico':
-      favicon_file = open('favicon.ico')
-      self.send_response(200)
-      self.send_header('Content-type', 'image/x-icon')
-      self.end_headers()
-      self.wfile.write(favicon_file.read())
-      favicon_file.close()
+      self.sendJSON({'success': False, 'response': 'No favicon'}, 404)
     elif path[1] == 'getprograms':
-      programsfile = open('programs.json')
-      contents = json.load(programsfile)
-      programsfile.close()
+      if not ('username' in qwargs): qwargs['username'] = ''
+      self.sendJSON(program_store.programs(qwargs['username']))
+    elif path[1] == 'cachestats':
+      self.sendJSON(parse_cache.stats())
+    elif path[1] == 'sensorstats':
+      self.sendJSON(interpreter.sensor_cache.stats())
+    elif path[1] == 'speechstats':
+      self.sendJSON(interpreter.speech_cache.stats())
+    elif path[1] == 'latency':
+      self.sendJSON({'routes': latency.toDict(), 'server': self.server.stats()})
+    elif path[1] == 'metrics':
+      text = metrics.registry.text()
       self.send_response(200)
-      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+      self.send_header('Content-Length', str(len(text)))
       self.end_headers()
-      if not ('username' in qwargs): qwargs['username'] = ''
-      if not (qwargs['username'] in contents):
-      	contents[qwargs['username']] = {}
-      	wprogramsfile = open('programs.json', 'w')
-      	wprogramsfile.write(json.dumps(contents))
-      	wprogramsfile.close()
-      self.wfile.write(json.dumps(contents[qwargs['username']]))
+      self.wfile.write(text)
+    elif path[1] == 'jobs' and len(path) > 2:
+      job = job_runner.get(path[2])
+      if job is None:
+        self.sendJSON({'success': False, 'response': 'No such job'}, 404)
+      elif len(path) > 3 and path[3] == 'stream':
+        self.streamJob(job)
+      elif len(path) > 3 and path[3] == 'profile':
+        self.sendProfile(job)
+      else:
+        self.sendJSON(job.toDict())
 
-  def do_POST(self):
+  def handlePOST(self):
     #Parse the given path
     parsed = urlparse.urlparse(self.path)
     path = parsed.path.split('/')
@@ -78,64 +393,98 @@ class NaoHandler (BaseHTTPServer.BaseHTTPRequestHandler):
       qwargs[key] = qwargs[key][0]
     
     reply = {}
+    status = 200
     
     if path[1] == 'code':
       length = int(self.headers.getheader('content-length'))
       postvars = urlparse.parse_qs(self.rfile.read(length), keep_blank_values = 1)
       code = urllib.unquote(postvars['code'][0])
-      log = []
-      interpreter.resetGlobalScope(log)
-      lines = interpreter.fullParse(code)
-      for line in lines:
-        line.evaluate(interpreter.global_scope)
-      print log
-      reply['success'] = True
-      reply['response'] = '\n'.join(log)
-    elif path[1] == 'delprogram':
-      programdata = json.loads(urllib.unquote(urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('content-length'))), keep_blank_values = 1)['data'][0]))
-      programsfile = open('programs.json')
-      contents = json.load(programsfile)
-      programsfile.close()
-      reply['nameerror'] = True
-      if programdata['name'] in contents[programdata['username']]:
-        del(contents[programdata['username']][programdata['name']])
-        wprogramsfile = open('programs.json', 'w')
-        wprogramsfile.write(json.dumps(contents))
-        wprogramsfile.close()
-        reply['nameerror'] = False
-    elif path[1] == 'addprogram':
-      programdata = json.loads(urllib.unquote(urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('content-length'))), keep_blank_values = 1)['data'][0]))
-      programsfile = open('programs.json')
-      contents = json.load(programsfile)
-      programsfile.close()
-      reply['success'] = False
-      if not (programdata['name'] in contents[programdata['username']]):
-        contents[programdata['username']][programdata['name']] = programdata['commands']
-        wprogramsfile = open('programs.json', 'w')
-        wprogramsfile.write(json.dumps(contents))
-        wprogramsfile.close()
+      job = job_runner.submit(code, 'tree' if qwargs.get('mode') == 'tree' else 'vm', qwargs.get('session'), qwargs.get('profile') == '1')
+      if recording.trace is not None:
+        recording.trace.submitted(job, 'wait' in qwargs)
+      if 'wait' in qwargs:
+        #Block until the program finishes and reply the old way
+        job.join()
+        reply = job.reply()
+      else:
         reply['success'] = True
-    elif path[1] == 'editprogram':
-      programdata = json.loads(urllib.unquote(urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('content-length'))), keep_blank_values = 1)['data'][0]))
-      programsfile = open('programs.json')
-      contents = json.load(programsfile)
-      programsfile.close()
-      reply['success'] = False
-      if not (programdata['newname'] in contents[programdata['username']]) or programdata['newname'] == programdata['oldname']:
-        if programdata['oldname'] in contents[programdata['username']]: del(contents[programdata['username']][programdata['oldname']])
-        contents[programdata['username']][programdata['newname']] = programdata['commands']
-        wprogramsfile = open('programs.json', 'w')
-        wprogramsfile.write(json.dumps(contents))
-        wprogramsfile.close()
+        reply['job'] = job.id
+    elif path[1] == 'check':
+      #Parse without running, for errors as the program is typed
+      length = int(self.headers.getheader('content-length'))
+      postvars = urlparse.parse_qs(self.rfile.read(length), keep_blank_values = 1)
+      reply = checkers.check(qwargs.get('session'), urllib.unquote(postvars['code'][0]))
+    elif path[1] == 'sessions' and len(path) > 3 and path[3] == 'reset':
+      reply['success'] = job_runner.resetSession(path[2])
+    elif path[1] == 'jobs' and len(path) > 3 and path[3] == 'cancel':
+      job = job_runner.cancel(path[2])
+      if job is None:
+        reply['success'] = False
+        reply['response'] = 'No such job'
+      else:
+        if recording.trace is not None:
+          recording.trace.cancelled(job)
+        reply = job.toDict()
         reply['success'] = True
+    elif path[1] in ('delprogram', 'addprogram', 'editprogram'):
+      reply, status = self.changeProgram(path[1])
 
-    self.send_response(200)
-    self.send_header('Content-Type', 'application/json')
-    self.end_headers()
-    self.wfile.write(json.dumps(reply))
+    self.sendJSON(reply, status)
+
+  def changeProgram(self, route):
+    #The routes that change saved programs. Returns (reply, status): data that
+    #isn't JSON, or fields that aren't text, get a 400 rather than being saved.
+    try:
+      programdata = json.loads(urllib.unquote(urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('content-length'))), keep_blank_values = 1)['data'][0]))
+      if route == 'delprogram':
+        return {'nameerror': not program_store.delete(programdata['username'], programdata['name'])}, 200
+      elif route == 'addprogram':
+        return {'success': program_store.add(programdata['username'], programdata['name'], programdata['commands'])}, 200
+      else:
+        return {'success': program_store.edit(programdata['username'], programdata['oldname'], programdata['newname'], programdata['commands'])}, 200
+    except ValueError, e:
+      return {'success': False, 'response': str(e)}, 400
 
 if __name__ == '__main__':
+  arguments = argparse.ArgumentParser(description = 'Serve the NaoScript editor and run programs on the robot.')
+  arguments.add_argument('--port', type = int, default = 8080)
+  arguments.add_argument('--workers', type = int, default = 16, help = 'threads serving requests')
+  arguments.add_argument('--queue', type = int, default = 64, help = 'connections allowed to wait for a worker before getting a 503')
+  arguments.add_argument('--robot', choices = ['naoqi', 'simulator'], default = None, help = 'robot backend (default: $NAOSCRIPT_ROBOT, or naoqi)')
+  arguments.add_argument('--time-scale', type = float, default = 1.0, help = 'multiplies how long simulated actions take')
+  arguments.add_argument('--sensor-max-age', type = float, default = 0.1, help = 'seconds a sensor reading may be reused for')
+  arguments.add_argument('--sensor-poll', type = float, default = None, help = 'refresh sensor readings in the background every this many seconds')
+  arguments.add_argument('--speech-cache', default = 'speechcache', help = 'directory to keep synthesised speech in; empty to synthesise every time')
+  arguments.add_argument('--speech-cache-mb', type = float, default = 50, help = 'how much synthesised speech to keep')
+  arguments.add_argument('--max-steps', type = int, default = 100000000, help = 'stop programs after roughly this many instructions')
+  arguments.add_argument('--max-seconds', type = float, default = 600, help = 'stop programs after this long')
+  arguments.add_argument('--record', default = None, metavar = 'TRACE', help = 'write every call to the robot and every /code submission to this file, for benchmarks/replay.py')
+  arguments.add_argument('--log-level', choices = ['debug', 'info', 'warning', 'error'], default = 'info', help = 'least severe messages to log')
+  arguments.add_argument('--max-depth', type = int, default = 10000, help = 'stop programs whose function calls nest deeper than this (the tree walker stops at %d)' % interpreter.TREE_MAX_DEPTH)
+  arguments.add_argument('--max-listen', type = float, default = 60, help = 'seconds a program keeps running its `when` blocks after its body finishes; it stops sooner if another program is queued')
+  options = arguments.parse_args()
+  logging.basicConfig(level = getattr(logging, options.log_level.upper()), format = '%(asctime)s %(levelname)s %(name)s: %(message)s')
+  job_runner.limits = {'max_steps': options.max_steps, 'max_seconds': options.max_seconds, 'max_depth': options.max_depth, 'max_listen': options.max_listen}
+  interpreter.sensor_cache.max_age = options.sensor_max_age
+  if options.sensor_poll is not None:
+    interpreter.sensor_cache.startPoller(options.sensor_poll)
+  if options.speech_cache:
+    interpreter.speech_cache.open(options.speech_cache, int(options.speech_cache_mb * 1024 * 1024))
+  if options.robot == 'simulator':
+    robot.configure('simulator', time_scale = options.time_scale)
+  elif options.robot == 'naoqi':
+    robot.configure('naoqi')
+  if options.record:
+    recording.record(options.record, {'limits': job_runner.limits, 'sensor_max_age': options.sensor_max_age, 'sensor_poll': options.sensor_poll,
+      'speech_cache': bool(options.speech_cache), 'speech_cache_mb': options.speech_cache_mb})
   ip_address = netproxy.getLocalIP()
-  print 'Starting server on %s:8080' % ip_address
-  httpd = BaseHTTPServer.HTTPServer(('', 8080), NaoHandler)
-  httpd.serve_forever()
+  logger.info('Starting server on %s:%d', ip_address, options.port)
+  job_runner.start()
+  httpd = PooledHTTPServer(('', options.port), NaoHandler, workers = options.workers, queue_limit = options.queue)
+  try:
+    httpd.serve_forever()
+  finally:
+    program_store.flush()
+    parse_cache.save()
+    if recording.trace is not None:
+      recording.trace.close()
@@ -25,7 +25,16 @@ import re
 import sys
 import time
 import math
-from naoqi import ALProxy
+import logging
+import threading
+import lexer
+import motion
+import robot
+import sensors
+import speech
+import triggers
+
+logger = logging.getLogger("naoscript.parser")
 
 #############################################
 # Architectural portion of the interpreter. #
@@ -42,20 +51,27 @@ OPERANT_MANNER = 2
 WHILE_MANNER = 3
 CONDITIONAL_MANNER = 4
 RETURN_STATEMENT_MANNER = 5
+WHEN_MANNER = 6
 
 operator_priority_list = [ROOT, "=", "and", "or", "is", "==", ">", "<", "+", "-", "mod", "*", "/"]
-ttsproxy = ALProxy("ALTextToSpeech", "localhost", 9559)
-sonarproxy = ALProxy("ALSonar", "localhost", 9559)
-walkproxy = ALProxy("ALMotion", "localhost", 9559)
-bmproxy = ALProxy("ALBehaviorManager", "localhost", 9559)
-darkproxy = ALProxy("ALDarknessDetection", "localhost", 9559)
+# Operators that come earlier in the list bind more loosely.
+operator_priority = dict((operator, index) for index, operator in enumerate(operator_priority_list))
+# Connections to the robot open the first time a program uses them; see robot.py.
+ttsproxy = robot.LazyProxy("ALTextToSpeech")
+walkproxy = robot.LazyProxy("ALMotion")
+bmproxy = robot.LazyProxy("ALBehaviorManager")
+memproxy = robot.LazyProxy("ALMemory")
+adproxy = robot.LazyProxy("ALAudioDevice")
+approxy = robot.LazyProxy("ALAudioPlayer")
 
-darkproxy.subscribe("naoscript")
-sonarproxy.subscribe("naoscript")
+# Sonar and darkness readings, fetched together and reused while they are fresh.
+sensor_cache = sensors.SensorCache(memproxy)
 
-bmproxy.installBehavior("wave")
+# Speech rendered to files and played back, once the server opens a directory for it.
+speech_cache = speech.SpeechCache(ttsproxy, approxy)
 
-memproxy = ALProxy("ALMemory", "localhost", 9559)
+# Walking, turning, relaxing and behaviors all go through this one queue.
+motion_scheduler = motion.MotionScheduler(walkproxy, bmproxy)
 
 def valuefy(tree): #DEBUGGING ONLY
   return tree.value if tree.value not in [ROOT, PAREN] else ["ROOT", "PAREN"][tree.value]
@@ -72,20 +88,133 @@ def isFutureAtomic(string):
 def isPastAtomic(string):
   return isStaticAtomic(string) or string == ")"
 
-class Stack:
-  #Fields
-  state = {}
-  parent = None
-  return_value = None
+# Marks a slot whose variable has not been assigned yet, so lookups fall through to the parent.
+UNSET = object()
+
+class ScriptError(Exception):
+  # Something a NaoScript program did wrong. It ends the run, never the server.
+  kind = None # "arity", "steps", "time", "depth", "runtime" or "parse"
+
+  def __init__(self, kind, message):
+    Exception.__init__(self, message)
+    self.kind = kind
+
+  def toDict(self):
+    return {'kind': self.kind, 'message': str(self)}
 
-  def __init__(self, parent, state = {}):
-    #Initiate us with this parent
+class Cancelled(Exception):
+  # Raised inside a run once its RunState has been cancelled.
+  pass
+
+# Each call the tree walker makes takes several Python frames, so it has to
+# stop well clear of Python's recursion limit whatever the run allows.
+TREE_MAX_DEPTH = 150
+
+class RunState:
+  # Everything that belongs to one run of a program rather than to its code:
+  # its limits, how far it has got towards them, and whether it has been cancelled.
+  # Both evaluators count steps on loop iterations and function calls only, and
+  # look at the clock once every CHECK_EVERY steps. The cancel flag is a plain
+  # attribute, so they look at it on every iteration and call, and builtins that
+  # block on the robot check everything once they return.
+  CHECK_EVERY = 1000
+
+  #Fields
+  values = None       # The VM's table of global values
+  cancelled = False   # Set from another thread to stop the run
+  steps = 0           # Roughly how many instructions have run
+  check_at = 0        # When steps reaches this, check the limits
+  depth = 0           # How many function calls deep we are
+  max_steps = None
+  max_seconds = None
+  max_depth = 10000   # The VM keeps calls on its own stack; the tree walker stops at TREE_MAX_DEPTH
+  deadline = None
+  publish = None      # Called before the VM calls a function an earlier run of the session defined
+  max_listen = None   # Seconds `when` blocks keep running once the program's body has finished
+  yielding = None     # Returns True when another program is waiting for the robot, which ends the listening early
+
+  def __init__(self, max_steps = None, max_seconds = None, max_depth = 10000, max_listen = None):
+    self.values = []
+    self.max_steps = max_steps
+    self.max_seconds = max_seconds
+    self.max_depth = max_depth
+    self.max_listen = max_listen
+    self.start()
+
+  def start(self):
+    # Start counting from zero, and the clock from now.
+    self.steps = 0
+    self.depth = 0
+    self.deadline = time.time() + self.max_seconds if self.max_seconds is not None else None
+    self.check_at = self.CHECK_EVERY if self.max_steps is None else min(self.CHECK_EVERY, self.max_steps + 1)
+
+  def cancel(self):
+    self.cancelled = True
+
+  def check(self):
+    if self.cancelled:
+      raise Cancelled()
+    if self.max_steps is not None and self.steps > self.max_steps:
+      raise ScriptError("steps", "The program took more than %d steps, so it was stopped." % self.max_steps)
+    if self.deadline is not None and time.time() > self.deadline:
+      raise ScriptError("time", "The program ran for more than %g seconds, so it was stopped." % self.max_seconds)
+    self.check_at = self.steps + self.CHECK_EVERY
+    if self.max_steps is not None:
+      self.check_at = min(self.check_at, self.max_steps + 1)
+
+  def tick(self, steps):
+    self.steps += steps
+    if self.cancelled or self.steps >= self.check_at:
+      self.check()
+
+  def enter(self, name, max_depth = None):
+    # Called on the way into a function; leave() must follow on the way out.
+    # A lower max_depth than the run's own applies to this call.
+    if max_depth is None or max_depth > self.max_depth:
+      max_depth = self.max_depth
+    self.depth += 1
+    if self.depth > max_depth:
+      self.depth -= 1
+      raise ScriptError("depth", "Function %s went more than %d calls deep, so the program was stopped." % (name, max_depth))
+
+  def leave(self):
+    self.depth -= 1
+
+  def pause(self, seconds):
+    # Sleep, but stay cancellable and inside the time limit.
+    end = time.time() + seconds
+    while True:
+      self.check()
+      left = end - time.time()
+      if left <= 0:
+        return
+      time.sleep(min(left, 0.1))
+
+def arityError(function, args):
+  return ScriptError("arity", "Function %s takes %d argument%s but was given %d." % (function.name, len(function.arguments), "" if len(function.arguments) == 1 else "s", len(args)))
+
+class Stack(object):
+  # One per scope and one per function call, so it has slots rather than a __dict__.
+  __slots__ = ('state', 'parent', 'return_value', 'returned', 'slots', 'layout')
+
+  def __init__(self, parent, state = None, slots = None, layout = None):
+    #Initiate us with this parent. Compiled frames also get an array of slots
+    #and a layout mapping each slot's variable name to its index. The dict of
+    #named variables is only made once something is set by name.
     self.parent = parent
     self.state = state
+    self.return_value = None
+    self.returned = False # Set by a return statement; the blocks and loops it is in stop
+    self.slots = slots
+    self.layout = layout
 
   def lookup(self, name):
     #If we have this variable, return it; otherwise ask for it from our parent.
-    if name in self.state:
+    if self.layout is not None and name in self.layout:
+      value = self.slots[self.layout[name]]
+      if value is not UNSET:
+        return value
+    if self.state is not None and name in self.state:
       return self.state[name]
     elif self.parent is not None:
       return self.parent.lookup(name)
@@ -102,15 +231,23 @@ class Stack:
 
   def set(self, name, value):
     #Set a variable.
-    self.state[name] = value
+    if self.layout is not None and name in self.layout:
+      self.slots[self.layout[name]] = value
+    elif self.state is None:
+      self.state = {name: value}
+    else:
+      self.state[name] = value
 
-class Expression:
-  manner = None
-  value = None
-  
-  def __init__(self, manner, value, to_return = False):
+class Expression(object):
+  __slots__ = ('manner', 'value', 'line')
+
+  def __init__(self, manner, value, to_return = False, line = None):
     self.manner = manner
     self.value = value
+    self.line = line # The source line a statement came from; None for the expressions inside one
+
+  def __repr__(self):
+    return "Expression(%d, %r)" % (self.manner, self.value)
   
   def evaluate(self, closure):
     if self.manner == 0: # Constant
@@ -129,28 +266,53 @@ class Expression:
     elif self.manner == 3: # Function construction
       closure.set(self.value[0], Function(closure, self.value[1], self.value[2], name = self.value[0]))
     elif self.manner == 4: # Loop
-      while (self.value[0].evaluate(closure)):
+      steps = len(self.value[1]) + 1
+      state = currentSession().state
+      while not closure.returned and (self.value[0].evaluate(closure)):
         for line in self.value[1]:
           line.evaluate(closure)
+          if closure.returned:
+            break
+        state.tick(steps)
       return closure.return_value
     elif self.manner == 5: # Conditional
       result = None
       if (self.value[0].evaluate(closure)): # The condition succeeds
         for line in self.value[1]:
           result = line.evaluate(closure)
-      elif (self.value[1] is not None): # The condition did not succeed, but there is an "else"
+          if closure.returned:
+            break
+      elif (self.value[2] is not None): # The condition did not succeed, but there is an "else"
         for line in self.value[2]:
           result = line.evaluate(closure)
+          if closure.returned:
+            break
       return result
     elif self.manner == 6: # Return statement
+      # Leaves the function straight away, like the VM: the loops and blocks it is in stop too.
       closure.return_value = self.value.evaluate(closure)
+      closure.returned = True
       return closure.return_value
-
-class Function:
-  arguments = []
-  closure = None
-  block = []
-  name = None
+    elif self.manner == 7: # Profiled statement, added by profiler.Profiler.instrument
+      return self.value[0].statement(self.value[1], self.value[2], closure)
+    elif self.manner == 8: # Event handler; see triggers.py
+      condition, block = self.value
+      keys = triggers.conditionKeys(triggers.conditionNames(condition), closure, builtin_state)
+      currentSession().when(triggers.Trigger(lambda: condition.evaluate(closure), lambda: handle(block, closure), keys))
+
+def handle(block, closure):
+  #Run a when block in the frame it was declared in. A return there ends the
+  #block rather than the frame, which may still be running.
+  return_value = closure.return_value
+  for line in block:
+    line.evaluate(closure)
+    if closure.returned:
+      break
+  closure.returned = False
+  closure.return_value = return_value
+
+class Function(object):
+  __slots__ = ('arguments', 'closure', 'block', 'name')
 
   def __init__(self, stack, args, statements, name = "anonymous"):
     self.arguments = args
@@ -159,23 +321,24 @@ class Function:
     self.name = name
 
   def call(self, args):
-    new_closure = self.closure.close()
-    return_value = None
     if len(args) < len(self.arguments):
-      print "%s is not enough arguments to call function %s." % (args, self.name)
-      sys.exit(1)
-    for i in range(0, len(self.arguments)):
-      new_closure.set(self.arguments[i], args[i])
+      raise arityError(self, args)
+    new_closure = Stack(self.closure, state = dict(zip(self.arguments, args)))
+    state = currentSession().state
+    state.tick(len(self.block))
+    state.enter(self.name, TREE_MAX_DEPTH)
+    # An error ends the whole run, so leave() doesn't need to be in a finally.
     for expression in self.block:
       expression.evaluate(new_closure)
-      if (new_closure.return_value is not None):
+      if new_closure.returned:
+        state.leave()
         return new_closure.return_value
+    state.leave()
     return None
 
-class NativeFunction:
+class NativeFunction(object):
   # Function here will be a lambda.
-  function = None
-  name = None
+  __slots__ = ('function', 'name')
 
   def __init__(self, function, name="anonymous"):
     self.function = function
@@ -190,10 +353,7 @@ def walk (l):
     x = l[0]
   else:
     x = 1
-  walkproxy.stiffnessInterpolation("Body", 1, 0.1)
-  walkproxy.walkInit()
-  walkproxy.walkTo(x / 10.0, 0, 0)
-  return True
+  return queueMotion(motion_scheduler.walk(x / 10.0, 0))
 
 def turn (l):
   x = None
@@ -201,58 +361,208 @@ def turn (l):
     x = l[0]
   else:
     x = 180
-  walkproxy.stiffnessInterpolation("Body", 1, 0.1)
-  walkproxy.walkInit()
-  walkproxy.walkTo(0, 0, x * math.pi / 180)
-  return True
+  return queueMotion(motion_scheduler.walk(0, x * math.pi / 180))
+
+def queueMotion(future):
+  currentSession().last_motion = future
+  return future
+
+def finishMotion(l = []):
+  # Wait for the given motion, or for everything the program has queued.
+  if len(l) > 0 and isinstance(l[0], motion.Future):
+    return l[0].wait()
+  return currentSession().finishMotion()
+
+def sense(key):
+  # Read a sensor. Readings should reflect where the program has told the robot to be.
+  session = currentSession()
+  if not session.events.checking: # A `when` condition shouldn't hold up its handlers' motions
+    session.finishMotion()
+    session.state.check()
+  return sensor_cache.read(key, session.last_motion.finished_at if session.last_motion is not None else 0)
+
+def say((x,)):
+  speech_cache.say(str(x))
+  # Speaking takes a while; stop here if the run was cancelled or ran out of time meanwhile.
+  currentSession().state.check()
+
+def pause(l):
+  currentSession().wait(l[0] if len(l) > 0 else 1)
+
+# Builtins that only compute a value from their arguments. The optimizer may
+# call these ahead of time on constant arguments, so nothing that talks to the
+# robot, sleeps or prints belongs here.
+pure_builtins = {
+  "+": NativeFunction(lambda (a, b): a + b if isinstance(a, int) and isinstance(b, int) else str(a) + str(b), name = "+"),
+  "-": NativeFunction(lambda (a, b): a - b, name = "-"),
+  "*": NativeFunction(lambda (a, b): a * b, name = "*"),
+  "/": NativeFunction(lambda (a, b): a / b, name = "/"),
+  ">": NativeFunction(lambda (a, b): a > b, name = "/"),
+  "<": NativeFunction(lambda (a, b): a < b, name = "/"),
+  "mod": NativeFunction(lambda (a, b): a % b, name = "mod"),
+  "is": NativeFunction(lambda (a, b): a == b, name = "is"),
+  "==": NativeFunction(lambda (a, b): a == b, name = "=="),
+  "not": NativeFunction(lambda (x,): not x, name = "not"),
+  "and": NativeFunction(lambda (a, b): a and b, name = "and"),
+  "or": NativeFunction(lambda (a, b): a or b, name = "or"),
+  "neg": NativeFunction(lambda (x,): -x, name = "neg"),
+  "backward": NativeFunction(lambda (l): -l[0] if len(l) > 0 else -1),
+}
+
+builtin_constants = {
+  "true": True,
+  "false": False,
+}
+
+# Everything else a program can call. These act on the session running them.
+impure_builtins = {
+  "print": NativeFunction(lambda (x,): currentSession().log.append(str(x)), name = "print"),
+  "walk": NativeFunction(walk, name = "walk"),
+  "turn": NativeFunction(turn, name = "turn"),
+  "wave": NativeFunction(lambda l: queueMotion(motion_scheduler.behavior("wave")), name="wave"),
+  "say": NativeFunction(say, name = "say"),
+  "stand": NativeFunction(lambda l: queueMotion(motion_scheduler.behavior("Stand Up")), name="stand"),
+  "sit": NativeFunction(lambda l: queueMotion(motion_scheduler.behavior("Sit Down")), name="sit"),
+  "wait": NativeFunction(pause, name = "wait"),
+  "relax": NativeFunction(lambda l: queueMotion(motion_scheduler.relax()), name = "relax"),
+  "finish": NativeFunction(finishMotion, name = "finish"),
+  "volume": NativeFunction(lambda (x,): adproxy.setOutputVolume(int(x)), name="volume"),
+  "distance": NativeFunction(lambda (x,): sense(sensors.SONAR_LEFT if x == "left" else sensors.SONAR_RIGHT), name = "distance"),
+  "brightness": NativeFunction(lambda l: 100 - (sense(sensors.DARKNESS) * 50 / 47), name = "brightness"),
+}
+
+# The scope every session's variables sit on top of. It is built once and shared;
+# programs only ever assign into their own session's scope, never into this one.
+builtin_state = dict(pure_builtins)
+builtin_state.update(builtin_constants)
+builtin_state.update(impure_builtins)
+builtin_scope = Stack(None, state = builtin_state)
+
+class Session:
+  # One user's interpreter: their variables, where print goes, the limits and
+  # progress of the current run, and the robot motion it is waiting on.
+  # Variables stay in the scope from one run to the next until reset().
 
-# The global scope, which to begin with contains the native functions.
+  #Fields
+  scope = None
+  log = None
+  state = None
+  limits = None       # RunState arguments for each run
+  last_motion = None  # The last motion queued; once it has finished, so has everything before it
+  previous = None     # The session this thread was running before we were entered
+  runs = None         # (Code, global values) of compiled runs whose functions may still be called
+  events = None       # The `when` blocks of the current run
+
+  def __init__(self, log = None, limits = {}):
+    self.log = log if log is not None else []
+    self.limits = dict(limits)
+    self.state = RunState(**self.limits)
+    self.events = triggers.EventLoop(sensor_cache)
+    self.reset()
+
+  def reset(self):
+    # Forget every variable.
+    self.scope = Stack(builtin_scope)
+    self.runs = []
+
+  def start(self, log = None, state = None):
+    # Get ready for another run. Pass a log to send print somewhere new, and a
+    # RunState to be able to cancel the run from elsewhere.
+    if log is not None:
+      self.log = log
+    self.state = state if state is not None else RunState(**self.limits)
+    self.state.start()
+    self.last_motion = None
+    self.events = triggers.EventLoop(sensor_cache)
+    return self
+
+  def finishMotion(self):
+    if self.last_motion is not None:
+      return self.last_motion.wait()
+    return True
+
+  def when(self, trigger):
+    self.events.add(trigger)
+
+  def wait(self, seconds):
+    # Sleep, but keep running `when` blocks while we do.
+    if len(self.events.triggers) > 0:
+      self.events.run(self.state, until = time.time() + seconds)
+      self.state.check()
+    else:
+      self.state.pause(seconds)
+
+  def listen(self):
+    # Once the program's body has finished, run its `when` blocks until it is
+    # cancelled, out of time or has listened for max_listen seconds, or until
+    # another program is waiting for the robot.
+    if len(self.events.triggers) > 0:
+      until = time.time() + self.state.max_listen if self.state.max_listen is not None else None
+      self.events.run(self.state, until = until, stop = self.state.yielding)
+
+  def evaluate(self, expressions):
+    # Run parsed lines with the tree walker.
+    result = None
+    for line in expressions:
+      if self.state.cancelled:
+        raise Cancelled()
+      result = line.evaluate(self.scope)
+      if self.scope.returned:
+        # A return at the top level ends the program; the session's next one starts afresh
+        self.scope.returned = False
+        self.scope.return_value = None
+        break
+    self.listen()
+    return result
+
+  def names(self):
+    # The variables bound so far, which the next program shares.
+    return self.scope.state.keys() if self.scope.state is not None else []
+
+  # Entering a session makes it the one builtins act on in this thread.
+  def __enter__(self):
+    self.previous = getattr(context, "session", None)
+    context.session = self
+    return self
+
+  def __exit__(self, kind, value, traceback):
+    context.session = self.previous
+    self.previous = None
+
+# Which session is running in each thread.
+context = threading.local()
+
+def currentSession():
+  session = getattr(context, "session", None)
+  if session is None:
+    session = context.session = Session()
+  return session
+
+# The scope resetGlobalScope last set up, for scripts that run one program at a time.
 global_scope = None
 
-def resetGlobalScope(log_file):
+def resetGlobalScope(log_file, state = None):
+  # Make a fresh session current in this thread, and its scope global_scope.
   global global_scope
-
-  global_scope = Stack(None, state = {
-    "+": NativeFunction(lambda (a, b): a + b if isinstance(a, int) and isinstance(b, int) else str(a) + str(b), name = "+"),
-    "-": NativeFunction(lambda (a, b): a - b, name = "-"),
-    "*": NativeFunction(lambda (a, b): a * b, name = "*"),
-    "/": NativeFunction(lambda (a, b): a / b, name = "/"),
-    ">": NativeFunction(lambda (a, b): a > b, name = "/"),
-    "<": NativeFunction(lambda (a, b): a < b, name = "/"),
-    "mod": NativeFunction(lambda (a, b): a % b, name = "mod"),
-    "is": NativeFunction(lambda (a, b): a == b, name = "is"),
-    "==": NativeFunction(lambda (a, b): a == b, name = "=="),
-    "not": NativeFunction(lambda (x,): not x, name = "not"),
-    "and": NativeFunction(lambda (a, b): a and b, name = "and"),
-    "or": NativeFunction(lambda (a, b): a or b, name = "or"),
-    "print": NativeFunction(lambda (x,): log_file.append(str(x)), name = "print"),
-    "true": True,
-    "false": False,
-    "walk": NativeFunction(walk, name = "walk"),
-    "turn": NativeFunction(turn, name = "turn"),
-    "wave": NativeFunction(lambda l: bmproxy.runBehavior("wave"), name="wave"),
-    "say": NativeFunction(lambda (x,): ttsproxy.say(str(x)), name = "say"),
-    "stand": NativeFunction(lambda l: bmproxy.runBehavior("Stand Up"), name="stand"),
-    "sit": NativeFunction(lambda l: bmproxy.runBehavior("Sit Down"), name="sit"),
-    "wait": NativeFunction(lambda l: time.sleep(l[0]) if len(l) > 0 else time.sleep(1), name = "wait"),
-    "relax": NativeFunction(lambda l: walkproxy.stiffnessInterpolation("Body", 0, 0.1), name = "relax"),
-    "volume": NativeFunction(lambda (x,): adproxy.setOutputVolume(int(commands["volume"])), name="volume"),
-    "neg": NativeFunction(lambda (x,): -x, name = "neg"),
-    "backward": NativeFunction(lambda (l): -l[0] if len(l) > 0 else -1),
-    "distance": NativeFunction(lambda (x,): memproxy.getData("Device/SubDeviceList/US/Left/Sensor/Value") if x == "left" else memproxy.getData("Device/SubDeviceList/US/Right/Sensor/Value"), name = "distance"),
-    "brightness": NativeFunction(lambda l: 100 - (memproxy.getData("DarknessDetection/DarknessValue") * 50 / 47), name = "brightness"),
-  })
+  session = Session(log = log_file).start(state = state)
+  context.session = session
+  global_scope = session.scope
+  return session
 
 ##########
 # Parser #
 ##########
 
-class TreeNode:
-  manner = None
-  value = None
-  parent = None
-  children = None
-  paren_depth = 0
+class ParseError(Exception):
+  # Raised for programs that cannot be parsed.
+  line = None # The line the problem is on, when it's known
+
+  def __init__(self, message, line = None):
+    Exception.__init__(self, message)
+    self.line = line
+
+class TreeNode(object):
+  __slots__ = ('manner', 'value', 'parent', 'children', 'paren_depth')
 
   def __init__(self, value, parent, paren_depth, manner = 0):
     self.parent = parent
@@ -294,18 +604,284 @@ class TreeNode:
       return self.parent.root()
 
 def hasPriority(o1, o2):
-  for operator in operator_priority_list:
-    if operator == o1:
-      print "%s == %s, so %s has priority over %s." % (raw_valuefy(operator), raw_valuefy(o1), raw_valuefy(o1), raw_valuefy(o2))
-      return True
-    elif operator == o2:
-      print "%s == %s, so %s has priority over %s." % (raw_valuefy(operator), raw_valuefy(o2), raw_valuefy(o2), raw_valuefy(o1))
-      return False
-  print "No operational match for either %s or %s in %r." % (o1, o2, operator_priority_list)
-  return None # This is actually an error condition, so we should say so. TODO
-
-def parse (lines, indentation):
-  # Parse a program into a list of parse trees.
+  # True if o1 binds more loosely than o2 (or they are the same), False if o2 does, None if neither is an operator.
+  p1 = operator_priority.get(o1)
+  p2 = operator_priority.get(o2)
+  if p1 is not None and (p2 is None or p1 <= p2):
+    result = True
+  elif p2 is not None:
+    result = False
+  else:
+    result = None
+  if logger.isEnabledFor(logging.DEBUG):
+    logger.debug("hasPriority(%s, %s) = %s", raw_valuefy(o1), raw_valuefy(o2), result)
+  return result
+
+def legacyTokenize(new_line):
+  # The original character-by-character tokenizer. lexer.tokenTexts replaces it;
+  # it is kept as the reference the lexer is checked against.
+  tokenization = []
+  latest_token = ""
+  alphanumeric = True
+  in_string = False
+  
+  for character in new_line:
+    escaped = False
+    if character == '\\' and in_string:
+      escaped = True
+    elif character == '"':
+      if in_string and not escaped:
+        latest_token += character
+        tokenization.append(latest_token)
+        latest_token = ''
+        in_string = False
+      else:
+        if len(latest_token) > 0:
+          tokenization.append(latest_token)
+        latest_token = '"'
+        in_string = True
+    elif in_string:
+      latest_token += character
+    else:
+      if character == '(' or character == ')':
+        alphanumeric = False
+        if len(latest_token) > 0:
+          tokenization.append(latest_token)
+        tokenization.append(character)
+        latest_token = ''
+      elif character.isalnum() == alphanumeric and character != ' ':
+        # We're still in the same token, so keep constructing it
+        latest_token += character
+      else:
+        # We're switching tokens.
+        alphanumeric = character.isalnum() if character != ' ' else alphanumeric
+        if len(latest_token) > 0:
+          # Append our token to the tokenization.
+          # Token will be '' if if it was created because of a space-separated
+          # alphanumeric-nonalphanumeric pair, so we don't add those.
+          tokenization.append(latest_token)
+        
+        # If we're supposed to, also begin constructing the next token.
+        latest_token = character if character != ' ' else ''
+
+  # Append the last token to the tokenization
+  if len(latest_token) > 0:
+    tokenization.append(latest_token)
+
+  return tokenization
+
+def legacyParseTokens(tokenization, manner = NORMAL_MANNER):
+  # The original TreeNode parser for one line's tokens, returning the ROOT node.
+  # parseExpression replaces it; it is kept as the reference the new parser is checked against.
+  tree = TreeNode(ROOT, None, 0, manner = manner)
+  current_paren_depth = 0
+  
+  # Parse the tokenization
+  last_token = None
+  for token in tokenization:
+    
+    # DEBUGGING
+    # print "Token: %s" % token
+    # print "Paren depth: %d" % current_paren_depth
+
+    if last_token is not None and isPastAtomic(last_token) and isFutureAtomic(token):
+      # Two consecutive alphanumeric sequences can only be a function call
+      tree.manner = FUNCTION_CALL_MANNER # Signify that this is a function call node
+      if token == "(":
+        tree = tree.birth(PAREN, current_paren_depth)
+        current_paren_depth += 1
+      else:
+        tree = tree.birth(token, current_paren_depth)
+
+
+    elif token == ",":
+      # It's not the comma that's significant, but the token after it
+      last_token = ","
+      continue
+    
+    elif last_token == "," and isFutureAtomic(token):
+      # Immediately seek the function call that this argument is a part of.
+      while (tree.manner != 1):
+        tree = tree.parent
+
+      tree = tree.birth(token, current_paren_depth)
+
+      if token == "(":
+        current_paren_depth += 1
+    
+    elif token == '(':
+      # Create a parenthetical node and increase our paren_depth
+      tree = tree.birth(PAREN, current_paren_depth)
+      current_paren_depth += 1
+
+    elif token == ')':
+      # Decrease the paren depth
+      current_paren_depth -= 1
+    
+    else:
+      # Otherwise, we have an atomic or operant token.
+      strung_child = None # This will be for in case we have insert our node between two others
+      new_manner = OPERANT_MANNER if token in operator_priority_list else NORMAL_MANNER
+      
+      while (tree.paren_depth > current_paren_depth) or (tree.paren_depth == current_paren_depth and (not hasPriority(tree.value, token)) and (not (tree.manner == 1))):
+        # DEBUGGING
+        # print "  deferring %s." % valuefy(tree)
+        
+        # Travel up the tree until we find the node we want to be beneath
+        strung_child = tree
+        tree = tree.parent
+
+      if strung_child is not None:
+        # Insert our node between two others
+        tree = tree.replaceChild(strung_child, token, manner = new_manner)
+      
+      else:
+        # Make our node (a leaf)
+        tree = tree.birth(token, current_paren_depth, manner = new_manner)
+    
+    # Update last_token
+    last_token = token
+    # DEBUGGING
+    # print tree.root().toString()
+
+  return tree.root()
+
+class Line:
+  # The parsed head of a line: how it behaves (NORMAL, WHILE, CONDITIONAL or RETURN_STATEMENT manner) and its expression.
+  manner = None
+  expression = None
+  number = None # Its line number in the source, counting from 1
+
+  def __init__(self, manner, expression, number = None):
+    self.manner = manner
+    self.expression = expression
+    self.number = number
+
+  def toString(self):
+    return "[%d] %r" % (self.manner, self.expression)
+
+def isValueToken(token):
+  return token == "(" or (token not in operator_priority and token != ")" and token != "," and (token.isalnum() or token[0] == '"'))
+
+class ExpressionParser:
+  # Precedence climbing over one line's tokens, producing Expressions directly.
+  #
+  # Two consecutive values make a function call whose arguments run to the end
+  # of the line, a comma or a closing parenthesis, so "f a + b, c" is f(a + b, c).
+  # A comma always belongs to the innermost call, even from inside parentheses:
+  # "f (a, b)" is f(a, b). Such a parenthesis is left open ("leaked"), and the
+  # ")" that closes it is skipped wherever it turns up. Every operator is right
+  # associative, as it was in the TreeNode parser.
+  tokens = None
+  position = 0
+  parens = None # One entry per open parenthesis, True once it has leaked
+  calls = 0
+  trace = False
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.position = 0
+    self.parens = []
+    self.calls = 0
+    self.trace = logger.isEnabledFor(logging.DEBUG)
+
+  def peek(self):
+    return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+  def expression(self, priority):
+    left = self.operand()
+    while True:
+      token = self.peek()
+      if token is None or token == ",":
+        return left
+      elif token == ")":
+        if len(self.parens) == 0 or not self.parens[-1]:
+          return left
+        self.parens.pop()
+        self.position += 1
+        continue
+      operator_rank = operator_priority.get(token)
+      if operator_rank is None:
+        if isValueToken(token):
+          raise ParseError("Unexpected %s after ')'" % token)
+        raise ParseError("Unknown operator %s" % token)
+      if operator_rank < priority:
+        return left
+      if self.trace:
+        logger.debug("operator %s (priority %d) inside priority %d", token, operator_rank, priority)
+      self.position += 1
+      right = self.expression(operator_rank)
+      left = self.binary(token, left, right)
+
+  def binary(self, operator, left, right):
+    if operator == "=":
+      # The assigned name is the head of the left side, which is normally a bare variable.
+      if left.manner != 1:
+        raise ParseError("Can't assign to %r" % left.value)
+      return Expression(2, (left.value[0], right))
+    return Expression(1, (operator, [left, right]))
+
+  def operand(self):
+    token = self.peek()
+    if token is None:
+      previous = self.tokens[self.position - 1] if self.position > 0 else None
+      raise ParseError("Expected a value after %s" % previous if previous is not None else "Expected a value")
+    if not isValueToken(token):
+      raise ParseError("Expected a value but found %s" % token)
+    self.position += 1
+
+    if token == "(":
+      index = len(self.parens)
+      self.parens.append(False)
+      inner = self.expression(0)
+      following = self.peek()
+      if following == ")":
+        self.position += 1
+        self.parens.pop()
+      elif following == ",":
+        if self.calls == 0:
+          raise ParseError("',' outside of a function call")
+        self.parens[index] = True
+      # A missing ")" at the end of the line is forgiven.
+      return inner
+
+    following = self.peek()
+    if following is not None and isValueToken(following):
+      # Two consecutive values can only be a function call.
+      if self.trace:
+        logger.debug("call %s", token)
+      return Expression(1, (token, self.arguments()))
+    elif token.isdigit():
+      return Expression(0, int(token))
+    elif token[0] == '"':
+      if len(token) < 2 or token[len(token) - 1] != '"':
+        raise ParseError("Unterminated string %s" % token)
+      return Expression(0, token.strip('"'))
+    else:
+      return Expression(1, (token, []))
+
+  def arguments(self):
+    self.calls += 1
+    args = [self.expression(0)]
+    while self.peek() == ",":
+      self.position += 1
+      args.append(self.expression(0))
+    self.calls -= 1
+    return args
+
+def parseExpression(tokens):
+  # Parse a whole line's tokens (without any leading keyword) into one Expression.
+  parser = ExpressionParser(tokens)
+  expression = parser.expression(0)
+  leftover = parser.peek()
+  if leftover == ",":
+    raise ParseError("',' outside of a function call")
+  elif leftover is not None:
+    raise ParseError("Unmatched %s" % leftover)
+  return expression
+
+def parse (lines, indentation, first_line = 1):
+  # Parse a program into a list of parse trees. first_line is the line number of lines[0].
   block = []
   current_block_index = 0
   current_line_index = 0 
@@ -332,7 +908,9 @@ def parse (lines, indentation):
 
     elif (indent > indentation):
       # They indented, so we recurse.
-      temporary_tuple = parse(lines[current_line_index:], indent) # Here we hang the parsed stuff as a block on the last parsed statement.
+      if current_block_index == 0:
+        raise ParseError("Unexpected indentation", first_line + current_line_index)
+      temporary_tuple = parse(lines[current_line_index:], indent, first_line + current_line_index) # Here we hang the parsed stuff as a block on the last parsed statement.
       if found_else:
         block[current_block_index - 1][2] = temporary_tuple[0]
         current_line_index += temporary_tuple[1]
@@ -342,61 +920,17 @@ def parse (lines, indentation):
         current_line_index += temporary_tuple[1]
     
     else:
-      tokenization = []
-      latest_token = ""
-      alphanumeric = True
-      in_string = False
-      
       # Tokenize the line
-      for character in new_line:
-        escaped = False
-        if character == '\\' and in_string:
-          escaped = True
-        elif character == '"':
-          if in_string and not escaped:
-            latest_token += character
-            tokenization.append(latest_token)
-            latest_token = ''
-            in_string = False
-          else:
-            if len(latest_token) > 0:
-              tokenization.append(latest_token)
-            latest_token = '"'
-            in_string = True
-        elif in_string:
-          latest_token += character
-        else:
-          if character == '(' or character == ')':
-            alphanumeric = False
-            if len(latest_token) > 0:
-              tokenization.append(latest_token)
-            tokenization.append(character)
-            latest_token = ''
-          elif character.isalnum() == alphanumeric and character != ' ':
-            # We're still in the same token, so keep constructing it
-            latest_token += character
-          else:
-            # We're switching tokens.
-            alphanumeric = character.isalnum() if character != ' ' else alphanumeric
-            if len(latest_token) > 0:
-              # Append our token to the tokenization.
-              # Token will be '' if if it was created because of a space-separated
-              # alphanumeric-nonalphanumeric pair, so we don't add those.
-              tokenization.append(latest_token)
-            
-            # If we're supposed to, also begin constructing the next token.
-            latest_token = character if character != ' ' else ''
-    
-      # Append the last token to the tokenization
-      if len(latest_token) > 0:
-        tokenization.append(latest_token)
-      
+      tokenization = lexer.tokenTexts(new_line)
+
       found_else = False
       
       if len(tokenization) == 0:
         current_line_index += 1
         continue
       elif tokenization[0] == "function":
+        if len(tokenization) < 2:
+          raise ParseError("A function needs a name", first_line + current_line_index)
         parameters = []
         if len(tokenization) > 3 and tokenization[2] == "takes":
           for token in tokenization[3:]:
@@ -404,105 +938,44 @@ def parse (lines, indentation):
               continue
             else:
               parameters.append(token)
-        block.append([("FUNCTION", tokenization[1], parameters), None, None])
+        block.append([("FUNCTION", tokenization[1], parameters, first_line + current_line_index), None, None])
         current_line_index += 1
         current_block_index += 1
         continue
       else:
-        # Begin constructing the parse tree
+        # Parse the rest of the line as an expression
         if tokenization[0] == "while":
           tokenization.pop(0)
-          tree = TreeNode(ROOT, None, 0, manner = WHILE_MANNER)
+          manner = WHILE_MANNER
         elif tokenization[0] == "if":
           tokenization.pop(0)
-          tree = TreeNode(ROOT, None, 0, manner = CONDITIONAL_MANNER)
+          manner = CONDITIONAL_MANNER
           seeking_else = True
         elif tokenization[0] == "return":
           tokenization.pop(0)
-          tree = TreeNode(ROOT, None, 0, manner = RETURN_STATEMENT_MANNER)
+          manner = RETURN_STATEMENT_MANNER
+        elif tokenization[0] == "when":
+          tokenization.pop(0)
+          manner = WHEN_MANNER
         elif seeking_else and tokenization[0] == "else":
           found_else = True
           seeking_else = False
           current_line_index += 1
           continue
         else:
-          tree = TreeNode(ROOT, None, 0)
-        current_paren_depth = 0
-        
-        # Parse the tokenization
-        last_token = None
-        for token in tokenization:
-          
-          # DEBUGGING
-          # print "Token: %s" % token
-          # print "Paren depth: %d" % current_paren_depth
-
-          if last_token is not None and isPastAtomic(last_token) and isFutureAtomic(token):
-            # Two consecutive alphanumeric sequences can only be a function call
-            tree.manner = FUNCTION_CALL_MANNER # Signify that this is a function call node
-            if token == "(":
-              tree = tree.birth(PAREN, current_paren_depth)
-              current_paren_depth += 1
-            else:
-              tree = tree.birth(token, current_paren_depth)
-
-
-          elif token == ",":
-            # It's not the comma that's significant, but the token after it
-            last_token = ","
-            continue
-          
-          elif last_token == "," and isFutureAtomic(token):
-            # Immediately seek the function call that this argument is a part of.
-            while (tree.manner != 1):
-              tree = tree.parent
-
-            tree = tree.birth(token, current_paren_depth)
-
-            if token == "(":
-              current_paren_depth += 1
-          
-          elif token == '(':
-            # Create a parenthetical node and increase our paren_depth
-            tree = tree.birth(PAREN, current_paren_depth)
-            current_paren_depth += 1
-
-          elif token == ')':
-            # Decrease the paren depth
-            current_paren_depth -= 1
-          
-          else:
-            # Otherwise, we have an atomic or operant token.
-            strung_child = None # This will be for in case we have insert our node between two others
-            new_manner = OPERANT_MANNER if token in operator_priority_list else NORMAL_MANNER
-            
-            while (tree.paren_depth > current_paren_depth) or (tree.paren_depth == current_paren_depth and (not hasPriority(tree.value, token)) and (not (tree.manner == 1))):
-              # DEBUGGING
-              # print "  deferring %s." % valuefy(tree)
-              
-              # Travel up the tree until we find the node we want to be beneath
-              strung_child = tree
-              tree = tree.parent
-
-            if strung_child is not None:
-              # Insert our node between two others
-              tree = tree.replaceChild(strung_child, token, manner = new_manner)
-            
-            else:
-              # Make our node (a leaf)
-              tree = tree.birth(token, current_paren_depth, manner = new_manner)
-          
-          # Update last_token
-          last_token = token
-          # DEBUGGING
-          # print tree.root().toString()
-         
+          manner = NORMAL_MANNER
+        try:
+          expression = parseExpression(tokenization)
+        except ParseError, e:
+          if e.line is None:
+            e.line = first_line + current_line_index
+          raise
+        head = Line(manner, expression, first_line + current_line_index)
 
       current_line_index += 1
       current_block_index += 1
 
-      # Seek the root node of our tree and append it to our list of parsed lines
-      block.append([tree.root(),None,None])
+      block.append([head, None, None])
   return (block, current_line_index)
 
 def expressionize(tree):
@@ -542,27 +1015,36 @@ def expressionize(tree):
       return Expression(1, (tree.value, []))
 
 def lineParse(line):
-  tree = line[0]
+  head = line[0]
+
+  if line[1] is None and (isinstance(head, tuple) or head.manner in (WHILE_MANNER, CONDITIONAL_MANNER, WHEN_MANNER)):
+    raise ParseError("Expected an indented block", head[3] if isinstance(head, tuple) else head.number)
 
-  if isinstance(tree, tuple) and tree[0] == "FUNCTION":
+  if isinstance(head, tuple) and head[0] == "FUNCTION":
     expression_block = []
     for statement in line[1]:
       expression_block.append(lineParse(statement))
-    return Expression(3, (tree[1], tree[2], expression_block))
+    return Expression(3, (head[1], head[2], expression_block), line = head[3])
 
-  elif tree.value == ROOT and tree.manner == RETURN_STATEMENT_MANNER:
-    return Expression(6, expressionize(tree.children[0]))
+  elif head.manner == RETURN_STATEMENT_MANNER:
+    return Expression(6, head.expression, line = head.number)
   
-  elif tree.value == ROOT and tree.manner == WHILE_MANNER:
+  elif head.manner == WHILE_MANNER:
     # Expressionize the looped block
     expression_block = []
     for statement in line[1]:
       expression_block.append(lineParse(statement))
 
     # Expressionize the whole thing
-    return Expression(4, (expressionize(tree.children[0]), expression_block))
+    return Expression(4, (head.expression, expression_block), line = head.number)
+
+  elif head.manner == WHEN_MANNER:
+    expression_block = []
+    for statement in line[1]:
+      expression_block.append(lineParse(statement))
+    return Expression(8, (head.expression, expression_block), line = head.number)
 
-  elif tree.value == ROOT and tree.manner == CONDITIONAL_MANNER:
+  elif head.manner == CONDITIONAL_MANNER:
     # Expressionize the conditional expression block
     if_expression_block = []
     for statement in line[1]:
@@ -576,14 +1058,15 @@ def lineParse(line):
         else_expression_block.append(lineParse(statement))
 
     # Expressionize the entire expression
-    return Expression(5, (expressionize(tree.children[0]), if_expression_block, else_expression_block))
+    return Expression(5, (head.expression, if_expression_block, else_expression_block), line = head.number)
 
   else:
-    return expressionize(tree)
+    head.expression.line = head.number
+    return head.expression
 
 def indentify(line):
   string = ""
-  string += line[0].toString() if isinstance(line[0], TreeNode) else str(line[0])
+  string += line[0].toString() if isinstance(line[0], (TreeNode, Line)) else str(line[0])
   if line[1] is not None:
     for subline in line[1]:
       string += "\n  " + "\n  ".join(indentify(subline).split("\n"))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+  Background execution of NaoScript programs.
+
+  POST /code used to run a program inside the request handler, so a program
+  full of waits and walks held the server for minutes. Programs are now
+  submitted to a JobRunner, which runs them one at a time on its own thread
+  (there is only one robot to move) and keeps each Job's output where request
+  handlers can stream it while it is still being produced.
+"""
+import time
+import threading
+import itertools
+import Queue
+import logging
+import traceback
+from collections import OrderedDict
+
+import interpreter
+import motion
+import profiler
+import vm
+import metrics
+import recording
+
+logger = logging.getLogger("naoscript.jobs")
+
+wait_seconds = metrics.histogram("naoscript_job_wait_seconds", "Time jobs spent queued before they started")
+run_seconds = metrics.histogram("naoscript_job_seconds", "Time taken to run jobs, until the robot stopped moving", ("mode", "status"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+class Job:
+  #Fields
+  id = None
+  code = None
+  mode = None     # "vm" or "tree"
+  session = None  # The name of the session to run in, or None for a fresh one
+  status = QUEUED
+  lines = None    # Everything the program has printed so far
+  error = None    # The ScriptError that ended the job, if it failed
+  optimizer = None
+  state = None    # The interpreter.RunState holding its limits and cancel flag
+  profiler = None # A profiler.Profiler, for jobs submitted to be profiled
+  submitted_at = None
+  condition = None
+
+  def __init__(self, id, code, mode = "vm", state = None, session = None, profile = False):
+    self.id = id
+    self.session = session
+    self.code = code
+    self.mode = mode
+    if profile:
+      #Profiling needs the statements the VM compiles away
+      self.mode = "tree"
+      self.profiler = profiler.Profiler()
+    self.status = QUEUED
+    self.submitted_at = time.time()
+    self.lines = []
+    self.condition = threading.Condition()
+    self.state = state if state is not None else interpreter.RunState()
+
+  # Jobs stand in for the log list handed to resetGlobalScope, so print lands here.
+  def append(self, line):
+    with self.condition:
+      self.lines.append(line)
+      self.condition.notify_all()
+
+  def finish(self, status, error = None):
+    with self.condition:
+      self.status = status
+      self.error = error
+      self.condition.notify_all()
+
+  def finished(self):
+    return self.status in FINISHED
+
+  def cancel(self):
+    #Ask the job to stop. A queued job never starts; a running one stops at its next loop iteration or call.
+    with self.condition:
+      self.state.cancel()
+      if self.status == QUEUED:
+        self.status = CANCELLED
+        self.condition.notify_all()
+
+  def wait(self, since = 0, timeout = None):
+    #Block until there are lines past since or the job has finished; return (new lines, finished).
+    with self.condition:
+      if len(self.lines) <= since and not self.finished():
+        self.condition.wait(timeout)
+      return (self.lines[since:], self.finished())
+
+  def join(self):
+    with self.condition:
+      while not self.finished():
+        self.condition.wait()
+
+  def reply(self):
+    #The old synchronous /code reply.
+    with self.condition:
+      reply = {'success': self.status == DONE, 'status': self.status, 'response': '\n'.join(self.lines)}
+      if self.error is not None:
+        reply['response'] = str(self.error)
+        reply['error'] = self.error.toDict()
+      if self.optimizer is not None:
+        reply['optimizer'] = self.optimizer
+      if self.profiler is not None and self.finished():
+        reply['profile'] = self.profiler.toDict(self.code)
+      return reply
+
+  def toDict(self):
+    with self.condition:
+      status = {'job': self.id, 'status': self.status, 'mode': self.mode, 'lines': len(self.lines)}
+      if self.error is not None:
+        status['error'] = self.error.toDict()
+      if self.optimizer is not None:
+        status['optimizer'] = self.optimizer
+      if self.profiler is not None and self.finished():
+        status['profile'] = self.profiler.toDict(self.code)
+      return status
+
+class JobRunner:
+  #Fields
+  parse_cache = None
+  queue = None
+  jobs = None    # Job id -> Job, oldest first
+  history = 50   # How many finished jobs to remember
+  limits = None  # RunState arguments: max_steps, max_seconds, max_depth and max_listen
+  sessions = None # Session name -> interpreter.Session, least recently used first
+  max_sessions = 32
+  lock = None
+  counter = None
+  thread = None
+
+  def __init__(self, parse_cache, history = 50, limits = {}):
+    self.parse_cache = parse_cache
+    self.history = history
+    self.limits = dict(limits)
+    self.sessions = OrderedDict()
+    self.queue = Queue.Queue()
+    self.jobs = OrderedDict()
+    self.lock = threading.Lock()
+    self.counter = itertools.count(1)
+
+  def start(self):
+    self.thread = threading.Thread(target = self.work, name = "naoscript-jobs")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, code, mode = "vm", session = None, profile = False):
+    #Queue a program. Programs submitted with the same session name share their variables.
+    with self.lock:
+      job = Job(str(self.counter.next()), code, mode, interpreter.RunState(**self.limits), session, profile)
+      # A program left listening for `when` events stops as soon as someone else's is queued
+      job.state.yielding = self.waiting
+      self.jobs[job.id] = job
+      self.forget()
+    self.queue.put(job)
+    return job
+
+  def waiting(self):
+    #Whether any job is queued to run.
+    return any(not job.finished() for job in list(self.queue.queue))
+
+  def get(self, id):
+    with self.lock:
+      return self.jobs.get(id)
+
+  def cancel(self, id):
+    job = self.get(id)
+    if job is not None:
+      if job.status == RUNNING:
+        #Moves the program queued but the robot hasn't started yet are dropped too
+        interpreter.motion_scheduler.clear()
+      job.cancel()
+    return job
+
+  def session(self, name):
+    #Return the named session, making it if need be. None gets a fresh one.
+    if name is None:
+      return interpreter.Session(limits = self.limits)
+    with self.lock:
+      session = self.sessions.pop(name, None)
+      if session is None:
+        session = interpreter.Session(limits = self.limits)
+      self.sessions[name] = session
+      while len(self.sessions) > self.max_sessions:
+        self.sessions.popitem(last = False)
+      return session
+
+  def resetSession(self, name):
+    with self.lock:
+      return self.sessions.pop(name, None) is not None
+
+  def forget(self):
+    #Drop the oldest finished jobs beyond the history limit. Call with the lock held.
+    finished = [id for id, job in self.jobs.iteritems() if job.finished()]
+    for id in finished[:max(0, len(finished) - self.history)]:
+      del self.jobs[id]
+
+  def work(self):
+    while True:
+      job = self.queue.get()
+      if job.finished():
+        continue # Cancelled while queued
+      start = time.time()
+      wait_seconds.observe(start - job.submitted_at)
+      try:
+        self.run(job)
+      except Exception, e:
+        logger.error("Job %s crashed:\n%s", job.id, traceback.format_exc())
+        job.finish(FAILED, interpreter.ScriptError("runtime", "Internal error: %s" % e))
+      run_seconds.observe(time.time() - start, job.mode, job.status)
+      if recording.trace is not None:
+        recording.trace.finished(job)
+
+  def run(self, job):
+    with job.condition:
+      if job.finished():
+        return
+      job.status = RUNNING
+      job.condition.notify_all()
+    session = self.session(job.session).start(log = job, state = job.state)
+    try:
+      # Programs sharing a session's variables can't have them, or builtins it may rebind, folded away
+      program = self.parse_cache.get(job.code, session.names() if job.session is not None else None)
+    except interpreter.ParseError, e:
+      job.finish(FAILED, interpreter.ScriptError("parse", str(e) if e.line is None else "Line %d: %s" % (e.line, e)))
+      return
+    interpreter.speech_cache.warm(program.phrases)
+    try:
+      with session:
+        if job.profiler is not None:
+          job.profiler.run(session, program.expressions)
+        elif job.mode == "tree":
+          #The reference tree walker, kept for comparing results against the VM
+          session.evaluate(program.expressions)
+        else:
+          job.optimizer = program.report.toDict()
+          vm.runInSession(program.code, session)
+        #The program isn't done until the robot has finished moving
+        session.finishMotion()
+    except (interpreter.Cancelled, motion.Cancelled):
+      job.finish(CANCELLED)
+      return
+    except interpreter.ScriptError, e:
+      job.finish(FAILED, e)
+      return
+    except Exception, e:
+      if isinstance(e, RuntimeError) and 'recursion' in str(e):
+        job.finish(FAILED, interpreter.ScriptError("depth", "The program nested too deeply, so it was stopped."))
+      else:
+        #Mistakes like adding a number to nothing surface as Python errors from the builtins
+        job.finish(FAILED, interpreter.ScriptError("runtime", "%s: %s" % (e.__class__.__name__, e)))
+      return
+    job.finish(DONE)
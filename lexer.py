@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+  Regular-expression lexer for NaoScript lines.
+
+  A line splits into strings, parentheses, runs of letters and digits, and
+  runs of any other characters except spaces (operators and commas). Inside
+  a string, backslashes are dropped and the next quote always ends it. An
+  unterminated string runs to the end of the line.
+"""
+import re
+
+STRING = "string"
+NUMBER = "number"
+NAME = "name"
+OPEN = "open"
+CLOSE = "close"
+SYMBOL = "symbol"
+
+# "Letters and digits" means str.isalnum, which is \w without the underscore.
+# For str that is ASCII only; unicode lines use the Unicode definition, just as isalnum does.
+TOKEN_PATTERN = r'(?P<string>"[^"]*"?)|(?P<open>\()|(?P<close>\))|(?P<word>[^\W_]+)|(?P<symbol>(?:[^\w ()"]|_)+)'
+TEXT_PATTERN = r'"[^"]*"?|[()]|[^\W_]+|(?:[^\w ()"]|_)+'
+
+token_regex = re.compile(TOKEN_PATTERN)
+text_regex = re.compile(TEXT_PATTERN)
+unicode_token_regex = re.compile(TOKEN_PATTERN, re.UNICODE)
+unicode_text_regex = re.compile(TEXT_PATTERN, re.UNICODE)
+
+class Token:
+  #Fields
+  kind = None
+  text = None
+  line = 0
+  column = 0
+
+  def __init__(self, kind, text, line, column):
+    self.kind = kind
+    self.text = text
+    self.line = line
+    self.column = column
+
+  def __repr__(self):
+    return "Token(%s, %r, %d:%d)" % (self.kind, self.text, self.line, self.column)
+
+def unescape(text):
+  # Backslashes inside strings are dropped rather than escaping anything.
+  return text.replace('\\', '') if '\\' in text else text
+
+def tokenize(line, line_number = 0, offset = 0):
+  # Return the typed tokens of a line. offset is added to each column, for
+  # callers that have already stripped the indentation.
+  regex = unicode_token_regex if isinstance(line, unicode) else token_regex
+  tokens = []
+  for match in regex.finditer(line):
+    kind = match.lastgroup
+    text = match.group()
+    if kind == "string":
+      kind = STRING
+      text = unescape(text)
+    elif kind == "word":
+      kind = NUMBER if text.isdigit() else NAME
+    elif kind == "open":
+      kind = OPEN
+    elif kind == "close":
+      kind = CLOSE
+    else:
+      kind = SYMBOL
+    tokens.append(Token(kind, text, line_number, match.start() + offset))
+  return tokens
+
+def tokenTexts(line):
+  # Return just the text of each token; this is what the parser consumes.
+  regex = unicode_text_regex if isinstance(line, unicode) else text_regex
+  texts = regex.findall(line)
+  if '\\' in line:
+    texts = [unescape(text) if text[0] == '"' else text for text in texts]
+  return texts
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+  Counters and histograms for the whole server, served at /metrics in the
+  Prometheus text format.
+
+  Each module declares the metrics it records at import time, with the names
+  of their labels:
+
+    requests = metrics.counter("naoscript_http_requests_total", "Requests served", ("route", "status"))
+    requests.inc("/code", "200")
+
+  Histograms count observations into fixed buckets, so recording one is a
+  bisect and a few additions under a lock, cheap enough to leave on
+  everywhere. Numbers other objects already keep (cache sizes, queue
+  lengths) are read when /metrics is requested, through gauge callbacks;
+  counts they keep that only go up (cache hits, rejected connections) are
+  read the same way but exported as counters, with names ending in _total:
+
+    metrics.countedBy("naoscript_parse_cache_hits_total", "Parse cache hits", lambda: cache.hits)
+"""
+import time
+import bisect
+import threading
+
+# Upper bounds in seconds, from a fast robot call to a long program.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labelText(names, values, extra = None):
+  #'{a="1",b="2"}' for label names and values, plus an extra (name, value), or '' for none.
+  pairs = ['%s="%s"' % (name, escape(value)) for name, value in zip(names, values)]
+  if extra is not None:
+    pairs.append('%s="%s"' % extra)
+  return '{%s}' % ','.join(pairs) if len(pairs) > 0 else ''
+
+def number(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) and value != int(value) else str(int(value))
+
+class Counter:
+  #Fields
+  name = None
+  help = None
+  labels = ()
+  values = None # Label values -> count
+  lock = None
+
+  def __init__(self, name, help, labels = ()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def inc(self, *labels):
+    self.add(1, *labels)
+
+  def add(self, amount, *labels):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def get(self, *labels):
+    with self.lock:
+      return self.values.get(labels, 0)
+
+  def text(self):
+    with self.lock:
+      values = sorted(self.values.iteritems())
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+    for labels, value in values:
+      lines.append('%s%s %s' % (self.name, labelText(self.labels, labels), number(value)))
+    return lines
+
+class Timer:
+  # Observes how long a with block takes.
+
+  #Fields
+  histogram = None
+  labels = ()
+  start = 0.0
+
+  def __init__(self, histogram, labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, kind, value, traceback):
+    self.histogram.observe(time.time() - self.start, *self.labels)
+
+class Histogram:
+  #Fields
+  name = None
+  help = None
+  labels = ()
+  buckets = DEFAULT_BUCKETS
+  values = None # Label values -> [count in each bucket (the last for above them all), sum, count]
+  lock = None
+
+  def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.buckets = tuple(sorted(buckets))
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def observe(self, value, *labels):
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      series = self.values.get(labels)
+      if series is None:
+        series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+      series[0][index] += 1
+      series[1] += value
+      series[2] += 1
+
+  def time(self, *labels):
+    return Timer(self, labels)
+
+  def count(self, *labels):
+    with self.lock:
+      series = self.values.get(labels)
+      return series[2] if series is not None else 0
+
+  def text(self):
+    with self.lock:
+      values = sorted((labels, [list(series[0]), series[1], series[2]]) for labels, series in self.values.iteritems())
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+    for labels, (counts, total, count) in values:
+      cumulative = 0
+      for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+        cumulative += bucket
+        lines.append('%s_bucket%s %d' % (self.name, labelText(self.labels, labels, ('le', number(bound))), cumulative))
+      lines.append('%s_sum%s %s' % (self.name, labelText(self.labels, labels), repr(total)))
+      lines.append('%s_count%s %d' % (self.name, labelText(self.labels, labels), count))
+    return lines
+
+class Gauge:
+  # A value read when the metrics are, from function(). With labels, function
+  # returns a dict from label values to values.
+
+  #Fields
+  name = None
+  help = None
+  labels = ()
+  function = None
+  kind = 'gauge'
+
+  def __init__(self, name, help, function, labels = ()):
+    self.name = name
+    self.help = help
+    self.function = function
+    self.labels = tuple(labels)
+
+  def text(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+    value = self.function()
+    if len(self.labels) == 0:
+      value = {(): value}
+    for labels, amount in sorted(value.iteritems()):
+      if amount is not None:
+        lines.append('%s%s %s' % (self.name, labelText(self.labels, labels), number(amount)))
+    return lines
+
+class CountedBy(Gauge):
+  # A counter kept by another object, read from function() like a gauge.
+
+  #Fields
+  kind = 'counter'
+
+class Registry:
+  #Fields
+  metrics = None # Name -> metric
+  order = None   # Their names, in the order they were registered
+  lock = None
+
+  def __init__(self):
+    self.metrics = {}
+    self.order = []
+    self.lock = threading.Lock()
+
+  def register(self, metric):
+    #Add a metric. A gauge, or a counter read like one, registered again under the same name replaces the old one.
+    with self.lock:
+      if metric.name in self.metrics and not isinstance(metric, Gauge):
+        raise ValueError("Metric %s is already registered" % metric.name)
+      if metric.name not in self.metrics:
+        self.order.append(metric.name)
+      self.metrics[metric.name] = metric
+    return metric
+
+  def text(self):
+    #Every metric in the Prometheus text exposition format.
+    with self.lock:
+      metrics = [self.metrics[name] for name in self.order]
+    lines = []
+    for metric in metrics:
+      try:
+        lines.extend(metric.text())
+      except Exception, e:
+        lines.append('# %s unavailable: %s' % (metric.name, escape(e)))
+    return '\n'.join(lines) + '\n'
+
+# Every metric the server exposes.
+registry = Registry()
+
+def counter(name, help, labels = ()):
+  return registry.register(Counter(name, help, labels))
+
+def histogram(name, help, labels = (), buckets = DEFAULT_BUCKETS):
+  return registry.register(Histogram(name, help, labels, buckets))
+
+def gauge(name, help, function, labels = ()):
+  return registry.register(Gauge(name, help, function, labels))
+
+def countedBy(name, help, function, labels = ()):
+  return registry.register(CountedBy(name, help, function, labels))
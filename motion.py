@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+  A single thread that owns the robot's motion and behavior proxies.
+
+  Programs used to call ALMotion directly, re-stiffening and re-initialising
+  the walk before every step, and two programs running at once would send it
+  interleaved commands. Now walk, turn, relax and the behaviors are queued on
+  the MotionScheduler, which runs them one at a time in order and hands back
+  a Future for each, so a program can keep talking while the robot moves.
+
+  The scheduler remembers whether the body is stiff and the walk initialised,
+  and only sends stiffnessInterpolation/walkInit when that has changed.
+  Consecutive small straight walks (and consecutive small turns) still
+  waiting in the queue are sent as one walkTo, saving the robot from
+  stopping and starting between steps. Bigger moves are sent as they are.
+"""
+import math
+import time
+import threading
+import collections
+import logging
+
+logger = logging.getLogger("naoscript.motion")
+
+# The largest walk (metres) and turn (radians) merged with their neighbours
+MERGE_STEP = 0.3
+MERGE_TURN = math.pi / 2
+
+class Cancelled(Exception):
+  # Raised by Future.wait for commands dropped from the queue before they ran.
+  pass
+
+class Future:
+  #Fields
+  name = None
+  done = None   # threading.Event, set once the command has run (or been dropped)
+  result = None
+  error = None
+  finished_at = None
+
+  def __init__(self, name):
+    self.name = name
+    self.done = threading.Event()
+
+  def resolve(self, result = None, error = None):
+    self.result = result
+    self.error = error
+    self.finished_at = time.time()
+    self.done.set()
+
+  def finished(self):
+    return self.done.is_set()
+
+  def wait(self):
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+  def __str__(self):
+    return "<%s %s>" % (self.name, "done" if self.finished() else "pending")
+
+class Command:
+  #Fields
+  kind = None   # "walk", "relax" or "behavior"
+  x = 0.0       # Metres forward, for walks
+  theta = 0.0   # Radians anticlockwise, for walks
+  behavior = None
+  futures = None # Every Future this command answers, more than one once merged
+  small = False  # Whether it was a walk small enough to merge when it was queued
+
+  def __init__(self, kind, future, x = 0.0, theta = 0.0, behavior = None):
+    self.kind = kind
+    self.x = x
+    self.theta = theta
+    self.behavior = behavior
+    self.futures = [future]
+    self.small = kind == "walk" and abs(x) <= MERGE_STEP and abs(theta) <= MERGE_TURN
+
+  def merges(self, other):
+    #Whether other can be folded into this one: both small straight walks, or both small turns on the spot.
+    if not self.small or not other.small:
+      return False
+    return (self.theta == 0 and other.theta == 0) or (self.x == 0 and other.x == 0)
+
+class MotionScheduler:
+  #Fields
+  walkproxy = None
+  bmproxy = None
+  queue = None     # Commands not yet started
+  condition = None
+  thread = None
+  stiff = False       # Whether we have stiffened the body since it last relaxed or ran a behavior
+  walk_ready = False  # Whether walkInit has run since then
+  merged = 0          # How many commands were folded into an earlier one
+  skipped = 0         # How many stiffness/init calls were not needed
+
+  def __init__(self, walkproxy, bmproxy):
+    self.walkproxy = walkproxy
+    self.bmproxy = bmproxy
+    self.queue = collections.deque()
+    self.condition = threading.Condition()
+    self.stiff = False
+    self.walk_ready = False
+    self.merged = 0
+    self.skipped = 0
+
+  def start(self):
+    self.thread = threading.Thread(target = self.work, name = "naoscript-motion")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, command):
+    with self.condition:
+      if self.thread is None:
+        self.start()
+      self.queue.append(command)
+      self.condition.notify_all()
+    return command.futures[0]
+
+  def walk(self, x, theta):
+    return self.submit(Command("walk", Future("walk" if theta == 0 else "turn"), x = x, theta = theta))
+
+  def relax(self):
+    return self.submit(Command("relax", Future("relax")))
+
+  def behavior(self, name):
+    return self.submit(Command("behavior", Future(name), behavior = name))
+
+  def clear(self):
+    #Drop every command that hasn't started. Their futures raise Cancelled.
+    with self.condition:
+      dropped = list(self.queue)
+      self.queue.clear()
+    for command in dropped:
+      for future in command.futures:
+        future.resolve(error = Cancelled())
+
+  def stats(self):
+    with self.condition:
+      return {'queued': len(self.queue), 'merged': self.merged, 'skipped': self.skipped}
+
+  def next(self):
+    #Take the next command off the queue, folding in any mergeable walks right behind it.
+    with self.condition:
+      while len(self.queue) == 0:
+        self.condition.wait()
+      command = self.queue.popleft()
+      while len(self.queue) > 0 and command.merges(self.queue[0]):
+        following = self.queue.popleft()
+        command.x += following.x
+        command.theta += following.theta
+        command.futures.extend(following.futures)
+        self.merged += 1
+      return command
+
+  def work(self):
+    while True:
+      command = self.next()
+      try:
+        result = self.run(command)
+      except Exception, e:
+        logger.error("Motion command %s failed: %s", command.kind, e)
+        for future in command.futures:
+          future.resolve(error = e)
+        continue
+      for future in command.futures:
+        future.resolve(result)
+
+  def run(self, command):
+    if command.kind == "walk":
+      if self.stiff:
+        self.skipped += 1
+      else:
+        self.walkproxy.stiffnessInterpolation("Body", 1, 0.1)
+        self.stiff = True
+      if self.walk_ready:
+        self.skipped += 1
+      else:
+        self.walkproxy.walkInit()
+        self.walk_ready = True
+      self.walkproxy.walkTo(command.x, 0, command.theta)
+    elif command.kind == "relax":
+      self.walkproxy.stiffnessInterpolation("Body", 0, 0.1)
+      self.stiff = False
+      self.walk_ready = False
+    elif command.kind == "behavior":
+      #Behaviors set their own stiffness and posture, so assume nothing afterwards
+      self.stiff = False
+      self.walk_ready = False
+      self.bmproxy.runBehavior(command.behavior)
+    return True
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+  Constant folding and dead-branch elimination for parsed NaoScript.
+
+  optimize takes the Expression list from interpreter.fullParse and returns a
+  new, equivalent list (the input is left untouched) along with a report of
+  what was removed. It:
+
+    * calls builtins from interpreter.pure_builtins on constant arguments,
+    * replaces if/else statements whose condition is constant with the block
+      that would run, and drops loops whose condition is constantly false,
+    * replaces reads of variables that are assigned a constant exactly once,
+      unconditionally at the top level, with that constant.
+
+  Only names the program never assigns or takes as a parameter are treated as
+  builtins, and only the pure ones are ever called, so say, walk, print and
+  the sensor reads always run when the program does.
+
+  A program run in a session (optimize with bound) shares its variables with
+  the session's earlier and later programs. Names the session has already
+  bound are left alone like assigned ones, top-level variables are never
+  inlined, since a later program may assign them again before a function
+  reads them, and the bodies of functions and `when` blocks, which may run
+  after a later program has rebound a builtin, keep their builtin reads and
+  calls.
+"""
+import interpreter
+from interpreter import Expression
+
+class OptimizationReport:
+  #Fields
+  nodes_before = 0
+  nodes_after = 0
+  folded = 0
+  branches_removed = 0
+  loops_removed = 0
+  reads_inlined = 0
+
+  def eliminated(self):
+    return self.nodes_before - self.nodes_after
+
+  def toDict(self):
+    return {
+      'nodes_before': self.nodes_before,
+      'nodes_after': self.nodes_after,
+      'eliminated': self.eliminated(),
+      'folded': self.folded,
+      'branches_removed': self.branches_removed,
+      'loops_removed': self.loops_removed,
+      'reads_inlined': self.reads_inlined,
+    }
+
+def countNodes(block):
+  count = 0
+  for expression in block:
+    count += countExpression(expression)
+  return count
+
+def countExpression(expression):
+  manner = expression.manner
+  if manner == 0:
+    return 1
+  elif manner == 1:
+    return 1 + countNodes(expression.value[1])
+  elif manner == 2:
+    return 1 + countExpression(expression.value[1])
+  elif manner == 3:
+    return 1 + countNodes(expression.value[2])
+  elif manner == 4:
+    return 1 + countExpression(expression.value[0]) + countNodes(expression.value[1])
+  elif manner == 5:
+    return 1 + countExpression(expression.value[0]) + countNodes(expression.value[1]) + (countNodes(expression.value[2]) if expression.value[2] is not None else 0)
+  elif manner == 6:
+    return 1 + countExpression(expression.value)
+  elif manner == 8:
+    return 1 + countExpression(expression.value[0]) + countNodes(expression.value[1])
+  return 1
+
+def countAssignments(block, counts):
+  # Count how many places bind each name: assignments, function definitions and parameters.
+  for expression in block:
+    countExpressionAssignments(expression, counts)
+  return counts
+
+def countExpressionAssignments(expression, counts):
+  manner = expression.manner
+  if manner == 1:
+    countAssignments(expression.value[1], counts)
+  elif manner == 2:
+    counts[expression.value[0]] = counts.get(expression.value[0], 0) + 1
+    countExpressionAssignments(expression.value[1], counts)
+  elif manner == 3:
+    for name in [expression.value[0]] + list(expression.value[1]):
+      counts[name] = counts.get(name, 0) + 1
+    countAssignments(expression.value[2], counts)
+  elif manner == 4:
+    countExpressionAssignments(expression.value[0], counts)
+    countAssignments(expression.value[1], counts)
+  elif manner == 5:
+    countExpressionAssignments(expression.value[0], counts)
+    countAssignments(expression.value[1], counts)
+    if expression.value[2] is not None:
+      countAssignments(expression.value[2], counts)
+  elif manner == 6:
+    countExpressionAssignments(expression.value, counts)
+  elif manner == 8:
+    countExpressionAssignments(expression.value[0], counts)
+    countAssignments(expression.value[1], counts)
+
+class Optimizer:
+  #Fields
+  assigned = None # Name -> number of places that bind it
+  bound = ()      # Names bound before the program runs, by the session it runs in
+  session = False # Whether the program runs in a session
+  deferred = 0    # How many function or `when` bodies deep we are
+  report = None
+
+  def __init__(self, expressions, bound = None):
+    self.assigned = countAssignments(expressions, {})
+    self.session = bound is not None
+    self.bound = frozenset(bound or ())
+    self.report = OptimizationReport()
+
+  def foldable(self):
+    #Whether builtins can be taken as they are now. In a session, code that runs later may find them rebound.
+    return not self.session or self.deferred == 0
+
+  def isConstant(self, expression):
+    return expression.manner == 0
+
+  def expression(self, expression, known):
+    # Return an optimized copy of an expression. known maps variables to their inlined constants.
+    manner = expression.manner
+    if manner == 0:
+      return expression
+
+    elif manner == 1:
+      name, args = expression.value
+      args = [self.expression(arg, known) for arg in args]
+      if name in known:
+        # The variable holds a constant, which is never a function, so any arguments would be ignored anyway.
+        self.report.reads_inlined += 1
+        return Expression(0, known[name])
+      if name in self.assigned or name in self.bound or not self.foldable():
+        return Expression(1, (name, args))
+      if len(args) == 0 and name in interpreter.builtin_constants:
+        self.report.reads_inlined += 1
+        return Expression(0, interpreter.builtin_constants[name])
+      if name in interpreter.pure_builtins and len(args) > 0 and all(self.isConstant(arg) for arg in args):
+        if name == "*" and any(isinstance(arg.value, basestring) for arg in args):
+          # Repeating a string could build something huge for a line that never runs.
+          return Expression(1, (name, args))
+        try:
+          value = interpreter.pure_builtins[name].call([arg.value for arg in args])
+        except Exception:
+          # Leave it for the program to fail on when (and if) it actually runs.
+          return Expression(1, (name, args))
+        self.report.folded += 1
+        return Expression(0, value)
+      return Expression(1, (name, args))
+
+    elif manner == 2:
+      # An assignment used as a function argument.
+      return self.statement(expression, known, False)[0]
+    return expression
+
+  def statement(self, expression, known, top_level):
+    # Return the optimized statements that replace this one (possibly none, possibly a whole block).
+    manner = expression.manner
+
+    if manner == 0 or manner == 1:
+      return [self.expression(expression, known)]
+
+    elif manner == 2: # Definition
+      name = expression.value[0]
+      value = self.expression(expression.value[1], known)
+      if top_level and not self.session and self.isConstant(value) and self.assigned.get(name) == 1:
+        known[name] = value.value
+      return [Expression(2, (name, value))]
+
+    elif manner == 3: # Function construction
+      name, arguments, block = expression.value
+      return [Expression(3, (name, arguments, self.deferredBlock(block, known)))]
+
+    elif manner == 4: # Loop
+      condition = self.expression(expression.value[0], known)
+      if self.isConstant(condition) and not condition.value:
+        self.report.loops_removed += 1
+        return []
+      return [Expression(4, (condition, self.block(expression.value[1], known)))]
+
+    elif manner == 5: # Conditional
+      condition = self.expression(expression.value[0], known)
+      if self.isConstant(condition):
+        self.report.branches_removed += 1
+        chosen = expression.value[1] if condition.value else expression.value[2]
+        if chosen is None:
+          return []
+        # The chosen block runs unconditionally now, so it keeps our top-levelness.
+        return self.block(chosen, known, top_level)
+      else_block = self.block(expression.value[2], known) if expression.value[2] is not None else None
+      return [Expression(5, (condition, self.block(expression.value[1], known), else_block))]
+
+    elif manner == 6: # Return statement
+      return [Expression(6, self.expression(expression.value, known))]
+
+    elif manner == 8: # Event handler
+      # Like a function body, the condition and block run later, after whatever follows them.
+      known = dict(known)
+      self.deferred += 1
+      try:
+        return [Expression(8, (self.expression(expression.value[0], known), self.block(expression.value[1], known)))]
+      finally:
+        self.deferred -= 1
+
+    return [expression]
+
+  def deferredBlock(self, block, known):
+    #Optimize the body of a function or `when` block, which runs after whatever follows it.
+    self.deferred += 1
+    try:
+      return self.block(block, dict(known))
+    finally:
+      self.deferred -= 1
+
+  def block(self, block, known, top_level = False):
+    optimized = []
+    for expression in block:
+      for statement in self.statement(expression, known, top_level):
+        if statement.line is None:
+          statement.line = expression.line
+        optimized.append(statement)
+    return optimized
+
+def optimize(expressions, bound = None):
+  #Return (optimized expressions, OptimizationReport). For a program run in a
+  #session, bound is the names the session has bound so far.
+  optimizer = Optimizer(expressions, bound)
+  optimizer.report.nodes_before = countNodes(expressions)
+  optimized = optimizer.block(expressions, {}, top_level = True)
+  optimizer.report.nodes_after = countNodes(optimized)
+  return (optimized, optimizer.report)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+  A bounded LRU cache of parsed and compiled NaoScript programs.
+
+  Programs are keyed by the SHA-1 of their source text, so running a saved
+  program again skips the parser and the compiler. Programs that fail to parse
+  are cached too, and raise the same ParseError every time. The cache can be
+  saved to disk and loaded again when the server restarts.
+"""
+import os
+import hashlib
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+import interpreter
+import optimizer
+import vm
+import speech
+import metrics
+from interpreter import ParseError
+
+# Bump this whenever the parser or compiler changes what they produce, so stale entries are discarded.
+CACHE_VERSION = 9
+
+stage_seconds = metrics.histogram("naoscript_parse_seconds", "Time taken to parse, optimize and compile programs the cache didn't have", ("stage",))
+
+class Program:
+  #Fields
+  expressions = None # The unoptimized Expression list from fullParse, for the reference tree walker
+  code = None        # The optimized, compiled vm.Code
+  report = None      # The optimizer.OptimizationReport for this program
+  phrases = None     # The constant strings it says, to render before it runs
+
+  def __init__(self, expressions, code, report, phrases = []):
+    self.expressions = expressions
+    self.code = code
+    self.report = report
+    self.phrases = phrases
+
+class ParseCache:
+  #Fields
+  size = 0
+  path = None
+  hits = 0
+  misses = 0
+  entries = None
+  lock = None
+
+  def __init__(self, size = 128, path = None):
+    self.size = size
+    self.path = path
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    if path is not None:
+      self.load()
+
+  def get(self, text, bound = None):
+    #Return the Program for this source text, parsing it on a miss. Raises ParseError if it doesn't parse.
+    #For a program run in a session, bound is the names the session has bound so far.
+    key = hashlib.sha1(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+    if bound is not None:
+      # Only the builtins a session has rebound change how its programs are optimized
+      bound = sorted(name for name in bound if name in interpreter.builtin_state)
+      key += ' session ' + ' '.join(bound)
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None:
+        self.hits += 1
+        self.entries[key] = entry
+    if entry is None:
+      entry = self.build(text, bound)
+      with self.lock:
+        self.misses += 1
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+          self.entries.popitem(last = False)
+    if isinstance(entry, ParseError):
+      raise entry
+    return entry
+
+  def build(self, text, bound = None):
+    try:
+      with stage_seconds.time("parse"):
+        expressions = interpreter.fullParse(text)
+    except ParseError, e:
+      return e
+    except Exception, e:
+      # Anything else the parser trips over, such as a function line with no name, is a parse failure too.
+      return ParseError("Could not parse program: %s" % e)
+    with stage_seconds.time("optimize"):
+      optimized, report = optimizer.optimize(expressions, bound)
+    with stage_seconds.time("compile"):
+      code = vm.compileProgram(optimized)
+    return Program(expressions, code, report, speech.phrases(optimized))
+
+  def stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def load(self):
+    #Load entries saved by a previous run, ignoring a missing, corrupt or outdated file.
+    if not os.path.exists(self.path):
+      return
+    try:
+      cache_file = open(self.path, 'rb')
+      try:
+        version, entries = pickle.load(cache_file)
+      finally:
+        cache_file.close()
+    except Exception:
+      return
+    if version != CACHE_VERSION:
+      return
+    with self.lock:
+      for key, entry in entries:
+        self.entries[key] = entry
+      while len(self.entries) > self.size:
+        self.entries.popitem(last = False)
+
+  def save(self):
+    #Write the entries out, oldest first, through a temporary file so a crash can't leave half a cache.
+    if self.path is None:
+      return
+    with self.lock:
+      entries = self.entries.items()
+    temporary_path = self.path + '.tmp'
+    cache_file = open(temporary_path, 'wb')
+    try:
+      pickle.dump((CACHE_VERSION, entries), cache_file, pickle.HIGHEST_PROTOCOL)
+    finally:
+      cache_file.close()
+    os.rename(temporary_path, self.path)
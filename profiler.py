@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+  Where a NaoScript program spends its time.
+
+  A Profiler records, for one run, how many times each source line ran and
+  how long it took (including everything it called), and how many times each
+  builtin was called and how long those calls took. It also keeps the time
+  spent in every stack of function lines and builtins, which folded() writes
+  in the "frame;frame;frame microseconds" format flame graph tools read.
+
+  Profiled runs use the tree walker: instrument() wraps each statement of the
+  parsed program in a profiled statement, and run() puts timed copies of the
+  builtins between the session's scope and the real ones for as long as the
+  program runs. Programs that aren't profiled pay nothing for any of this.
+"""
+import time
+
+import interpreter
+from interpreter import Expression, NativeFunction, Stack
+
+class Profiler:
+  #Fields
+  lines = None     # Line number -> [hits, seconds]
+  builtins = None  # Builtin name -> [calls, seconds]
+  stacks = None    # "frame;frame;..." -> seconds spent in the last frame itself
+  stack = None     # Frame names, outermost first
+  children = None  # Seconds spent in what each frame on the stack called so far
+  active = None    # Line number -> how many times it is on the stack, so recursion isn't counted twice
+  seconds = 0.0    # How long the whole run took
+  clock = time.time
+
+  def __init__(self):
+    self.lines = {}
+    self.builtins = {}
+    self.stacks = {}
+    self.stack = []
+    self.children = []
+    self.active = {}
+
+  def enter(self, frame):
+    self.stack.append(frame)
+    self.children.append(0.0)
+    return self.clock()
+
+  def leave(self, start):
+    #Pop the innermost frame, charging its own time to its stack. Returns how long it took.
+    elapsed = self.clock() - start
+    key = ";".join(self.stack)
+    self.stacks[key] = self.stacks.get(key, 0.0) + elapsed - self.children.pop()
+    self.stack.pop()
+    if len(self.children) > 0:
+      self.children[-1] += elapsed
+    return elapsed
+
+  def statement(self, frame, expression, closure):
+    #Evaluate one instrumented statement.
+    line = expression.line
+    stats = self.lines.get(line)
+    if stats is None:
+      stats = self.lines[line] = [0, 0.0]
+    stats[0] += 1
+    self.active[line] = self.active.get(line, 0) + 1
+    start = self.enter(frame)
+    try:
+      return expression.evaluate(closure)
+    finally:
+      elapsed = self.leave(start)
+      self.active[line] -= 1
+      if self.active[line] == 0:
+        stats[1] += elapsed
+
+  def builtin(self, name, function, args):
+    stats = self.builtins.get(name)
+    if stats is None:
+      stats = self.builtins[name] = [0, 0.0]
+    stats[0] += 1
+    start = self.enter(name)
+    try:
+      return function.call(args)
+    finally:
+      stats[1] += self.leave(start)
+
+  def timed(self, name, function):
+    return NativeFunction(lambda args: self.builtin(name, function, args), name)
+
+  def instrument(self, block, function = "main"):
+    #Return a copy of a parsed block with every statement profiled. Frames are named
+    #after the function the statement is in and its line, as in "fib:4".
+    instrumented = []
+    for expression in block:
+      manner = expression.manner
+      if manner == 3:
+        name, arguments, body = expression.value
+        copy = Expression(3, (name, arguments, self.instrument(body, name)), line = expression.line)
+      elif manner == 4:
+        copy = Expression(4, (expression.value[0], self.instrument(expression.value[1], function)), line = expression.line)
+      elif manner == 5:
+        condition, if_block, else_block = expression.value
+        copy = Expression(5, (condition, self.instrument(if_block, function), self.instrument(else_block, function) if else_block is not None else None), line = expression.line)
+      elif manner == 8:
+        copy = Expression(8, (expression.value[0], self.instrument(expression.value[1], "when:%d" % expression.line)), line = expression.line)
+      else:
+        copy = expression
+      if expression.line is not None:
+        copy = Expression(7, (self, "%s:%d" % (function, expression.line), copy), line = expression.line)
+      instrumented.append(copy)
+    return instrumented
+
+  def run(self, session, expressions):
+    #Run parsed lines with the tree walker in an entered session, profiling them, and wait for the robot to finish moving.
+    timed = {}
+    for name, value in interpreter.builtin_scope.state.iteritems():
+      if isinstance(value, NativeFunction):
+        timed[name] = self.timed(name, value)
+    builtins = session.scope.parent
+    session.scope.parent = Stack(builtins, state = timed)
+    start = self.enter("main")
+    try:
+      session.evaluate(self.instrument(expressions))
+      motion_start = self.enter("(robot moving)")
+      try:
+        session.finishMotion()
+      finally:
+        self.leave(motion_start)
+    finally:
+      session.scope.parent = builtins
+      self.seconds = self.leave(start)
+
+  def folded(self):
+    #The profile as folded stacks, one "frame;frame;frame microseconds" line each.
+    stacks = []
+    for key in sorted(self.stacks):
+      microseconds = int(round(self.stacks[key] * 1000000))
+      if microseconds > 0:
+        stacks.append("%s %d" % (key, microseconds))
+    return "\n".join(stacks) + "\n"
+
+  def toDict(self, source = None):
+    #The profile for a JSON reply. With the program's source, each line comes with its text.
+    texts = source.split("\n") if source is not None else []
+    lines = []
+    for number in sorted(self.lines):
+      hits, seconds = self.lines[number]
+      entry = {'line': number, 'hits': hits, 'seconds': seconds}
+      if 0 < number <= len(texts):
+        entry['text'] = texts[number - 1].strip()
+      lines.append(entry)
+    builtins = []
+    for name, (calls, seconds) in sorted(self.builtins.iteritems(), key = lambda item: -item[1][1]):
+      builtins.append({'name': name, 'calls': calls, 'seconds': seconds, 'mean_ms': seconds * 1000 / calls})
+    return {'seconds': self.seconds, 'lines': lines, 'builtins': builtins, 'folded': self.folded()}
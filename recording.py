@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+  Recording what the server asked of the robot, and playing it back later
+  without one.
+
+  record() wraps the configured backend so that every call through a
+  LazyProxy (walkTo, say, getListData, runBehavior, ...) is written to a
+  trace with its arguments, its result or error, when it was made and how
+  long it took. The server adds each /code submission to the same trace, the
+  jobs cancelled through /jobs/<id>/cancel, and the status each job finished
+  with.
+
+  A trace is gzipped JSON, one entry per line:
+
+    {"trace": 1, "started": ..., "options": {...}}     the header
+    {"t": 1.2, "c": "ALMotion.walkTo", "a": [0.1, 0, 0], "r": null, "s": 3.4}
+    {"t": 0.9, "code": "...", "mode": "vm", "session": "s1", "profile": false, "wait": false, "job": "4"}
+    {"t": 3.0, "cancel": "4"}
+    {"t": 5.1, "job": "4", "status": "cancelled", "s": 4.2}
+
+  where t is seconds since recording started and s how long the call or job
+  took. A failed call has "e", its message, instead of "r".
+
+  The replay backend (robot.configure("replay", trace = path)) answers calls
+  from a trace instead of a robot. Calls to each method are answered in the
+  order they were recorded, preferring the next recorded call with the same
+  arguments, since the motion and sensor threads interleave differently from
+  run to run. Once a method's recorded calls run out, its last answer is
+  given again. Answers take as long as they did on the robot, multiplied by
+  time_scale. benchmarks/replay.py feeds a trace's submissions and cancels
+  back to the server against this backend.
+"""
+import time
+import gzip
+import zlib
+import logging
+import threading
+import simplejson as json
+
+import robot
+
+logger = logging.getLogger("naoscript.recording")
+
+FORMAT = 1
+MATCH_WINDOW = 64 # How far ahead in a method's recorded calls to look for the same arguments
+
+# Methods that write a file on the robot, with the index of the path argument.
+# Replaying one creates the file empty, so whoever asked for it finds it.
+WRITES = {"ALTextToSpeech.sayToFile": 1}
+
+# The Trace being recorded to, if the server was started with --record
+trace = None
+
+def plain(value):
+  #value as it comes back from a trace: tuples as lists, and ASCII text as str rather than unicode.
+  if isinstance(value, (list, tuple)):
+    return [plain(item) for item in value]
+  if isinstance(value, dict):
+    return dict((plain(key), plain(item)) for key, item in value.iteritems())
+  if isinstance(value, unicode):
+    try:
+      return str(value)
+    except UnicodeEncodeError:
+      return value
+  return value
+
+class Trace:
+  #Fields
+  path = None
+  output = None
+  started = 0.0
+  calls = 0
+  lock = None
+
+  def __init__(self, path, options = None):
+    self.path = path
+    self.output = gzip.open(path, 'wb')
+    self.started = time.time()
+    self.lock = threading.Lock()
+    self.write({'trace': FORMAT, 'started': self.started, 'options': options or {}}, flush = True)
+
+  def write(self, entry, flush = False):
+    line = json.dumps(entry, separators = (',', ':'), default = repr) + '\n'
+    with self.lock:
+      if self.output is None:
+        return
+      self.output.write(line)
+      if flush:
+        # A sync flush, so a server that is killed leaves a trace that reads up to here
+        self.output.flush(zlib.Z_SYNC_FLUSH)
+
+  def call(self, module, method, args, start, seconds, result = None, error = None):
+    entry = {'t': start - self.started, 'c': module + '.' + method, 'a': args, 's': seconds}
+    if error is not None:
+      entry['e'] = error
+    else:
+      entry['r'] = result
+    with self.lock:
+      self.calls += 1
+    self.write(entry)
+
+  def submitted(self, job, wait = False):
+    self.write({'t': job.submitted_at - self.started, 'code': job.code, 'mode': job.mode, 'session': job.session,
+      'profile': job.profiler is not None, 'wait': wait, 'job': job.id}, flush = True)
+
+  def cancelled(self, job):
+    self.write({'t': time.time() - self.started, 'cancel': job.id}, flush = True)
+
+  def finished(self, job):
+    now = time.time()
+    self.write({'t': now - self.started, 'job': job.id, 'status': job.status, 's': now - job.submitted_at}, flush = True)
+
+  def close(self):
+    with self.lock:
+      if self.output is not None:
+        self.output.close()
+        self.output = None
+
+class RecordingModule:
+  # Passes calls to a module of another backend, writing each one to the trace.
+
+  #Fields
+  trace = None
+  module = None
+  proxy = None
+
+  def __init__(self, trace, module, proxy):
+    self.trace = trace
+    self.module = module
+    self.proxy = proxy
+
+  def __getattr__(self, name):
+    method = getattr(self.proxy, name)
+    trace = self.trace
+    module = self.module
+    def call(*args):
+      start = time.time()
+      try:
+        result = method(*args)
+      except Exception, e:
+        trace.call(module, name, args, start, time.time() - start, error = str(e))
+        raise
+      trace.call(module, name, args, start, time.time() - start, result = result)
+      return result
+    return call
+
+class RecordingRobot:
+  # A backend that records everything asked of another one.
+
+  #Fields
+  trace = None
+  inner = None
+  proxies = None
+  lock = None
+
+  def __init__(self, trace, inner):
+    self.trace = trace
+    self.inner = inner
+    self.proxies = {}
+    self.lock = threading.Lock()
+
+  def proxy(self, module):
+    with self.lock:
+      if module not in self.proxies:
+        self.proxies[module] = RecordingModule(self.trace, module, self.inner.proxy(module))
+      return self.proxies[module]
+
+def record(path, options = None):
+  #Start recording every call to the robot to a new trace at path, and return the Trace.
+  #options are the server settings a replay should copy.
+  global trace
+  trace = Trace(path, options)
+  robot.wrap(lambda inner: RecordingRobot(trace, inner))
+  logger.info("Recording robot calls to %s", path)
+  return trace
+
+def load(path):
+  #Return (header, entries) from a trace, up to wherever it was cut off.
+  entries = []
+  trace_file = gzip.open(path, 'rb')
+  try:
+    while True:
+      line = trace_file.readline()
+      if not line.endswith('\n'):
+        break
+      entries.append(plain(json.loads(line)))
+  except (IOError, EOFError, zlib.error):
+    # A server that was killed leaves no gzip trailer; everything flushed before then is still good
+    pass
+  finally:
+    trace_file.close()
+  if len(entries) == 0 or entries[0].get('trace') != FORMAT:
+    raise ValueError("%s is not a robot trace" % path)
+  return entries[0], entries[1:]
+
+def submissions(entries):
+  #The /code submissions in a trace, each with the 'status' and 'seconds' it finished with if it did.
+  found = [entry for entry in entries if 'code' in entry]
+  finishes = dict((entry['job'], entry) for entry in entries if 'status' in entry)
+  for entry in found:
+    finish = finishes.get(entry['job'])
+    entry['status'] = finish['status'] if finish is not None else None
+    entry['seconds'] = finish['s'] if finish is not None else None
+  return sorted(found, key = lambda entry: entry['t'])
+
+def cancels(entries):
+  #The /jobs/<id>/cancel requests in a trace, oldest first.
+  return sorted([entry for entry in entries if 'cancel' in entry], key = lambda entry: entry['t'])
+
+class ReplayModule:
+  # Stands in for one module, answering from the trace.
+
+  #Fields
+  robot = None
+  module = None
+
+  def __init__(self, robot, module):
+    self.robot = robot
+    self.module = module
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return lambda *args: self.robot.answer(self.module, name, args)
+
+class ReplayRobot:
+  # A backend that answers every call as a trace says the robot did.
+
+  #Fields
+  path = None
+  time_scale = 1.0
+  header = None
+  pending = None  # "Module.method" -> its recorded calls not yet answered, oldest first
+  last = None     # "Module.method" -> the call it was last answered with
+  proxies = None
+  served = 0      # Calls answered with a recorded call
+  repeated = 0    # Calls answered with the last answer again, the recorded ones having run out
+  unknown = 0     # Calls to methods the trace never saw, answered with None
+  lock = None
+
+  def __init__(self, trace, time_scale = 1.0):
+    self.path = trace
+    self.time_scale = float(time_scale)
+    self.header, entries = load(trace)
+    self.pending = {}
+    self.last = {}
+    self.proxies = {}
+    self.lock = threading.Lock()
+    for entry in entries:
+      if 'c' in entry:
+        self.pending.setdefault(entry['c'], []).append(entry)
+
+  def proxy(self, module):
+    with self.lock:
+      if module not in self.proxies:
+        self.proxies[module] = ReplayModule(self, module)
+      return self.proxies[module]
+
+  def answer(self, module, method, args):
+    key = module + '.' + method
+    arguments = plain(json.loads(json.dumps(args, default = repr)))
+    entry = None
+    with self.lock:
+      calls = self.pending.get(key)
+      if calls:
+        for index, candidate in enumerate(calls[:MATCH_WINDOW]):
+          if candidate['a'] == arguments:
+            entry = calls.pop(index)
+            break
+        else:
+          entry = calls.pop(0)
+        self.last[key] = entry
+        self.served += 1
+      elif key in self.last:
+        entry = self.last[key]
+        self.repeated += 1
+      else:
+        self.unknown += 1
+    if entry is None:
+      logger.warning("The trace has no calls to %s", key)
+      return None
+    if self.time_scale > 0 and entry['s'] > 0:
+      time.sleep(entry['s'] * self.time_scale)
+    if key in WRITES and len(args) > WRITES[key]:
+      open(args[WRITES[key]], 'wb').close()
+    if 'e' in entry:
+      raise RuntimeError(entry['e'])
+    return entry.get('r')
+
+  def stats(self):
+    with self.lock:
+      return {
+        'served': self.served,
+        'repeated': self.repeated,
+        'unknown': self.unknown,
+        'unused': sum(len(calls) for calls in self.pending.itervalues()),
+      }
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+  An interactive NaoScript prompt.
+
+  Each submission runs in the same interpreter.Session, so variables and
+  functions defined at the prompt stay defined. A line that opens a block
+  (while, if, else, function or when) keeps reading until a blank line.
+
+  Usage: python repl.py [--tree] [--simulator]
+"""
+import sys
+import interpreter
+import optimizer
+import vm
+import robot
+
+BLOCK_WORDS = ("while", "if", "else", "function", "when")
+
+def readSubmission(prompt = ">>> ", more = "... "):
+  # Return the next program typed in, or None at the end of input.
+  try:
+    line = raw_input(prompt)
+  except EOFError:
+    return None
+  lines = [line]
+  words = line.split()
+  if len(words) > 0 and words[0] in BLOCK_WORDS:
+    while True:
+      try:
+        line = raw_input(more)
+      except EOFError:
+        break
+      if line.strip() == "":
+        break
+      lines.append(line)
+  return "\n".join(lines)
+
+def submit(session, text, tree = False):
+  # Run one submission in the session and return its printed output.
+  log = []
+  session.start(log = log)
+  expressions = interpreter.fullParse(text)
+  with session:
+    if tree:
+      session.evaluate(expressions)
+    else:
+      optimized, report = optimizer.optimize(expressions, session.names())
+      vm.runInSession(vm.compileProgram(optimized), session)
+    session.finishMotion()
+  return log
+
+if __name__ == "__main__":
+  tree = "--tree" in sys.argv
+  if "--simulator" in sys.argv:
+    robot.configure("simulator")
+  session = interpreter.Session(limits = {'max_seconds': 600})
+  while True:
+    text = readSubmission()
+    if text is None:
+      print
+      break
+    if text.strip() == "":
+      continue
+    try:
+      for line in submit(session, text, tree):
+        print line
+    except interpreter.ParseError, e:
+      print "Parse error: %s" % e
+    except interpreter.ScriptError, e:
+      print "Error: %s" % e
+    except (interpreter.Cancelled, KeyboardInterrupt):
+      print "Stopped"
+    except Exception, e:
+      print "Error: %s: %s" % (e.__class__.__name__, e)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+  The robot the interpreter talks to.
+
+  Modules used to create their ALProxy objects when imported, which meant a
+  slow start and no way to run anything without a Nao. They now hold
+  LazyProxy objects, which ask the configured backend for the real proxy the
+  first time one of their methods is called.
+
+  Three backends are available:
+
+    naoqi      proxies to NAOqi on a real robot (the default)
+    simulator  simulator.SimulatedRobot, an in-process model of the robot
+    replay     recording.ReplayRobot, which answers from a recorded trace
+
+  Pick one with configure(), or with the NAOSCRIPT_ROBOT environment variable
+  (plus NAOSCRIPT_ROBOT_HOST and NAOSCRIPT_ROBOT_PORT for naoqi,
+  NAOSCRIPT_ROBOT_TIME_SCALE and NAOSCRIPT_ROBOT_ROOM for the simulator, or
+  NAOSCRIPT_ROBOT_TRACE and NAOSCRIPT_ROBOT_TIME_SCALE for replay).
+"""
+import os
+import time
+import threading
+import logging
+import metrics
+
+logger = logging.getLogger("naoscript.robot")
+
+call_seconds = metrics.histogram("naoscript_robot_call_seconds", "Time taken by calls to the robot's modules", ("module", "method"))
+call_errors = metrics.counter("naoscript_robot_call_errors_total", "Calls to the robot's modules that raised", ("module", "method"))
+
+# Calls to make the first time a module is used, as (module, method, arguments).
+# Sonar and darkness readings only appear in ALMemory while someone is subscribed.
+SETUP = {
+  "ALMemory": [("ALSonar", "subscribe", ("naoscript",)), ("ALDarknessDetection", "subscribe", ("naoscript",))],
+  "ALBehaviorManager": [("ALBehaviorManager", "installBehavior", ("wave",))],
+}
+
+def setUp(backend, module):
+  # Run the SETUP calls for a module a backend has just created a proxy for.
+  for setup_module, method, arguments in SETUP.get(module, []):
+    getattr(backend.proxy(setup_module), method)(*arguments)
+
+class NaoqiRobot:
+  #Fields
+  host = "localhost"
+  port = 9559
+  proxies = None # Module name -> ALProxy
+  lock = None
+
+  def __init__(self, host = "localhost", port = 9559):
+    self.host = host
+    self.port = int(port)
+    self.proxies = {}
+    self.lock = threading.RLock()
+
+  def connect(self, module):
+    from naoqi import ALProxy
+    logger.info("Connecting to %s on %s:%d", module, self.host, self.port)
+    return ALProxy(module, self.host, self.port)
+
+  def proxy(self, module):
+    with self.lock:
+      if module not in self.proxies:
+        self.proxies[module] = self.connect(module)
+        setUp(self, module)
+      return self.proxies[module]
+
+def createRobot(name, **options):
+  if name == "naoqi":
+    return NaoqiRobot(**options)
+  elif name == "simulator":
+    import simulator
+    return simulator.SimulatedRobot(**options)
+  elif name == "replay":
+    import recording
+    return recording.ReplayRobot(**options)
+  raise ValueError("Unknown robot backend %r (expected naoqi, simulator or replay)" % name)
+
+# The robot every LazyProxy talks to, created on first use.
+current = None
+lock = threading.Lock()
+
+def configure(name, **options):
+  # Switch backends. Proxies already handed out follow along on their next call.
+  global current
+  with lock:
+    current = createRobot(name, **options)
+  return current
+
+def wrap(function):
+  # Replace the backend with function(backend), such as a recorder around it.
+  global current
+  inner = backend()
+  with lock:
+    current = function(inner)
+  return current
+
+def backend():
+  global current
+  with lock:
+    if current is None:
+      name = os.environ.get("NAOSCRIPT_ROBOT", "naoqi")
+      options = {}
+      for option in ENVIRONMENT.get(name, []):
+        variable = "NAOSCRIPT_ROBOT_" + option.upper()
+        if os.environ.get(variable):
+          options[option] = os.environ[variable]
+      current = createRobot(name, **options)
+    return current
+
+# The options backend() reads from NAOSCRIPT_ROBOT_<OPTION> variables.
+ENVIRONMENT = {
+  "naoqi": ["host", "port"],
+  "simulator": ["time_scale", "room"],
+  "replay": ["trace", "time_scale"],
+}
+
+class LazyProxy:
+  # Stands in for an ALProxy to one module of whichever robot is configured.
+
+  #Fields
+  module = None
+
+  def __init__(self, module):
+    self.module = module
+
+  def __getattr__(self, name):
+    method = getattr(backend().proxy(self.module), name)
+    module = self.module
+    def call(*args):
+      start = time.time()
+      try:
+        return method(*args)
+      except Exception:
+        call_errors.inc(module, name)
+        raise
+      finally:
+        call_seconds.observe(time.time() - start, module, name)
+    return call
+
+  def __repr__(self):
+    return "LazyProxy(%r)" % self.module
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+  Cached sensor readings from ALMemory.
+
+  The sonar and darkness values only change a few times a second, but a loop
+  like `while distance "left" > 50` used to fetch them from ALMemory on every
+  iteration. SensorCache remembers every key a program has asked for, fetches
+  them all at once with getListData, and answers reads from that batch until
+  it is older than max_age. A poller thread can keep the batch fresh so reads
+  never wait on the robot at all.
+"""
+import time
+import threading
+import logging
+
+logger = logging.getLogger("naoscript.sensors")
+
+SONAR_LEFT = "Device/SubDeviceList/US/Left/Sensor/Value"
+SONAR_RIGHT = "Device/SubDeviceList/US/Right/Sensor/Value"
+DARKNESS = "DarknessDetection/DarknessValue"
+
+class SensorCache:
+  #Fields
+  memproxy = None
+  max_age = 0.1     # Seconds a batch may be reused for
+  keys = None       # Every key read so far, fetched together
+  values = None     # Key -> value from the last batch
+  fetched_at = 0.0  # When the last batch was fetched
+  lock = None
+  poller = None
+  interval = None   # Seconds between polls, if polling
+  reads = 0         # Reads by programs
+  fetches = 0       # getListData calls
+  saved = 0         # Reads answered without a fetch
+  age_total = 0.0   # Sum of the ages of the values programs were given
+  age_max = 0.0
+
+  def __init__(self, memproxy, max_age = 0.1):
+    self.memproxy = memproxy
+    self.max_age = max_age
+    self.keys = []
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def fetch(self):
+    #Fetch every known key in one call. Call with the lock held.
+    self.values = dict(zip(self.keys, self.memproxy.getListData(self.keys)))
+    self.fetched_at = time.time()
+    self.fetches += 1
+
+  def read(self, key, newer_than = 0):
+    #Return the value of key, fetched no more than max_age ago and no earlier than newer_than.
+    with self.lock:
+      now = time.time()
+      if key not in self.values:
+        self.keys.append(key)
+        self.fetch()
+      elif now - self.fetched_at > self.max_age or self.fetched_at < newer_than:
+        self.fetch()
+      else:
+        self.saved += 1
+      age = max(0.0, now - self.fetched_at)
+      self.reads += 1
+      self.age_total += age
+      self.age_max = max(self.age_max, age)
+      return self.values[key]
+
+  def invalidate(self):
+    #Make the next read fetch.
+    with self.lock:
+      self.fetched_at = 0.0
+
+  def startPoller(self, interval):
+    #Refresh the batch every interval seconds from a background thread.
+    self.interval = interval
+    if self.poller is None:
+      self.poller = threading.Thread(target = self.poll, name = "naoscript-sensors")
+      self.poller.daemon = True
+      self.poller.start()
+
+  def poll(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        with self.lock:
+          if len(self.keys) > 0:
+            self.fetch()
+      except Exception, e:
+        logger.warning("Sensor poll failed: %s", e)
+
+  def stats(self):
+    with self.lock:
+      return {
+        'keys': len(self.keys),
+        'reads': self.reads,
+        'fetches': self.fetches,
+        'saved': self.saved,
+        'max_age_ms': self.max_age * 1000,
+        'polling_ms': self.interval * 1000 if self.interval is not None else None,
+        'mean_age_seen_ms': self.age_total / self.reads * 1000 if self.reads > 0 else 0.0,
+        'max_age_seen_ms': self.age_max * 1000,
+      }
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+  An in-process stand-in for a Nao, for running the server and the
+  interpreter without NAOqi.
+
+  SimulatedRobot hands out objects with the same methods as the NAOqi
+  proxies the interpreter uses. They share one model of the robot: where it
+  stands in a square room, which way it faces, whether it is stiff, and how
+  dark it is. Sonar readings are the distance from the robot to the walls.
+  Actions take about as long as they would on the robot, multiplied by
+  time_scale (0 makes everything instant). Speech rendered with sayToFile is
+  written as a silent WAV file as long as the speech would be, which
+  ALAudioPlayer's playFile plays by waiting that long.
+"""
+import math
+import time
+import wave
+import threading
+import robot
+from sensors import SONAR_LEFT, SONAR_RIGHT, DARKNESS
+
+WALK_SPEED = 0.1    # Metres per second
+TURN_SPEED = 0.5    # Radians per second
+SPEECH_RATE = 0.07  # Seconds per character
+SYNTHESIS_TIME = 0.3       # Seconds before synthesised speech can start
+SYNTHESIS_RATE = 0.01      # Further seconds of synthesis per character
+SAMPLE_RATE = 8000         # Of the files sayToFile writes: 8-bit mono
+BEHAVIOR_TIME = 2.0
+WALK_INIT_TIME = 0.5
+
+SONAR_MAX = 2.55    # Metres; the sonar reads this when nothing is in range
+SONAR_ANGLE = 0.35  # Radians either side of straight ahead
+
+class RobotState:
+  #Fields
+  x = 0.0         # Metres from the centre of the room
+  y = 0.0
+  theta = 0.0     # Radians anticlockwise from the x axis
+  room = 4.0      # Length of the room's sides in metres
+  stiffness = 0.0
+  walk_ready = False
+  posture = "Stand"
+  darkness = 30   # 0 (bright) to 100 (dark), as ALDarknessDetection reports it
+  volume = 50
+  spoken = None   # Everything said so far
+  spoken_at = None # When each of those started being heard
+  voice = "naoenu"
+  speech_speed = 100
+  recordings = None # Path of each file sayToFile wrote -> its text
+  lock = None
+
+  def __init__(self, room = 4.0):
+    self.room = room
+    self.spoken = []
+    self.spoken_at = []
+    self.recordings = {}
+    self.lock = threading.Lock()
+
+  def wallDistance(self, angle):
+    #Distance from the robot to the first wall along the given heading.
+    half = self.room / 2.0
+    dx = math.cos(angle)
+    dy = math.sin(angle)
+    distances = []
+    if dx > 1e-9:
+      distances.append((half - self.x) / dx)
+    elif dx < -1e-9:
+      distances.append((-half - self.x) / dx)
+    if dy > 1e-9:
+      distances.append((half - self.y) / dy)
+    elif dy < -1e-9:
+      distances.append((-half - self.y) / dy)
+    return max(0.0, min(distances))
+
+  def sonar(self, side):
+    with self.lock:
+      angle = self.theta + (SONAR_ANGLE if side == "left" else -SONAR_ANGLE)
+      return min(SONAR_MAX, self.wallDistance(angle))
+
+  def move(self, x, y, theta):
+    #Walk x forward and y to the left, then turn; stop at the walls like the real robot would (by bumping into them).
+    with self.lock:
+      half = self.room / 2.0
+      self.x += x * math.cos(self.theta) - y * math.sin(self.theta)
+      self.y += x * math.sin(self.theta) + y * math.cos(self.theta)
+      self.x = max(-half, min(half, self.x))
+      self.y = max(-half, min(half, self.y))
+      self.theta = (self.theta + theta) % (2 * math.pi)
+
+class SimulatedModule:
+  #Fields
+  robot = None
+
+  def __init__(self, robot):
+    self.robot = robot
+
+  def sleep(self, seconds):
+    if self.robot.time_scale > 0 and seconds > 0:
+      time.sleep(seconds * self.robot.time_scale)
+
+class SimulatedMotion(SimulatedModule):
+  def stiffnessInterpolation(self, names, stiffness, duration):
+    self.sleep(duration)
+    self.robot.state.stiffness = stiffness
+    if stiffness == 0:
+      self.robot.state.walk_ready = False
+
+  def walkInit(self):
+    self.sleep(WALK_INIT_TIME)
+    self.robot.state.walk_ready = True
+
+  def walkTo(self, x, y, theta):
+    if self.robot.state.stiffness == 0:
+      # A relaxed robot can't walk; NAOqi just does nothing.
+      return
+    self.sleep(math.hypot(x, y) / WALK_SPEED + abs(theta) / TURN_SPEED)
+    self.robot.state.move(x, y, theta)
+
+class SimulatedMemory(SimulatedModule):
+  def getData(self, key):
+    state = self.robot.state
+    if key == SONAR_LEFT:
+      return state.sonar("left")
+    elif key == SONAR_RIGHT:
+      return state.sonar("right")
+    elif key == DARKNESS:
+      return state.darkness
+    raise RuntimeError("ALMemory::getData: no data for key %s" % key)
+
+  def getListData(self, keys):
+    return [self.getData(key) for key in keys]
+
+def speak(module, text, seconds):
+  #Record that text starts being heard now, and wait until it has been.
+  state = module.robot.state
+  with state.lock:
+    state.spoken.append(text)
+    state.spoken_at.append(time.time())
+  module.sleep(seconds)
+
+class SimulatedTextToSpeech(SimulatedModule):
+  def synthesise(self, text):
+    self.sleep(SYNTHESIS_TIME + len(text) * SYNTHESIS_RATE)
+
+  def say(self, text):
+    self.synthesise(text)
+    speak(self, text, len(text) * SPEECH_RATE)
+
+  def sayToFile(self, text, filename):
+    self.synthesise(text)
+    recording = wave.open(filename, "wb")
+    try:
+      recording.setnchannels(1)
+      recording.setsampwidth(1)
+      recording.setframerate(SAMPLE_RATE)
+      recording.writeframes("\x80" * int(len(text) * SPEECH_RATE * SAMPLE_RATE))
+    finally:
+      recording.close()
+    with self.robot.state.lock:
+      self.robot.state.recordings[filename] = text
+
+  def getVoice(self):
+    return self.robot.state.voice
+
+  def setVoice(self, voice):
+    self.robot.state.voice = voice
+
+  def getParameter(self, name):
+    if name != "speed":
+      raise RuntimeError("ALTextToSpeech::getParameter: the simulator has no parameter %s" % name)
+    return self.robot.state.speech_speed
+
+  def setParameter(self, name, value):
+    if name != "speed":
+      raise RuntimeError("ALTextToSpeech::setParameter: the simulator has no parameter %s" % name)
+    self.robot.state.speech_speed = value
+
+class SimulatedAudioPlayer(SimulatedModule):
+  def playFile(self, filename):
+    try:
+      recording = wave.open(filename, "rb")
+    except (IOError, wave.Error), e:
+      raise RuntimeError("ALAudioPlayer::playFile: cannot open %s: %s" % (filename, e))
+    try:
+      seconds = recording.getnframes() / float(recording.getframerate())
+    finally:
+      recording.close()
+    speak(self, self.robot.state.recordings.get(filename, filename), seconds)
+
+class SimulatedBehaviorManager(SimulatedModule):
+  #Fields
+  installed = None
+
+  def __init__(self, robot):
+    SimulatedModule.__init__(self, robot)
+    self.installed = set(["Stand Up", "Sit Down"])
+
+  def installBehavior(self, name):
+    self.installed.add(name)
+    return True
+
+  def isBehaviorInstalled(self, name):
+    return name in self.installed
+
+  def runBehavior(self, name):
+    if name not in self.installed:
+      raise RuntimeError("ALBehaviorManager::runBehavior: behavior %s is not installed" % name)
+    self.sleep(BEHAVIOR_TIME)
+    state = self.robot.state
+    if name == "Sit Down":
+      state.posture = "Sit"
+    elif name == "Stand Up":
+      state.posture = "Stand"
+    state.walk_ready = False
+
+class SimulatedExtractor(SimulatedModule):
+  # ALSonar and ALDarknessDetection: the simulator's readings are always fresh.
+  def subscribe(self, name):
+    pass
+
+  def unsubscribe(self, name):
+    pass
+
+class SimulatedAudioDevice(SimulatedModule):
+  def setOutputVolume(self, volume):
+    self.robot.state.volume = volume
+
+class SimulatedNetwork(SimulatedModule):
+  def getLocalIP(self):
+    return "127.0.0.1"
+
+class SimulatedRobot:
+  #Fields
+  state = None
+  time_scale = 1.0
+  proxies = None
+  lock = None
+
+  MODULES = {
+    "ALMotion": SimulatedMotion,
+    "ALMemory": SimulatedMemory,
+    "ALTextToSpeech": SimulatedTextToSpeech,
+    "ALAudioPlayer": SimulatedAudioPlayer,
+    "ALBehaviorManager": SimulatedBehaviorManager,
+    "ALSonar": SimulatedExtractor,
+    "ALDarknessDetection": SimulatedExtractor,
+    "ALAudioDevice": SimulatedAudioDevice,
+    "ALNetwork": SimulatedNetwork,
+  }
+
+  def __init__(self, time_scale = 1.0, room = 4.0):
+    self.time_scale = float(time_scale)
+    self.state = RobotState(room = float(room))
+    self.proxies = {}
+    self.lock = threading.RLock()
+
+  def proxy(self, module):
+    with self.lock:
+      if module not in self.proxies:
+        if module not in self.MODULES:
+          raise RuntimeError("The simulator has no %s module" % module)
+        self.proxies[module] = self.MODULES[module](self)
+        robot.setUp(self, module)
+      return self.proxies[module]
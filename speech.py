@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+  Speech synthesised once and played from disk after that.
+
+  ALTextToSpeech.say synthesises its text before the robot says a word, every
+  time, and classroom programs say the same few phrases over and over inside
+  loops. Once open() has been given a directory, a SpeechCache renders each
+  phrase to a file there with sayToFile the first time it is said, and later
+  plays the file through ALAudioPlayer. Files are keyed by the text, voice
+  and speed. They are kept up to max_bytes in total, dropping the least
+  recently played first, and the files of earlier runs are picked up again
+  by open(). The server runs on the robot, next to NAOqi, so the paths mean
+  the same thing to both. The voice and speed are asked of the robot once
+  and remembered, so a say that finds its file makes no other robot calls;
+  change them with setVoice and setSpeed so the cache knows.
+
+  Phrases a program says as constants can be rendered in the background as
+  soon as it is parsed (see warm), so that they are ready by the time the
+  program gets to them. Until open() is called, say goes straight to
+  ALTextToSpeech.say.
+"""
+import os
+import time
+import Queue
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("naoscript.speech")
+
+SUFFIX = ".wav"
+MAX_WARM = 32 # Phrases rendered ahead of time per program
+
+def phrases(expressions, found = None):
+  #The constant strings a parsed program passes to say, in order.
+  if found is None:
+    found = []
+  for expression in expressions:
+    manner = expression.manner
+    if manner == 1:
+      name, args = expression.value
+      if name == "say" and len(args) > 0 and args[0].manner == 0 and str(args[0].value) not in found:
+        found.append(str(args[0].value))
+      phrases(args, found)
+    elif manner == 2:
+      phrases([expression.value[1]], found)
+    elif manner == 3:
+      phrases(expression.value[2], found)
+    elif manner == 4 or manner == 8:
+      phrases([expression.value[0]], found)
+      phrases(expression.value[1], found)
+    elif manner == 5:
+      phrases([expression.value[0]], found)
+      phrases(expression.value[1], found)
+      if expression.value[2] is not None:
+        phrases(expression.value[2], found)
+    elif manner == 6:
+      phrases([expression.value], found)
+  return found
+
+class SpeechCache:
+  #Fields
+  ttsproxy = None
+  playerproxy = None
+  directory = None   # Where rendered speech goes; None until open(), and then speech isn't cached
+  max_bytes = 0
+  entries = None     # File name -> size in bytes, least recently played first
+  bytes = 0
+  rendering = None   # File name -> Event set once a render of it has finished, for renders in progress
+  queue = None       # Phrases waiting to be rendered in the background
+  worker = None
+  lock = None
+  hits = 0           # Says whose speech was already on disk
+  misses = 0
+  warmed = 0         # Phrases rendered in the background
+  evictions = 0
+  fallbacks = 0      # Says that went to ALTextToSpeech.say because rendering or playing failed
+  first_audio = None # "hit" or "miss" -> [says, total seconds, most seconds] from the call until playing starts
+  synthesis = None   # (voice, speed) speech is synthesised with, once read from the robot
+
+  def __init__(self, ttsproxy, playerproxy):
+    self.ttsproxy = ttsproxy
+    self.playerproxy = playerproxy
+    self.entries = OrderedDict()
+    self.rendering = {}
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    self.first_audio = {"hit": [0, 0.0, 0.0], "miss": [0, 0.0, 0.0]}
+
+  def open(self, directory, max_bytes = 50 * 1024 * 1024):
+    #Start caching speech in directory, keeping what earlier runs left there.
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    found = []
+    for name in os.listdir(directory):
+      if name.endswith(SUFFIX):
+        path = os.path.join(directory, name)
+        found.append((os.path.getmtime(path), name, os.path.getsize(path)))
+    with self.lock:
+      self.directory = directory
+      self.max_bytes = max_bytes
+      self.entries.clear()
+      self.bytes = 0
+      for played_at, name, size in sorted(found):
+        self.entries[name] = size
+        self.bytes += size
+      self.evict()
+
+  def settings(self):
+    #The voice and speed speech is synthesised with, which the files depend on.
+    #They are only read from the robot until both reads succeed.
+    with self.lock:
+      if self.synthesis is not None:
+        return self.synthesis
+    try:
+      voice = self.ttsproxy.getVoice()
+      speed = self.ttsproxy.getParameter("speed")
+    except Exception:
+      return None, None
+    with self.lock:
+      if self.synthesis is None:
+        self.synthesis = (voice, speed)
+      return self.synthesis
+
+  def setVoice(self, voice):
+    self.ttsproxy.setVoice(voice)
+    with self.lock:
+      self.synthesis = None
+
+  def setSpeed(self, speed):
+    self.ttsproxy.setParameter("speed", speed)
+    with self.lock:
+      self.synthesis = None
+
+  def fileName(self, text, voice, speed):
+    return hashlib.sha1(repr((text, voice, speed))).hexdigest() + SUFFIX
+
+  def render(self, text, voice, speed):
+    #Return (path, whether it was already on disk), rendering it if need be.
+    #A phrase being rendered by another thread is waited for, not rendered twice.
+    name = self.fileName(text, voice, speed)
+    path = os.path.join(self.directory, name)
+    ready = True
+    while True:
+      with self.lock:
+        found = name in self.entries
+        if found:
+          self.entries[name] = self.entries.pop(name)
+        else:
+          event = self.rendering.get(name)
+          if event is None:
+            event = self.rendering[name] = threading.Event()
+            break
+      if found:
+        try:
+          # So open() finds the files in the order they were last played
+          os.utime(path, None)
+        except OSError:
+          pass
+        return path, ready
+      ready = False
+      event.wait()
+    try:
+      self.ttsproxy.sayToFile(text, path)
+      size = os.path.getsize(path)
+      with self.lock:
+        self.entries[name] = size
+        self.bytes += size
+        self.evict()
+    finally:
+      with self.lock:
+        del self.rendering[name]
+      event.set()
+    return path, False
+
+  def evict(self):
+    #Delete the least recently played files until we are within max_bytes. Call with the lock held.
+    #The newest file always stays, so the phrase about to be played is still there.
+    while self.bytes > self.max_bytes and len(self.entries) > 1:
+      name, size = self.entries.popitem(last = False)
+      self.bytes -= size
+      self.evictions += 1
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError, e:
+        logger.warning("Could not delete cached speech %s: %s", name, e)
+
+  def say(self, text):
+    if self.directory is None:
+      return self.ttsproxy.say(text)
+    start = time.time()
+    try:
+      path, ready = self.render(text, *self.settings())
+      with self.lock:
+        if ready:
+          self.hits += 1
+        else:
+          self.misses += 1
+        stats = self.first_audio["hit" if ready else "miss"]
+        elapsed = time.time() - start
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+      return self.playerproxy.playFile(path)
+    except Exception, e:
+      logger.warning("Could not play cached speech for %r, saying it instead: %s", text, e)
+      with self.lock:
+        self.fallbacks += 1
+      return self.ttsproxy.say(text)
+
+  def warm(self, texts):
+    #Render texts in the background, so saying them later only has to play them.
+    if self.directory is None:
+      return
+    for text in texts[:MAX_WARM]:
+      self.queue.put(text)
+    with self.lock:
+      if self.worker is None:
+        self.worker = threading.Thread(target = self.work, name = "naoscript-speech")
+        self.worker.daemon = True
+        self.worker.start()
+
+  def work(self):
+    while True:
+      text = self.queue.get()
+      try:
+        path, ready = self.render(text, *self.settings())
+        if not ready:
+          with self.lock:
+            self.warmed += 1
+      except Exception, e:
+        logger.warning("Could not render %r ahead of time: %s", text, e)
+
+  def stats(self):
+    with self.lock:
+      said = self.hits + self.misses
+      reply = {
+        'enabled': self.directory is not None,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / float(said) if said > 0 else 0.0,
+        'warmed': self.warmed,
+        'waiting_to_warm': self.queue.qsize(),
+        'fallbacks': self.fallbacks,
+        'entries': len(self.entries),
+        'bytes': self.bytes,
+        'max_bytes': self.max_bytes,
+        'evictions': self.evictions,
+      }
+      for kind, (count, total, most) in self.first_audio.iteritems():
+        reply['first_audio_%s_mean_ms' % kind] = total / count * 1000 if count > 0 else 0.0
+        reply['first_audio_%s_max_ms' % kind] = most * 1000
+      return reply
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+  The files the editor page is made of, kept in memory and served with
+  caching headers.
+
+  Every page load used to read index.html from disk and send it whole, with
+  no length, no validator and no compression. StaticFiles keeps each file in
+  memory along with a gzipped copy and an ETag, and reloads it when its
+  modification time changes. serve() answers If-None-Match with 304 Not
+  Modified, compresses for clients that accept gzip, and honours single byte
+  ranges.
+"""
+import os
+import re
+import gzip
+import hashlib
+import threading
+import StringIO
+
+# URL path -> (file, content type, seconds browsers may reuse it without asking).
+# Files that change with the server are revalidated every time, which costs a 304.
+FILES = {
+  'index.html': ('index.html', 'text/html; charset=utf-8', 0),
+  'stylesheet.css': ('stylesheet.css', 'text/css', 0),
+  'favicon.ico': ('favicon.ico', 'image/x-icon', 86400),
+  'static/jquery.min.js': (os.path.join('static', 'jquery.min.js'), 'application/javascript', 7 * 86400),
+}
+
+COMPRESSIBLE = ('text/', 'application/javascript')
+
+range_regex = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class StaticFile:
+  #Fields
+  path = None
+  content_type = None
+  max_age = 0
+  mtime = None
+  body = None
+  gzipped = None  # The body gzipped, or None when that doesn't make it smaller
+  etag = None
+
+  def __init__(self, path, content_type, max_age):
+    self.path = path
+    self.content_type = content_type
+    self.max_age = max_age
+
+  def load(self, mtime):
+    static_file = open(self.path, 'rb')
+    self.body = static_file.read()
+    static_file.close()
+    self.mtime = mtime
+    self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()[:20]
+    self.gzipped = None
+    if self.content_type.startswith(COMPRESSIBLE):
+      buffer = StringIO.StringIO()
+      compressor = gzip.GzipFile(fileobj = buffer, mode = 'wb', compresslevel = 9, mtime = 0)
+      compressor.write(self.body)
+      compressor.close()
+      if len(buffer.getvalue()) < len(self.body):
+        self.gzipped = buffer.getvalue()
+
+  def gzipETag(self):
+    #The gzipped body is a different representation, so it gets its own validator.
+    return self.etag[:-1] + '-gzip"'
+
+class StaticFiles:
+  #Fields
+  root = None
+  files = None # URL path -> StaticFile
+  lock = None
+
+  def __init__(self, root = '.', files = FILES):
+    self.root = root
+    self.lock = threading.Lock()
+    self.files = {}
+    for url, (path, content_type, max_age) in files.iteritems():
+      self.files[url] = StaticFile(os.path.join(root, path), content_type, max_age)
+
+  def get(self, url):
+    #Return the up-to-date StaticFile for a URL path, or None if there isn't one.
+    static_file = self.files.get(url)
+    if static_file is None:
+      return None
+    try:
+      mtime = os.stat(static_file.path).st_mtime
+    except OSError:
+      return None
+    with self.lock:
+      if static_file.mtime != mtime:
+        static_file.load(mtime)
+    return static_file
+
+def serve(handler, static_file):
+  #Answer a GET for a StaticFile on a BaseHTTPRequestHandler.
+  accepts_gzip = static_file.gzipped is not None and 'gzip' in (handler.headers.getheader('accept-encoding') or '')
+  byte_range = handler.headers.getheader('range')
+  if byte_range is not None:
+    accepts_gzip = False # Ranges are of the uncompressed body
+  etag = static_file.gzipETag() if accepts_gzip else static_file.etag
+
+  def headers():
+    handler.send_header('ETag', etag)
+    handler.send_header('Cache-Control', 'public, max-age=%d' % static_file.max_age if static_file.max_age > 0 else 'no-cache')
+    handler.send_header('Accept-Ranges', 'bytes')
+    if static_file.gzipped is not None:
+      handler.send_header('Vary', 'Accept-Encoding')
+
+  if_none_match = handler.headers.getheader('if-none-match')
+  if if_none_match is not None:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    if '*' in tags or etag in tags:
+      handler.send_response(304)
+      headers()
+      handler.end_headers()
+      return
+
+  body = static_file.gzipped if accepts_gzip else static_file.body
+  status = 200
+  content_range = None
+  if byte_range is not None:
+    match = range_regex.match(byte_range.strip())
+    if match is not None and match.group(1) + match.group(2) != '':
+      size = len(body)
+      if match.group(1) == '':
+        # The last n bytes
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+      else:
+        start = int(match.group(1))
+        end = min(size - 1, int(match.group(2))) if match.group(2) != '' else size - 1
+      if start >= size or start > end:
+        handler.send_response(416)
+        handler.send_header('Content-Range', 'bytes */%d' % size)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+        return
+      status = 206
+      content_range = 'bytes %d-%d/%d' % (start, end, size)
+      body = body[start:end + 1]
+
+  handler.send_response(status)
+  handler.send_header('Content-Type', static_file.content_type)
+  handler.send_header('Content-Length', str(len(body)))
+  if content_range is not None:
+    handler.send_header('Content-Range', content_range)
+  if accepts_gzip:
+    handler.send_header('Content-Encoding', 'gzip')
+  headers()
+  handler.end_headers()
+  handler.wfile.write(body)
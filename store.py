@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+  Saved programs, kept in SQLite and keyed by (username, program name).
+
+  The server used to load and rewrite all of programs.json for every request,
+  and two requests writing at once could lose one another's changes. Each
+  request now reads or writes just the rows it needs, and renames happen in a
+  single transaction. The first time a store opens it imports programs.json,
+  if there is one; the JSON file itself is left alone.
+
+  The server keeps a ProgramCatalog in front of the store, so reads come from
+  memory and bursts of changes reach the database as one write.
+"""
+import os
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+import simplejson as json
+import metrics
+
+logger = logging.getLogger("naoscript.store")
+
+io_seconds = metrics.histogram("naoscript_store_seconds", "Time taken to import programs.json, load every program and write changes", ("operation",))
+
+SCHEMA = [
+  "CREATE TABLE IF NOT EXISTS programs (username TEXT NOT NULL, name TEXT NOT NULL, commands TEXT NOT NULL, PRIMARY KEY (username, name))",
+  "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+]
+
+def checkProgram(username, name, commands = ''):
+  #Raise ValueError unless a program's username, name and commands are all text.
+  for field, value in (('username', username), ('name', name), ('commands', commands)):
+    if not isinstance(value, basestring):
+      raise ValueError("A program's %s must be text, not %s" % (field, 'null' if value is None else type(value).__name__))
+
+class ProgramStore:
+  #Fields
+  path = None
+  connection = None
+  lock = None # sqlite3 connections aren't safe to use from two threads at once
+
+  def __init__(self, path = 'programs.db', json_path = 'programs.json'):
+    self.path = path
+    self.connection = sqlite3.connect(path, check_same_thread = False)
+    self.lock = threading.Lock()
+    with self.lock:
+      with self.connection:
+        for statement in SCHEMA:
+          self.connection.execute(statement)
+    if json_path is not None:
+      self.migrate(json_path)
+
+  def migrate(self, json_path):
+    #Import a programs.json ({username: {name: commands}}) once. Returns how many programs were imported.
+    with self.lock:
+      if self.connection.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone() is not None:
+        return 0
+      contents = {}
+      with io_seconds.time("import"):
+        if os.path.exists(json_path):
+          json_file = open(json_path)
+          contents = json.load(json_file)
+          json_file.close()
+        rows = [(username, name, commands) for username in contents for name, commands in contents[username].iteritems()]
+        with self.connection:
+          self.connection.executemany("INSERT OR REPLACE INTO programs (username, name, commands) VALUES (?, ?, ?)", rows)
+          self.connection.execute("INSERT INTO meta (key, value) VALUES ('migrated', ?)", (json_path,))
+      if len(rows) > 0:
+        logger.info("Imported %d programs from %s", len(rows), json_path)
+      return len(rows)
+
+  def programs(self, username):
+    #Every program a user has saved, as {name: commands}.
+    with self.lock:
+      return dict(self.connection.execute("SELECT name, commands FROM programs WHERE username = ?", (username,)))
+
+  def get(self, username, name):
+    with self.lock:
+      row = self.connection.execute("SELECT commands FROM programs WHERE username = ? AND name = ?", (username, name)).fetchone()
+    return row[0] if row is not None else None
+
+  def add(self, username, name, commands):
+    #Save a new program. Returns False if the user already has one by that name.
+    checkProgram(username, name, commands)
+    with self.lock:
+      try:
+        with self.connection:
+          self.connection.execute("INSERT INTO programs (username, name, commands) VALUES (?, ?, ?)", (username, name, commands))
+      except sqlite3.IntegrityError:
+        return False
+    return True
+
+  def delete(self, username, name):
+    #Returns False if there was no such program.
+    with self.lock:
+      with self.connection:
+        return self.connection.execute("DELETE FROM programs WHERE username = ? AND name = ?", (username, name)).rowcount > 0
+
+  def edit(self, username, oldname, newname, commands):
+    #Replace a program, renaming it if newname differs. Returns False (changing nothing)
+    #if the user already has a different program called newname.
+    checkProgram(username, oldname)
+    checkProgram(username, newname, commands)
+    with self.lock:
+      with self.connection:
+        if newname != oldname:
+          if self.connection.execute("SELECT 1 FROM programs WHERE username = ? AND name = ?", (username, newname)).fetchone() is not None:
+            return False
+          self.connection.execute("DELETE FROM programs WHERE username = ? AND name = ?", (username, oldname))
+        self.connection.execute("INSERT OR REPLACE INTO programs (username, name, commands) VALUES (?, ?, ?)", (username, newname, commands))
+    return True
+
+  def all(self):
+    #Every saved program, as {username: {name: commands}}.
+    with self.lock:
+      with io_seconds.time("load"):
+        contents = {}
+        for username, name, commands in self.connection.execute("SELECT username, name, commands FROM programs"):
+          contents.setdefault(username, {})[name] = commands
+        return contents
+
+  def apply(self, changes):
+    #Write (username, name, commands) rows in one transaction; commands of None deletes the program.
+    with self.lock:
+      with io_seconds.time("write"), self.connection:
+        for username, name, commands in changes:
+          if commands is None:
+            self.connection.execute("DELETE FROM programs WHERE username = ? AND name = ?", (username, name))
+          else:
+            self.connection.execute("INSERT OR REPLACE INTO programs (username, name, commands) VALUES (?, ?, ?)", (username, name, commands))
+
+  def dataVersion(self):
+    #Changes whenever another connection commits to the database (but not when we do).
+    with self.lock:
+      return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+  def count(self):
+    with self.lock:
+      return self.connection.execute("SELECT COUNT(*) FROM programs").fetchone()[0]
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+class ProgramCatalog:
+  #Every saved program held in memory in front of a ProgramStore. Reads never
+  #touch the database. Changes apply to memory at once and are written behind:
+  #the first change starts a short timer, and everything that changes before it
+  #fires goes to the store in one transaction. If something else writes to the
+  #database, the catalog notices within check_interval and reloads.
+
+  #Fields
+  store = None
+  contents = None        # {username: {name: commands}}
+  pending = None         # (username, name) -> commands, or None for a delete, not yet written
+  lock = None
+  delay = 0.5            # Seconds to gather changes before writing them
+  timer = None
+  check_interval = 1.0   # Seconds between checks for outside changes
+  checked_at = 0.0
+  data_version = None
+  flushes = 0
+  writes = 0             # Changes written, after coalescing
+
+  def __init__(self, store, delay = 0.5, check_interval = 1.0):
+    self.store = store
+    self.delay = delay
+    self.check_interval = check_interval
+    self.pending = OrderedDict()
+    self.lock = threading.RLock()
+    self.reload()
+
+  def reload(self):
+    with self.lock:
+      self.data_version = self.store.dataVersion()
+      self.contents = self.store.all()
+      #Changes we haven't written yet still win
+      for (username, name), commands in self.pending.iteritems():
+        self.change(username, name, commands, False)
+      self.checked_at = time.time()
+
+  def check(self):
+    #Reload if another process has changed the database. Call with the lock held.
+    now = time.time()
+    if now - self.checked_at < self.check_interval:
+      return
+    self.checked_at = now
+    if self.store.dataVersion() != self.data_version:
+      logger.info("Programs changed outside the server; reloading")
+      self.reload()
+
+  def change(self, username, name, commands, record = True):
+    #Change memory and, if record, remember to write the change. Call with the lock held.
+    user = self.contents.setdefault(username, {})
+    if commands is None:
+      user.pop(name, None)
+    else:
+      user[name] = commands
+    if record:
+      self.pending.pop((username, name), None)
+      self.pending[(username, name)] = commands
+      if self.timer is None:
+        self.timer = threading.Timer(self.delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+  def programs(self, username):
+    with self.lock:
+      self.check()
+      return dict(self.contents.get(username, {}))
+
+  def get(self, username, name):
+    with self.lock:
+      self.check()
+      return self.contents.get(username, {}).get(name)
+
+  def add(self, username, name, commands):
+    #Raises ValueError for anything that isn't text, rather than letting it into the next write.
+    checkProgram(username, name, commands)
+    with self.lock:
+      self.check()
+      if name in self.contents.get(username, {}):
+        return False
+      self.change(username, name, commands)
+      return True
+
+  def delete(self, username, name):
+    checkProgram(username, name)
+    with self.lock:
+      self.check()
+      if name not in self.contents.get(username, {}):
+        return False
+      self.change(username, name, None)
+      return True
+
+  def edit(self, username, oldname, newname, commands):
+    checkProgram(username, oldname)
+    checkProgram(username, newname, commands)
+    with self.lock:
+      self.check()
+      user = self.contents.get(username, {})
+      if newname != oldname and newname in user:
+        return False
+      if newname != oldname and oldname in user:
+        self.change(username, oldname, None)
+      self.change(username, newname, commands)
+      return True
+
+  def count(self):
+    with self.lock:
+      return sum(len(user) for user in self.contents.itervalues())
+
+  def flush(self):
+    #Write every pending change in one transaction. Runs from the timer, and should be called at shutdown.
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      if len(self.pending) == 0:
+        return
+      changes = [(username, name, commands) for (username, name), commands in self.pending.iteritems()]
+      try:
+        self.store.apply(changes)
+        written = changes
+      except sqlite3.OperationalError, e:
+        #The database is locked or can't be written; keep them all pending and try again later
+        logger.error("Could not save %d program changes: %s", len(changes), e)
+        self.retry()
+        return
+      except Exception, e:
+        #Something in the batch can't be written; write the rest one by one so it doesn't hold them up
+        logger.error("Could not save %d program changes together, saving them one at a time: %s", len(changes), e)
+        written = [change for change in changes if self.applyOne(change)]
+      for username, name, commands in written:
+        del self.pending[(username, name)]
+      if len(written) > 0:
+        self.flushes += 1
+        self.writes += len(written)
+
+  def applyOne(self, change):
+    #Write one change. A change the database rejects is dropped, and memory goes
+    #back to what is saved, so it can't block every later write. Returns whether
+    #it was written. Call with the lock held.
+    username, name, commands = change
+    try:
+      self.store.apply([change])
+      return True
+    except sqlite3.OperationalError, e:
+      logger.error("Could not save %s's program %r: %s", username, name, e)
+      self.retry()
+      return False
+    except Exception, e:
+      logger.error("Dropping unsaveable change to %s's program %r: %s", username, name, e)
+      del self.pending[(username, name)]
+      self.change(username, name, self.store.get(username, name), False)
+      return False
+
+  def retry(self):
+    #Try the pending changes again shortly. Call with the lock held.
+    if self.timer is None:
+      self.timer = threading.Timer(self.delay, self.flush)
+      self.timer.daemon = True
+      self.timer.start()
+
+  def stats(self):
+    with self.lock:
+      return {'programs': self.count(), 'pending': len(self.pending), 'flushes': self.flushes, 'writes': self.writes}
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+  `when` blocks: code that runs each time a condition becomes true.
+
+      when (distance "left") < 0.5
+        say "wall"
+
+  The only way to react to a sensor used to be a while loop asking for it
+  over and over, which keeps a core busy and still only notices the change on
+  its next pass. A `when` statement instead registers a Trigger with the
+  session's EventLoop. Once the program's main body has finished (and during
+  any `wait`), the loop reads every ALMemory key a condition depends on in one
+  batch, a few times a second, sleeping in between. A condition is only
+  evaluated again when one of its keys has changed (or, for conditions on
+  ordinary variables, after some handler has run). Its block runs when it goes
+  from false to true, and not again within the debounce time.
+"""
+import time
+
+from sensors import SONAR_LEFT, SONAR_RIGHT, DARKNESS
+
+POLL_INTERVAL = 0.05 # Seconds between reads of the watched keys; the sonar updates about ten times a second
+DEBOUNCE = 0.5       # Seconds after a block runs before it may run again
+
+# The ALMemory keys each sensor builtin reads.
+SENSOR_KEYS = {
+  "distance": (SONAR_LEFT, SONAR_RIGHT),
+  "brightness": (DARKNESS,),
+}
+
+def conditionNames(expression, names = None):
+  #Every variable and function name a condition Expression reads.
+  if names is None:
+    names = set()
+  if expression.manner == 1:
+    names.add(expression.value[0])
+    for arg in expression.value[1]:
+      conditionNames(arg, names)
+  elif expression.manner == 2:
+    conditionNames(expression.value[1], names)
+  return names
+
+def conditionKeys(names, scope, builtins):
+  #The ALMemory keys a condition reading names depends on, or None if it reads
+  #something that isn't a builtin (a variable, or a function of the program's own),
+  #in which case it has to be checked every time.
+  keys = set()
+  for name in names:
+    value = scope.lookup(name)
+    if name not in builtins or value is not builtins[name]:
+      return None
+    keys.update(SENSOR_KEYS.get(name, ()))
+  return frozenset(keys)
+
+class Trigger:
+  #Fields
+  condition = None  # Callable returning the condition's value
+  body = None       # Callable running the block
+  keys = None       # frozenset of ALMemory keys the condition depends on, or None to check it every time
+  debounce = DEBOUNCE
+  active = False    # Whether the condition held when last checked
+  fired_at = None
+  fires = 0
+
+  def __init__(self, condition, body, keys, debounce = DEBOUNCE):
+    self.condition = condition
+    self.body = body
+    self.keys = keys
+    self.debounce = debounce
+
+  def watches(self, changed, handled):
+    #Whether the condition could have changed, given the keys that changed and whether any block ran.
+    if self.keys is None:
+      return True
+    return handled or not self.keys.isdisjoint(changed)
+
+class EventLoop:
+  #Fields
+  triggers = None
+  sensor_cache = None
+  interval = POLL_INTERVAL
+  last = None        # Key -> value at the last tick
+  checking = False   # True while conditions are evaluated, so sensor reads don't wait for the robot to stop
+  handled = False    # Whether a block ran at the last tick, or a trigger was added, so every condition needs checking
+  ticks = 0
+  checks = 0         # Conditions evaluated
+  skipped = 0        # Conditions not evaluated because nothing they read had changed
+  fires = 0
+
+  def __init__(self, sensor_cache, interval = POLL_INTERVAL):
+    self.sensor_cache = sensor_cache
+    self.interval = interval
+    self.triggers = []
+    self.last = {}
+
+  def add(self, trigger):
+    self.triggers.append(trigger)
+    self.handled = True
+
+  def tick(self):
+    #Read the watched keys and run the blocks whose conditions have just become true.
+    self.ticks += 1
+    keys = set()
+    for trigger in self.triggers:
+      if trigger.keys is not None:
+        keys.update(trigger.keys)
+    now = time.time()
+    changed = set()
+    for key in keys:
+      # The first read fetches a fresh batch of every key; the others come from it.
+      value = self.sensor_cache.read(key, now)
+      if key not in self.last or self.last[key] != value:
+        changed.add(key)
+      self.last[key] = value
+    handled = self.handled
+    self.handled = False
+    for trigger in list(self.triggers):
+      if not trigger.watches(changed, handled):
+        self.skipped += 1
+        continue
+      self.checks += 1
+      self.checking = True
+      try:
+        value = trigger.condition()
+      finally:
+        self.checking = False
+      if value and not trigger.active:
+        trigger.active = True
+        # Becoming true again straight after running counts as the same event.
+        if trigger.fired_at is None or time.time() - trigger.fired_at >= trigger.debounce:
+          trigger.fired_at = time.time()
+          trigger.fires += 1
+          self.fires += 1
+          self.handled = True
+          trigger.body()
+      elif not value:
+        trigger.active = False
+
+  def run(self, state, until = None, stop = None):
+    #Dispatch until the time until (or for as long as the run may last), or until
+    #stop() returns True, checking state for cancellation. Stopping because the
+    #run is out of time is not an error.
+    while True:
+      if state.cancelled:
+        state.check() # Raises Cancelled
+      if stop is not None and stop():
+        return
+      end = state.deadline
+      if until is not None and (end is None or until < end):
+        end = until
+      if end is not None and time.time() >= end:
+        return
+      self.tick()
+      time.sleep(self.interval if end is None else max(0.0, min(self.interval, end - time.time())))
+
+  def stats(self):
+    return {'triggers': len(self.triggers), 'ticks': self.ticks, 'checks': self.checks, 'skipped': self.skipped, 'fires': self.fires}
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+"""
+  Bytecode compiler and stack machine for NaoScript.
+
+  compileProgram turns the Expression list produced by interpreter.fullParse
+  into a flat array of (opcode, a, b) instructions, and run executes that
+  array with a value stack. Expression.evaluate remains the reference
+  implementation; the two should agree on every program.
+
+  Variables are resolved while compiling. A name assigned in a function (or at
+  the top level of the program) gets a slot in that frame, and reads of it
+  become (depth, slot) pairs. Names that are never assigned, which covers the
+  builtins, are looked up once when the program starts and read from a table.
+"""
+import sys
+import interpreter
+import triggers
+from interpreter import Stack, Function, NativeFunction, UNSET, arityError
+
+###########
+# Opcodes #
+###########
+
+LOAD_CONST = 0            # a: constant index.
+LOAD_LOCAL_CALL = 1       # a: slot. Push the variable, calling it first if it is a function.
+LOAD_GLOBAL_CALL = 2      # a: global index.
+LOAD_OUTER_CALL = 3       # a: outer index.
+LOAD_LOCAL_FUNCTION = 4   # a: slot, b: target. Push the variable; if it is not a function, jump past its arguments.
+LOAD_GLOBAL_FUNCTION = 5  # a: global index, b: target.
+LOAD_OUTER_FUNCTION = 6   # a: outer index, b: target.
+CALL = 7                  # a: argument count.
+STORE_LOCAL = 8           # a: slot.
+POP = 9
+JUMP = 10                 # a: target.
+JUMP_IF_FALSE = 11        # a: target.
+MAKE_FUNCTION = 12        # a: constant index of the body's Code.
+RETURN = 13
+WHEN = 14                 # a: constant index of (condition position, block position, names the condition reads), b: target.
+
+opcode_names = ["LOAD_CONST", "LOAD_LOCAL_CALL", "LOAD_GLOBAL_CALL", "LOAD_OUTER_CALL", "LOAD_LOCAL_FUNCTION", "LOAD_GLOBAL_FUNCTION", "LOAD_OUTER_FUNCTION", "CALL", "STORE_LOCAL", "POP", "JUMP", "JUMP_IF_FALSE", "MAKE_FUNCTION", "RETURN", "WHEN"]
+
+CALLABLE_TYPES = (Function, NativeFunction)
+
+class Code:
+  #Fields
+  ops = None
+  consts = None
+  const_index = None  # id of each constant -> its index in consts
+  local_names = None  # Slot index -> variable name
+  layout = None       # Variable name -> slot index
+  outers = None       # (depth, slot, name) for variables of enclosing frames
+  outer_index = None  # (depth, slot, name) -> its index in outers
+  globals = None      # Names looked up once per run, shared by the whole program
+  global_index = None # Name -> its index in globals, shared like globals
+  arguments = None
+  name = None
+  parent = None
+
+  def __init__(self, parent = None, name = "main", arguments = []):
+    self.ops = []
+    self.consts = []
+    self.const_index = {}
+    self.local_names = []
+    self.layout = {}
+    self.outers = []
+    self.outer_index = {}
+    self.globals = parent.globals if parent is not None else []
+    self.global_index = parent.global_index if parent is not None else {}
+    self.arguments = arguments
+    self.name = name
+    self.parent = parent
+    for argument in arguments:
+      self.declare(argument)
+
+  def emit(self, op, a = 0, b = 0):
+    #Append an instruction and return its position, so jumps can be patched later.
+    self.ops.append((op, a, b))
+    return len(self.ops) - 1
+
+  def patch(self, position, target):
+    #Point a jump at target. The LOAD_*_FUNCTION instructions keep their target in b.
+    op, a, b = self.ops[position]
+    if op in (LOAD_LOCAL_FUNCTION, LOAD_GLOBAL_FUNCTION, LOAD_OUTER_FUNCTION):
+      self.ops[position] = (op, a, target)
+    else:
+      self.ops[position] = (op, target, b)
+
+  def here(self):
+    return len(self.ops)
+
+  def const(self, value):
+    #Constants are only shared when they are the same object; 1 and True compare equal.
+    #consts keeps every one alive, so their ids aren't reused while compiling.
+    index = self.const_index.get(id(value))
+    if index is None:
+      index = self.const_index[id(value)] = len(self.consts)
+      self.consts.append(value)
+    return index
+
+  def declare(self, name):
+    if name not in self.layout:
+      self.layout[name] = len(self.local_names)
+      self.local_names.append(name)
+    return self.layout[name]
+
+  def resolve(self, name):
+    #Return ("local", slot), ("outer", index) or ("global", index) for a variable read.
+    if name in self.layout:
+      return ("local", self.layout[name])
+    depth = 1
+    code = self.parent
+    while code is not None:
+      if name in code.layout:
+        outer = (depth, code.layout[name], name)
+        if outer not in self.outer_index:
+          self.outer_index[outer] = len(self.outers)
+          self.outers.append(outer)
+        return ("outer", self.outer_index[outer])
+      depth += 1
+      code = code.parent
+    if name not in self.global_index:
+      self.global_index[name] = len(self.globals)
+      self.globals.append(name)
+    return ("global", self.global_index[name])
+
+class CodeFunction(Function):
+  # A Function whose block is a compiled Code object rather than a list of Expressions.
+  __slots__ = ('values',) # The table of global values of the run that created it
+
+  def __init__(self, stack, code, values):
+    Function.__init__(self, stack, code.arguments, code, name = code.name)
+    self.values = values
+
+  def call(self, args):
+    # For calls from outside the machine; execute makes its own calls without recursing.
+    state = interpreter.currentSession().state
+    value = execute(self.block, callFrame(self, args, state, state.values), state, self.values)
+    state.depth -= 1
+    return value
+
+def callFrame(function, args, state, values):
+  #Count a call to a CodeFunction against the limits and return its new frame.
+  #values is the caller's table of globals. The caller takes the depth back off
+  #when the call returns.
+  if function.values is not values and values is state.values and state.publish is not None:
+    # A function from an earlier run of the session reads this run's variables from the session's scope
+    state.publish()
+  code = function.block
+  count = len(code.arguments)
+  if len(args) < count:
+    raise arityError(function, args)
+  state.steps += len(code.ops)
+  if state.cancelled or state.steps >= state.check_at:
+    state.check()
+  if state.depth >= state.max_depth:
+    state.enter(function.name) # Raises
+  state.depth += 1
+  slots = args[:count] + [UNSET] * (len(code.local_names) - count)
+  return Stack(function.closure, slots = slots, layout = code.layout)
+
+############
+# Resolver #
+############
+
+def declareBlock(block, code):
+  # Give a slot to every variable the block assigns, before any reads are compiled,
+  # so a read that comes before the assignment still refers to the local.
+  for expression in block:
+    declareExpression(expression, code)
+
+def declareExpression(expression, code):
+  manner = expression.manner
+  if manner == 1:
+    for arg in expression.value[1]:
+      declareExpression(arg, code)
+  elif manner == 2:
+    code.declare(expression.value[0])
+    declareExpression(expression.value[1], code)
+  elif manner == 3:
+    # The body gets its own frame; only the function's name belongs to this one.
+    code.declare(expression.value[0])
+  elif manner == 4:
+    declareExpression(expression.value[0], code)
+    declareBlock(expression.value[1], code)
+  elif manner == 5:
+    declareExpression(expression.value[0], code)
+    declareBlock(expression.value[1], code)
+    if expression.value[2] is not None:
+      declareBlock(expression.value[2], code)
+  elif manner == 6:
+    declareExpression(expression.value, code)
+  elif manner == 8:
+    # The condition and block run later, but in this frame.
+    declareExpression(expression.value[0], code)
+    declareBlock(expression.value[1], code)
+
+############
+# Compiler #
+############
+
+def compileExpression(expression, code):
+  # Emit instructions that leave exactly one value on the stack.
+  manner = expression.manner
+  if manner == 0: # Constant
+    code.emit(LOAD_CONST, code.const(expression.value))
+  elif manner == 1: # Variable dereference or function call
+    name, args = expression.value
+    kind, index = code.resolve(name)
+    if len(args) == 0:
+      code.emit({"local": LOAD_LOCAL_CALL, "global": LOAD_GLOBAL_CALL, "outer": LOAD_OUTER_CALL}[kind], index)
+    else:
+      # Arguments are only evaluated when the variable turns out to be a function.
+      skip = code.emit({"local": LOAD_LOCAL_FUNCTION, "global": LOAD_GLOBAL_FUNCTION, "outer": LOAD_OUTER_FUNCTION}[kind], index)
+      for arg in args:
+        compileExpression(arg, code)
+      code.emit(CALL, len(args))
+      code.patch(skip, code.here())
+  else:
+    # Statements used as values evaluate to None.
+    compileStatement(expression, code)
+    code.emit(LOAD_CONST, code.const(None))
+
+def compileBlock(block, code):
+  for statement in block:
+    compileStatement(statement, code)
+
+def compileStatement(expression, code):
+  # Emit instructions that leave the stack as they found it.
+  manner = expression.manner
+  if manner == 0 or manner == 1:
+    compileExpression(expression, code)
+    code.emit(POP)
+  elif manner == 2: # Definition
+    compileExpression(expression.value[1], code)
+    code.emit(STORE_LOCAL, code.declare(expression.value[0]))
+  elif manner == 3: # Function construction
+    name, arguments, block = expression.value
+    body = compileBody(Code(parent = code, name = name, arguments = arguments), block)
+    code.emit(MAKE_FUNCTION, code.const(body))
+    code.emit(STORE_LOCAL, code.declare(name))
+  elif manner == 4: # Loop
+    start = code.here()
+    compileExpression(expression.value[0], code)
+    exit = code.emit(JUMP_IF_FALSE)
+    compileBlock(expression.value[1], code)
+    code.emit(JUMP, start)
+    code.patch(exit, code.here())
+  elif manner == 5: # Conditional
+    compileExpression(expression.value[0], code)
+    otherwise = code.emit(JUMP_IF_FALSE)
+    compileBlock(expression.value[1], code)
+    if expression.value[2] is not None:
+      end = code.emit(JUMP)
+      code.patch(otherwise, code.here())
+      compileBlock(expression.value[2], code)
+      code.patch(end, code.here())
+    else:
+      code.patch(otherwise, code.here())
+  elif manner == 6: # Return statement
+    # A CALL straight before a RETURN is a tail call, which execute makes without keeping our frame.
+    compileExpression(expression.value, code)
+    code.emit(RETURN)
+  elif manner == 8: # Event handler
+    # The condition and the block are compiled inline, each ending in a RETURN, and
+    # skipped over here; the trigger runs each of them from its start in this frame.
+    condition, block = expression.value
+    handler = code.emit(WHEN)
+    condition_start = code.here()
+    compileExpression(condition, code)
+    code.emit(RETURN)
+    block_start = code.here()
+    compileBlock(block, code)
+    code.emit(LOAD_CONST, code.const(None))
+    code.emit(RETURN)
+    code.ops[handler] = (WHEN, code.const((condition_start, block_start, triggers.conditionNames(condition))), code.here())
+
+def compileBody(code, block):
+  declareBlock(block, code)
+  compileBlock(block, code)
+  # Falling off the end returns None, so the machine never has to check for the end of the code.
+  code.emit(LOAD_CONST, code.const(None))
+  code.emit(RETURN)
+  return code
+
+def compileProgram(expressions):
+  return compileBody(Code(), expressions)
+
+def disassemble(code, indent = ""):
+  #DEBUGGING ONLY
+  lines = []
+  for pc in range(0, len(code.ops)):
+    op, a, b = code.ops[pc]
+    if op in (LOAD_LOCAL_CALL, LOAD_LOCAL_FUNCTION, STORE_LOCAL):
+      detail = "%d (%s)" % (a, code.local_names[a])
+    elif op in (LOAD_GLOBAL_CALL, LOAD_GLOBAL_FUNCTION):
+      detail = "%d (%s)" % (a, code.globals[a])
+    elif op in (LOAD_OUTER_CALL, LOAD_OUTER_FUNCTION):
+      detail = "%d:%d (%s)" % code.outers[a]
+    elif op == LOAD_CONST or op == MAKE_FUNCTION:
+      detail = repr(code.consts[a]) if not isinstance(code.consts[a], Code) else "<code %s>" % code.consts[a].name
+    elif op == WHEN:
+      detail = "if %d then %d" % code.consts[a][:2]
+    else:
+      detail = str(a)
+    if op in (LOAD_LOCAL_FUNCTION, LOAD_GLOBAL_FUNCTION, LOAD_OUTER_FUNCTION):
+      detail += " else %d" % b
+    elif op == WHEN:
+      detail += " after %d" % b
+    lines.append("%s%4d %-22s %s" % (indent, pc, opcode_names[op], detail))
+    if op == MAKE_FUNCTION:
+      lines.append(disassemble(code.consts[a], indent + "    "))
+  return "\n".join(lines)
+
+###################
+# Virtual machine #
+###################
+
+def loadOuter(frame, outer):
+  depth, slot, name = outer
+  for i in xrange(depth):
+    frame = frame.parent
+  value = frame.slots[slot]
+  if value is UNSET:
+    # Not assigned yet, so fall back to finding it by name above that frame.
+    value = frame.parent.lookup(name)
+  return value
+
+def execute(code, frame, state, values, pc = 0):
+  # Calls between CodeFunctions don't recurse in Python: the caller's code,
+  # position, frame and globals are saved on frames, and the callee runs in
+  # this same loop, pushing onto the same value stack. Every statement leaves
+  # the stack as it found it, so at a RETURN only the return value is left
+  # above what the caller had pushed. A call whose result is returned straight
+  # away (a tail call) replaces the caller instead, so it takes no depth.
+  # A `when` block's condition and block are run by starting at pc.
+  frames = []
+  ops = code.ops
+  consts = code.consts
+  slots = frame.slots
+  stack = []
+  push = stack.append
+  pop = stack.pop
+
+  # The branches are ordered roughly by how often loop-heavy programs hit them.
+  while True:
+    op, a, b = ops[pc]
+    pc += 1
+
+    if op == LOAD_CONST:
+      push(consts[a])
+    elif op == LOAD_LOCAL_CALL:
+      value = slots[a]
+      if value is UNSET:
+        value = frame.parent.lookup(code.local_names[a])
+      if value.__class__ is CodeFunction:
+        callee = callFrame(value, [], state, values)
+        if ops[pc][0] == RETURN:
+          state.depth -= 1
+        else:
+          frames.append((code, pc, frame, values))
+        code, frame, values = value.block, callee, value.values
+        ops, consts, slots, pc = code.ops, code.consts, frame.slots, 0
+        continue
+      if isinstance(value, CALLABLE_TYPES):
+        value = value.call([])
+      push(value)
+    elif op == LOAD_GLOBAL_FUNCTION:
+      value = values[a]
+      push(value)
+      if not isinstance(value, CALLABLE_TYPES):
+        pc = b
+    elif op == CALL:
+      args = stack[-a:]
+      del stack[-a:]
+      function = pop()
+      if function.__class__ is CodeFunction:
+        callee = callFrame(function, args, state, values)
+        if ops[pc][0] == RETURN:
+          state.depth -= 1
+        else:
+          frames.append((code, pc, frame, values))
+        code, frame, values = function.block, callee, function.values
+        ops, consts, slots, pc = code.ops, code.consts, frame.slots, 0
+        continue
+      # Call builtins' lambdas directly rather than through NativeFunction.call.
+      push(function.function(args) if function.__class__ is NativeFunction else function.call(args))
+    elif op == JUMP_IF_FALSE:
+      if not pop():
+        pc = a
+    elif op == STORE_LOCAL:
+      slots[a] = pop()
+    elif op == LOAD_GLOBAL_CALL:
+      value = values[a]
+      if value.__class__ is CodeFunction:
+        callee = callFrame(value, [], state, values)
+        if ops[pc][0] == RETURN:
+          state.depth -= 1
+        else:
+          frames.append((code, pc, frame, values))
+        code, frame, values = value.block, callee, value.values
+        ops, consts, slots, pc = code.ops, code.consts, frame.slots, 0
+        continue
+      if isinstance(value, CALLABLE_TYPES):
+        value = value.call([])
+      push(value)
+    elif op == POP:
+      pop()
+    elif op == JUMP:
+      if a < pc:
+        # The end of a loop iteration: count the loop's instructions, stop if cancelled, and now and then check the limits.
+        state.steps += pc - a
+        if state.cancelled or state.steps >= state.check_at:
+          state.check()
+      pc = a
+    elif op == RETURN:
+      if not frames:
+        return pop()
+      # The return value stays on the stack for the caller.
+      state.depth -= 1
+      code, pc, frame, values = frames.pop()
+      ops, consts, slots = code.ops, code.consts, frame.slots
+    elif op == LOAD_LOCAL_FUNCTION:
+      value = slots[a]
+      if value is UNSET:
+        value = frame.parent.lookup(code.local_names[a])
+      push(value)
+      if not isinstance(value, CALLABLE_TYPES):
+        pc = b
+    elif op == LOAD_OUTER_CALL:
+      value = loadOuter(frame, code.outers[a])
+      if value.__class__ is CodeFunction:
+        callee = callFrame(value, [], state, values)
+        if ops[pc][0] == RETURN:
+          state.depth -= 1
+        else:
+          frames.append((code, pc, frame, values))
+        code, frame, values = value.block, callee, value.values
+        ops, consts, slots, pc = code.ops, code.consts, frame.slots, 0
+        continue
+      if isinstance(value, CALLABLE_TYPES):
+        value = value.call([])
+      push(value)
+    elif op == LOAD_OUTER_FUNCTION:
+      value = loadOuter(frame, code.outers[a])
+      push(value)
+      if not isinstance(value, CALLABLE_TYPES):
+        pc = b
+    elif op == MAKE_FUNCTION:
+      push(CodeFunction(frame, consts[a], values))
+    elif op == WHEN:
+      addTrigger(code, frame, state, values, consts[a])
+      pc = b
+
+def addTrigger(code, frame, state, values, handler):
+  condition_start, block_start, names = handler
+  keys = triggers.conditionKeys(names, frame, interpreter.builtin_state)
+  interpreter.currentSession().when(triggers.Trigger(lambda: execute(code, frame, state, values, condition_start),
+    lambda: execute(code, frame, state, values, block_start), keys))
+
+def run(code, closure, state = None):
+  #Run a compiled program against a scope, normally interpreter.global_scope.
+  #The program's own variables live in a frame of slots beneath it, and the
+  #run counts towards the limits of state (by default, the current session's).
+  if state is None:
+    state = interpreter.currentSession().state
+  state.values = [closure.lookup(name) for name in code.globals]
+  frame = Stack(closure, slots = [UNSET] * len(code.local_names), layout = code.layout)
+  result = execute(code, frame, state, state.values)
+  interpreter.currentSession().listen()
+  return result
+
+def runInSession(code, session):
+  #Run a compiled program in an interpreter.Session (which should be entered),
+  #leaving its variables in the session's scope for the next program.
+  scope = session.scope
+  state = session.state
+  state.values = [scope.lookup(name) for name in code.globals]
+  frame = Stack(scope, slots = [UNSET] * len(code.local_names), layout = code.layout)
+  if any(isinstance(const, Code) for const in code.consts):
+    # Functions defined here can be called by later programs, and will need their globals kept current.
+    session.runs.append((code, state.values))
+  state.publish = lambda: publish(code, frame, session)
+  try:
+    result = execute(code, frame, state, state.values)
+    session.listen()
+    return result
+  finally:
+    state.publish = None
+    publish(code, frame, session, finished = True)
+
+def publish(code, frame, session, finished = False):
+  #Copy the variables a run has set into the session's scope, and into the
+  #global tables of its earlier runs, so their functions see them. Once the
+  #run has finished, its slots are cleared and its own functions read the
+  #scope too.
+  scope = session.scope
+  changed = []
+  for name, slot in code.layout.iteritems():
+    if frame.slots[slot] is not UNSET:
+      scope.set(name, frame.slots[slot])
+      if finished:
+        frame.slots[slot] = UNSET
+      changed.append(name)
+  for old_code, old_values in session.runs:
+    for name in changed:
+      if name in old_code.global_index:
+        old_values[old_code.global_index[name]] = scope.lookup(name)
+
+if __name__ == "__main__":
+  import optimizer
+  log = []
+  interpreter.resetGlobalScope(log)
+  optimized, report = optimizer.optimize(interpreter.fullParse(open(sys.argv[1]).read()))
+  program = compileProgram(optimized)
+  if len(sys.argv) > 2 and sys.argv[2] == "--disassemble":
+    print disassemble(program)
+    print report.toDict()
+  run(program, interpreter.global_scope)
+  print "\n".join(log)